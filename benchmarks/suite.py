@@ -0,0 +1,247 @@
+"""
+Times the workloads in benchmarks.workloads over tables of several sizes
+and records, for each, the throughput, the latency percentiles and the
+peak memory traced while it ran. The results can be written to a JSON
+file and compared with an earlier run kept as the baseline.
+
+Run from the repository root:
+
+    python -m benchmarks --sizes 1000,10000 --output results.json
+    python -m benchmarks --baseline results.json
+
+Comparing with a baseline exits with status 1 if a workload's median
+latency grew by more than the threshold.
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import project
+from benchmarks.workloads import WORKLOADS
+
+# Iterations whose peak memory is traced, in a run of their own, as
+# tracing slows everything down.
+MEMORY_ITERATIONS = 3
+_DATABASE_NUMBERS = itertools.count()
+
+
+def fresh_connection(storage, directory):
+    """
+    Returns a connection to an empty database: in memory, or in a file
+    of its own under directory.
+    """
+    if storage == "file":
+        return project.connect(os.path.join(
+            directory, "{}.db".format(next(_DATABASE_NUMBERS))))
+    connection = project.connect(":memory:")
+    for table_name in list(connection.database.tables):
+        connection.execute("DROP TABLE {};".format(table_name))
+    return connection
+
+
+def prepare(workload, storage, directory, size):
+    operation = workload(fresh_connection(storage, directory), size)
+    if isinstance(operation, tuple):
+        return operation
+    return operation, None
+
+
+def percentile(ordered, fraction):
+    """
+    Returns the value below which fraction of the sorted values in
+    ordered fall (nearest rank).
+    """
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def time_workload(workload, storage, directory, size, min_time,
+                  min_iterations, max_iterations):
+    """
+    Runs one warm-up iteration, then iterations until min_time seconds
+    have been timed (at least min_iterations, at most max_iterations),
+    and returns the latency of each.
+    """
+    operation, before = prepare(workload, storage, directory, size)
+    latencies = []
+    timed = 0.0
+    number = 0
+    while (number <= min_iterations or timed < min_time) and \
+            number <= max_iterations:
+        if before is not None:
+            before(number)
+        start = time.perf_counter()
+        operation(number)
+        elapsed = time.perf_counter() - start
+        if number:
+            latencies.append(elapsed)
+            timed += elapsed
+        number += 1
+    return latencies
+
+
+def trace_memory(workload, storage, directory, size):
+    """
+    Returns the peak memory allocated while making the workload's tables
+    and running MEMORY_ITERATIONS of it, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        operation, before = prepare(workload, storage, directory, size)
+        for number in range(MEMORY_ITERATIONS):
+            if before is not None:
+                before(number)
+            operation(number)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(latencies, peak_memory):
+    ordered = sorted(latencies)
+    milliseconds = 1000.0
+    return {
+        "iterations": len(latencies),
+        "seconds": sum(latencies),
+        "throughput": len(latencies) / sum(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * milliseconds,
+        "p50_ms": percentile(ordered, 0.5) * milliseconds,
+        "p90_ms": percentile(ordered, 0.9) * milliseconds,
+        "p99_ms": percentile(ordered, 0.99) * milliseconds,
+        "max_ms": ordered[-1] * milliseconds,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run(sizes, names=None, storage="memory", min_time=0.5,
+        min_iterations=5, max_iterations=10000, memory=True, report=print):
+    """
+    Returns the results of the workloads (all, or those in names) at
+    each size, keyed "workload/size", with the environment they ran in.
+    """
+    directory = tempfile.mkdtemp(prefix="benchmarks-")
+    results = {}
+    try:
+        for size in sizes:
+            for name, workload in WORKLOADS:
+                if names and name not in names:
+                    continue
+                latencies = time_workload(workload, storage, directory, size,
+                                          min_time, min_iterations,
+                                          max_iterations)
+                peak_memory = None
+                if memory:
+                    peak_memory = trace_memory(workload, storage, directory,
+                                               size)
+                result = summarize(latencies, peak_memory)
+                results["{}/{}".format(name, size)] = result
+                report("{:<34} {:>8} it {:>10.3f} ms p50 {:>10.3f} ms p99"
+                       .format("{}/{}".format(name, size),
+                               result["iterations"], result["p50_ms"],
+                               result["p99_ms"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "storage": storage,
+        "sizes": list(sizes),
+        "results": results,
+    }
+
+
+def compare(run_results, baseline, threshold):
+    """
+    Returns a line for each workload run both now and in the baseline,
+    with the change in median latency and throughput, and the keys of the
+    workloads whose median latency grew by more than threshold (0.25 for
+    25%).
+    """
+    lines = ["{:<34} {:>12} {:>12} {:>9} {:>9}".format(
+        "workload", "base p50 ms", "p50 ms", "p50", "ops/s")]
+    regressions = []
+    for key, result in run_results["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        latency_change = result["p50_ms"] / base["p50_ms"] - 1
+        throughput_change = result["throughput"] / base["throughput"] - 1
+        flag = ""
+        if latency_change > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        lines.append("{:<34} {:>12.3f} {:>12.3f} {:>+8.1%} {:>+8.1%}{}"
+                     .format(key, base["p50_ms"], result["p50_ms"],
+                             latency_change, throughput_change, flag))
+    return lines, regressions
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Times the database's workloads on synthetic tables.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma-separated table sizes, in rows")
+    parser.add_argument("--workloads", default="",
+                        help="comma-separated workloads to run (default all: "
+                             "{})".format(", ".join(name for name, _
+                                                    in WORKLOADS)))
+    parser.add_argument("--storage", choices=["memory", "file"],
+                        default="memory")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="seconds to time each workload for")
+    parser.add_argument("--min-iterations", type=int, default=5)
+    parser.add_argument("--max-iterations", type=int, default=10000)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the traced run measuring peak memory")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="median latency growth counted as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    sizes = [int(size) for size in arguments.sizes.split(",")]
+    names = [name for name in arguments.workloads.split(",") if name]
+    unknown = set(names) - {name for name, _ in WORKLOADS}
+    if unknown:
+        raise SystemExit("Unknown workloads: {}".format(
+            ", ".join(sorted(unknown))))
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+    results = run(sizes, names, arguments.storage, arguments.min_time,
+                  arguments.min_iterations, arguments.max_iterations,
+                  not arguments.no_memory)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if baseline is not None:
+        lines, regressions = compare(results, baseline, arguments.threshold)
+        print()
+        if baseline.get("storage") != results["storage"]:
+            print("The baseline used {} storage, this run {}.".format(
+                baseline.get("storage"), results["storage"]))
+        print("\n".join(lines))
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
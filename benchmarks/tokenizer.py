@@ -0,0 +1,166 @@
+"""
+Compares the tokenizer in project.py with the slice-based tokenizer it
+replaced, on statements of increasing size.
+
+Run from the repository root:
+
+    python -m benchmarks.tokenizer
+"""
+import string
+import time
+
+import project
+
+
+# The previous tokenizer, kept verbatim as the baseline. Every helper
+# returns query[len(token):], so each token copies the rest of the query.
+
+def collect_characters(query, allowed_characters):
+    letters = []
+    for letter in query:
+        if letter not in allowed_characters:
+            break
+        letters.append(letter)
+    return "".join(letters)
+
+
+def remove_leading_whitespace(query, tokens):
+    whitespace = collect_characters(query, string.whitespace)
+    return query[len(whitespace):]
+
+
+def remove_word(query, tokens):
+    word = collect_characters(query,
+                              string.ascii_letters + "_" + string.digits)
+    if word == "NULL":
+        tokens.append(None)
+    else:
+        tokens.append(word)
+    return query[len(word):]
+
+
+def remove_text(query, tokens):
+    if (query[0] == "'"):
+        delimiter = "'"
+    else:
+        delimiter = '"'
+    query = query[1:]
+    end_quote_index = query.find(delimiter)
+    while query[end_quote_index + 1] == delimiter:
+        # Remove Escaped Quote
+        query = query[:end_quote_index] + query[end_quote_index + 1:]
+        end_quote_index = query.find(delimiter, end_quote_index + 1)
+    text = query[:end_quote_index]
+    tokens.append(text)
+    query = query[end_quote_index + 1:]
+    return query
+
+
+def remove_integer(query, tokens):
+    int_str = collect_characters(query, string.digits)
+    tokens.append(int_str)
+    return query[len(int_str):]
+
+
+def remove_number(query, tokens):
+    query = remove_integer(query, tokens)
+    if query[0] == ".":
+        whole_str = tokens.pop()
+        query = query[1:]
+        query = remove_integer(query, tokens)
+        frac_str = tokens.pop()
+        float_str = whole_str + "." + frac_str
+        tokens.append(float(float_str))
+    else:
+        int_str = tokens.pop()
+        tokens.append(int(int_str))
+    return query
+
+
+def old_tokenize(query):
+    tokens = []
+    parameter_count = 0
+    while query:
+        old_query = query
+
+        if query[0] == "?":
+            tokens.append(project.Parameter(parameter_count))
+            parameter_count += 1
+            query = query[1:]
+            continue
+
+        if query[0] in string.whitespace:
+            query = remove_leading_whitespace(query, tokens)
+            continue
+
+        if query[0] in (string.ascii_letters + "_"):
+            query = remove_word(query, tokens)
+            continue
+
+        if query[:2] == "!=":
+            tokens.append(query[:2])
+            query = query[2:]
+            continue
+
+        if query[0] in "(),;*.><=":
+            tokens.append(query[0])
+            query = query[1:]
+            continue
+
+        if query[0] in {"'", '"'}:
+            query = remove_text(query, tokens)
+            continue
+
+        if query[0] in string.digits:
+            query = remove_number(query, tokens)
+            continue
+
+        if len(query) == len(old_query):
+            raise AssertionError(
+                "Query didn't get shorter. query = {}".format(query))
+
+    return tokens
+
+
+def make_insert(row_count):
+    rows = []
+    for i in range(row_count):
+        rows.append("({}, {}.5, 'name''{}', NULL, \"x\")".format(i, i, i))
+    return "INSERT INTO t VALUES " + ", ".join(rows) + ";"
+
+
+def make_select(column_count):
+    columns = ", ".join("t.c{}".format(i) for i in range(column_count))
+    return ("SELECT DISTINCT " + columns +
+            " FROM t WHERE t.c0 != 'it''s' ORDER BY c1 DESC, c2;")
+
+
+def best_time(function, argument, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    cases = [("INSERT, {} rows".format(n), make_insert(n))
+             for n in (10, 100, 1000, 10000)]
+    cases += [("SELECT, {} columns".format(n), make_select(n))
+              for n in (10, 1000)]
+    print("{:<22} {:>9} {:>12} {:>12} {:>9}".format(
+        "statement", "chars", "old (s)", "new (s)", "speedup"))
+    for name, statement in cases:
+        assert old_tokenize(statement) == project.tokenize(statement), name
+        repeat = 5 if len(statement) < 100000 else 1
+        old = best_time(old_tokenize, statement, repeat)
+        new = best_time(project.tokenize, statement, repeat)
+        print("{:<22} {:>9} {:>12.6f} {:>12.6f} {:>8.1f}x".format(
+            name, len(statement), old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
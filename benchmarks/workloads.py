@@ -0,0 +1,182 @@
+"""
+The workloads the benchmark suite times, each over synthetic tables of
+a given size.
+
+A workload is a function taking a connection and a table size. It
+creates and fills the tables it needs, then returns the operation to
+time: a function running one iteration, given that iteration's number.
+It may instead return an (operation, before) pair, where before(number)
+runs ahead of each iteration without being timed.
+"""
+import random
+
+GROUP_SIZE = 100
+BATCH_ROWS = 100
+
+
+def group_count(size):
+    return max(1, size // GROUP_SIZE)
+
+
+def make_rows(size, seed=0, first_id=0):
+    """
+    Returns size rows of (id, grp, name, score) with ids from first_id
+    on, grp and score drawn at random and about GROUP_SIZE rows a group.
+    """
+    generator = random.Random(seed)
+    groups = group_count(size)
+    return [(first_id + i, generator.randrange(groups),
+             "name{}".format(generator.randrange(1000)), generator.random())
+            for i in range(size)]
+
+
+def create_table(connection, table_name, size, seed=0):
+    connection.execute("CREATE TABLE {} (id INTEGER, grp INTEGER, "
+                       "name TEXT, score REAL);".format(table_name))
+    connection.bulk_load(table_name, ("{},{},{},{!r}".format(*row)
+                                      for row in make_rows(size, seed)))
+
+
+def values_list(rows):
+    # Fixed-point scores: SQL number literals have no exponent.
+    return ", ".join("({}, {}, '{}', {:.6f})".format(*row) for row in rows)
+
+
+def point_select(connection, size):
+    create_table(connection, "t", size)
+    connection.execute("CREATE INDEX t_id ON t (id);")
+    statement = connection.prepare("SELECT name, score FROM t WHERE id = ?;")
+    ids = random.Random(1)
+
+    def operation(number):
+        list(connection.execute(statement, (ids.randrange(size),)))
+    return operation
+
+
+def range_select_order_by(connection, size):
+    create_table(connection, "t", size)
+    statement = connection.prepare(
+        "SELECT id, score FROM t WHERE score > ? AND score < ? "
+        "ORDER BY score;")
+    lows = random.Random(1)
+
+    def operation(number):
+        low = lows.random() * 0.99
+        list(connection.execute(statement, (low, low + 0.01)))
+    return operation
+
+
+def multi_row_insert(connection, size):
+    create_table(connection, "t", size)
+    statement = connection.prepare("INSERT INTO t VALUES {};".format(
+        values_list(make_rows(BATCH_ROWS, seed=1, first_id=size))))
+
+    def operation(number):
+        connection.execute(statement)
+    return operation
+
+
+def executemany(connection, size):
+    create_table(connection, "t", size)
+    rows = make_rows(BATCH_ROWS, seed=1, first_id=size)
+
+    def operation(number):
+        connection.executemany("INSERT INTO t VALUES (?, ?, ?, ?);", rows)
+    return operation
+
+
+def update_where(connection, size):
+    create_table(connection, "t", size)
+    statement = connection.prepare("UPDATE t SET score = ? WHERE grp = ?;")
+    groups = group_count(size)
+
+    def operation(number):
+        connection.execute(statement, (number / 1000.0, number % groups))
+    return operation
+
+
+def delete_where(connection, size):
+    create_table(connection, "t", size)
+    # A group none of the generated rows is in.
+    doomed = group_count(size)
+    insert = connection.prepare("INSERT INTO t VALUES {};".format(
+        values_list((row[0], doomed) + row[2:] for row in
+                    make_rows(BATCH_ROWS, seed=1, first_id=size))))
+    statement = connection.prepare("DELETE FROM t WHERE grp = ?;")
+
+    def before(number):
+        connection.execute(insert)
+
+    def operation(number):
+        connection.execute(statement, (doomed,))
+    return operation, before
+
+
+def left_join(connection, size):
+    create_table(connection, "t", size)
+    connection.execute("CREATE TABLE g (grp INTEGER, label TEXT);")
+    connection.bulk_load("g", ("{},group{}".format(group, group)
+                               for group in range(group_count(size))))
+    statement = connection.prepare(
+        "SELECT t.id, g.label FROM t LEFT OUTER JOIN g ON t.grp = g.grp "
+        "WHERE t.score < ?;")
+
+    def operation(number):
+        list(connection.execute(statement, (0.1,)))
+    return operation
+
+
+def distinct(connection, size):
+    create_table(connection, "t", size)
+
+    def operation(number):
+        list(connection.execute("SELECT DISTINCT grp, name FROM t;"))
+    return operation
+
+
+def min_max(connection, size):
+    create_table(connection, "t", size)
+
+    def operation(number):
+        list(connection.execute("SELECT min(score), max(score) FROM t;"))
+    return operation
+
+
+def view_select(connection, size):
+    create_table(connection, "t", size)
+    connection.execute("CREATE VIEW v AS SELECT id, grp, score FROM t "
+                       "WHERE score < 0.5;")
+    statement = connection.prepare("SELECT id, score FROM v WHERE grp = ?;")
+    groups = group_count(size)
+
+    def operation(number):
+        list(connection.execute(statement, (number % groups,)))
+    return operation
+
+
+def transaction_cycle(connection, size):
+    create_table(connection, "t", size)
+    update = connection.prepare("UPDATE t SET score = ? WHERE id = ?;")
+    insert = connection.prepare("INSERT INTO t VALUES (?, ?, ?, ?);")
+
+    def operation(number):
+        connection.execute("BEGIN TRANSACTION;")
+        connection.execute(update, (0.5, number % size))
+        connection.execute(insert, (size + number, 0, "new", 0.5))
+        connection.execute("COMMIT TRANSACTION;")
+    return operation
+
+
+WORKLOADS = [
+    ("point_select", point_select),
+    ("range_select_order_by", range_select_order_by),
+    ("multi_row_insert", multi_row_insert),
+    ("executemany", executemany),
+    ("update_where", update_where),
+    ("delete_where", delete_where),
+    ("left_join", left_join),
+    ("distinct", distinct),
+    ("min_max", min_max),
+    ("view_select", view_select),
+    ("transaction_cycle", transaction_cycle),
+]
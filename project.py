@@ -1,572 +1,966 @@
-import string
-import copy
+import re
+import os
+import csv
+import json
+import math
+import mmap
+import queue
+import bisect
+import concurrent.futures
+import contextlib
+import heapq
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+from array import array
 from operator import itemgetter
-from collections import namedtuple
-from functools import cmp_to_key
+from collections import namedtuple, OrderedDict, deque
+from collections.abc import MutableMapping
+from functools import cmp_to_key, lru_cache
 import itertools
 
-_ALL_DATABASES = {}
-_TRANSACTION_CNTR = 0
+# Every connection, and every pooled connection each time it is reset,
+# takes the next of these as the id its locks are held under.
+_CONNECTION_IDS = itertools.count(1)
+# Serializes loading the parts of a database file that are read lazily.
+_LOAD_LOCK = threading.RLock()
+# Seconds a statement waits for a lock before giving up, as in sqlite3.
+LOCK_TIMEOUT = 5.0
+# Rows in a morsel, the unit of work a parallel scan hands to a worker,
+# and how many morsels are handed out at once (each holds a copy of its
+# rows until its worker is done).
+MORSEL_ROWS = 65536
+MORSELS_IN_FLIGHT = 16
+# Rows a bulk load converts and appends at a time.
+BULK_LOAD_ROWS = 65536
+# Rows a checkpoint copies at a time, letting committing threads run in
+# between.
+CHECKPOINT_COPY_ROWS = 65536
+# Sort keys each key-based collation keeps, for the values it was most
+# recently handed.
+COLLATION_KEYS_CACHED = 65536
+_EXECUTORS = {}
+_EXECUTORS_LOCK = threading.Lock()
+# Every change to any table gives it the next of these, so a version
+# names one state of one table.
+_TABLE_VERSIONS = itertools.count(1)
+# How many connections have a profile callback, and the StatementProfile
+# of the statement each thread is running, if that is being profiled.
+# While no connection profiles, the operators skip looking it up.
+_PROFILERS = 0
+_PROFILERS_LOCK = threading.Lock()
+_PROFILING = threading.local()
 
 WhereClause = namedtuple("WhereClause", ["col_name", "operator", "constant"])
+ColumnComparison = namedtuple("ColumnComparison",
+                              ["col_name", "operator", "other_col_name"])
+InList = namedtuple("InList", ["col_name", "values", "negated"])
+Between = namedtuple("Between", ["col_name", "low", "high", "negated"])
+Like = namedtuple("Like", ["col_name", "pattern", "negated"])
+BooleanExpression = namedtuple("BooleanExpression", ["operator", "operands"])
+NotExpression = namedtuple("NotExpression", ["operand"])
 UpdateClause = namedtuple("UpdateClause", ["col_name", "constant"])
 FromJoinClause = namedtuple("FromJoinClause", ["left_table_name",
                                                "right_table_name",
                                                "left_join_col_name",
                                                "right_join_col_name"])
+Aggregate = namedtuple("Aggregate", ["function", "col_name"])
+Parameter = namedtuple("Parameter", ["index"])
+AccessPath = namedtuple("AccessPath", ["table_name", "index_name", "condition",
+                                       "residual", "positions", "rows",
+                                       "cost"])
+JoinPlan = namedtuple("JoinPlan", ["strategy", "left", "right",
+                                   "left_position", "right_position",
+                                   "residual", "rows", "cost"])
+AggregatePlan = namedtuple("AggregatePlan", ["items", "output_items",
+                                             "sort_keys", "having_item",
+                                             "group_positions"])
+PlanStep = namedtuple("PlanStep", ["operator", "detail", "columns", "rows",
+                                   "cost", "inputs"])
+
+
+class QuotedText(str):
+    """
+    A quoted string token, which the parser must not take for a name.
+    """
+
+
+PreparedStatement = namedtuple("PreparedStatement", ["sql", "statement",
+                                                     "parameter_count", "key"])
+
+BeginStatement = namedtuple("BeginStatement", ["mode"])
+CommitStatement = namedtuple("CommitStatement", [])
+RollbackStatement = namedtuple("RollbackStatement", [])
+CreateTableStatement = namedtuple("CreateTableStatement",
+                                  ["table_name", "column_name_type_pairs",
+                                   "notexists", "default_values"])
+CreateIndexStatement = namedtuple("CreateIndexStatement",
+                                  ["index_name", "table_name", "col_name",
+                                   "notexists"])
+CreateViewStatement = namedtuple("CreateViewStatement",
+                                 ["view_name", "select", "materialized",
+                                  "select_tokens"])
+DropTableStatement = namedtuple("DropTableStatement",
+                                ["table_name", "ifexists"])
+DropIndexStatement = namedtuple("DropIndexStatement",
+                                ["index_name", "ifexists"])
+DropViewStatement = namedtuple("DropViewStatement",
+                               ["view_name", "materialized", "ifexists"])
+InsertStatement = namedtuple("InsertStatement",
+                             ["table_name", "qual_col_names", "rows"])
+UpdateStatement = namedtuple("UpdateStatement",
+                             ["table_name", "update_clauses", "where_clause"])
+DeleteStatement = namedtuple("DeleteStatement",
+                             ["table_name", "where_clause"])
+SelectStatement = namedtuple("SelectStatement",
+                             ["output_columns", "aggregates", "is_distinct",
+                              "from_join_clause", "where_clause",
+                              "group_by_columns", "having_clause",
+                              "order_by_columns", "limit", "offset"])
+ExplainStatement = namedtuple("ExplainStatement", ["query_plan", "statement"])
+AnalyzeStatement = namedtuple("AnalyzeStatement", ["table_name"])
+CopyStatement = namedtuple("CopyStatement", ["table_name", "qual_col_names",
+                                             "path", "format", "header"])
+
+STATEMENT_RUNNERS = {
+    BeginStatement: "_begin",
+    CommitStatement: "_commit",
+    RollbackStatement: "_rollback",
+    CreateTableStatement: "_create_table",
+    CreateIndexStatement: "_create_index",
+    CreateViewStatement: "_create_view",
+    DropTableStatement: "_drop_table",
+    DropIndexStatement: "_drop_index",
+    DropViewStatement: "_drop_view",
+    InsertStatement: "_insert",
+    UpdateStatement: "_update",
+    DeleteStatement: "_delete",
+    SelectStatement: "_select",
+    ExplainStatement: "_explain",
+    AnalyzeStatement: "_analyze",
+    CopyStatement: "_copy",
+}
 
 
 class Connection(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, cached_statements=128, timeout=LOCK_TIMEOUT):
         """
-        Takes a filename, but doesn't do anything with it.
-        (The filename will be used in a future project).
+        Takes the filename of the database file, which is opened if it
+        exists and created by the first change otherwise. ":memory:" keeps
+        the database in this process only. timeout is how many seconds a
+        statement waits for another connection's lock (None to wait for
+        as long as it takes).
         """
-        if filename in _ALL_DATABASES:
-            self.database = _ALL_DATABASES[filename]
-        else:
-            self.database = Database(filename)
-            _ALL_DATABASES[filename] = self.database
-    
+        self.database = _ALL_DATABASES.open(filename)
         self.filename = filename
         self.begin_transaction = False
         self.temp_database = None
         self.needs_exclusive = False
-        self.id_ = _TRANSACTION_CNTR
+        self.id_ = next(_CONNECTION_IDS)
+        self.timeout = timeout
+        self.statement_shared = False
+        self.executor = None
         self.view_queries = {}
-        self.view_select = False
-        self.collations = {}
-        
-    def create_collation(self, collation_name, function):
-        self.collations[collation_name] = function
-    
+        self.cached_statements = cached_statements
+        self.statement_cache = OrderedDict()
+        self.trace_callback = None
+        self.profile_callback = None
+
+    def set_parallelism(self, degree, processes=False):
+        """
+        Lets SELECT, UPDATE and DELETE split the full scans of large
+        tables into morsels run on degree workers at once, threads or
+        (with processes) processes. A degree of 1 runs everything on the
+        calling thread again.
+        """
+        assert degree >= 1
+        self.executor = None
+        if degree > 1:
+            self.executor = shared_executor(degree, processes)
+
+    def create_collation(self, collation_name, function, key=None):
+        """
+        Registers a collation for ORDER BY ... COLLATE on this
+        connection's database, shared by every connection to it.
+        function compares two values as in sqlite3; key, if given,
+        instead maps a value to a sort key ordered the same way, which
+        sorts much faster (function may then be None). With neither, the
+        collation is removed.
+        """
+        self.database.create_collation(collation_name, function, key)
+
+    def set_trace_callback(self, callback):
+        """
+        Calls callback with the SQL of each statement run on this
+        connection, as it starts, as in sqlite3. None stops it.
+        """
+        self.trace_callback = callback
+
+    def set_profile_callback(self, callback):
+        """
+        Profiles every statement run on this connection: once it is done
+        (for a SELECT, once its last row has been read or its cursor
+        closed), callback is called with its StatementProfile, which is
+        also added to the database's counters. None stops profiling.
+        """
+        global _PROFILERS
+        with _PROFILERS_LOCK:
+            _PROFILERS += ((callback is not None) -
+                           (self.profile_callback is not None))
+        self.profile_callback = callback
+
+    def prepare(self, statement):
+        """
+        Parses a SQL statement into a PreparedStatement, reusing the
+        parse of an identical statement from the cache.
+        """
+        if statement in self.statement_cache:
+            self.statement_cache.move_to_end(statement)
+            return self.statement_cache[statement]
+        profile = current_profile()
+        if profile is not None:
+            started = profile.begin()
+        tokens = deque(tokenize(statement))
+        if profile is not None:
+            profile.end("tokenize", started)
+            started = profile.begin()
+        last_semicolon = tokens.pop()
+        assert last_semicolon == ";"
+        parameter_count = sum(isinstance(token, Parameter) for token in tokens)
+        # The tokens with their types, so that quoted text does not
+        # collide with a name, are the statement with its layout left out.
+        key = tuple((type(token), token) for token in tokens)
+        prepared = PreparedStatement(statement, parse_statement(tokens),
+                                     parameter_count, key)
+        if profile is not None:
+            profile.end("parse", started)
+        self.statement_cache[statement] = prepared
+        if len(self.statement_cache) > self.cached_statements:
+            self.statement_cache.popitem(last=False)
+        return prepared
+
     def executemany(self, statement, value_sets):
+        prepared = self.prepare(statement)
         for value_set in value_sets:
-            new_statement = statement
-            for value in value_set:
-                if(isinstance(value,str)):
-                    replace_value = "\'" + value + "\'"
-                else:
-                    replace_value = str(value)
-                new_statement = new_statement.replace("?",replace_value,1)
-            self.execute(new_statement)
-        
-    def execute(self, statement):
-        
-        def begin(tokens):
-            pop_and_check(tokens, "BEGIN")
-            if(tokens[0] == "DEFERRED"):
-                tokens.pop(0)
-            elif(tokens[0] == "IMMEDIATE"):
-                tokens.pop(0)
-                self.database.add_reserved_lock(self.id_)
-            elif(tokens[0] == "EXCLUSIVE"):
-                tokens.pop(0)
-                self.database.add_exclusive_lock(self.id_)
-            pop_and_check(tokens, "TRANSACTION")
-            assert self.begin_transaction == False
-            self.begin_transaction = True
-            self.temp_database = copy.deepcopy(self.database)
-            
-        def commit(tokens):
-            pop_and_check(tokens, "COMMIT")
-            pop_and_check(tokens, "TRANSACTION")
-            assert self.begin_transaction == True
-            self.database.commit(self.id_, self.needs_exclusive)
-            self.begin_transaction = False
-            self.database.tables = self.temp_database.tables
-            self.temp_database = None
-            self.needs_exclusive = False
-            
-        def create(tokens):
-            pop_and_check(tokens, "CREATE")
-            if tokens[0] == "TABLE":
-                create_table(tokens)
-            else:
-                create_view(tokens)
-        """
-        Takes a SQL statement.
-        Returns a list of tuples (empty unless select statement
-        with rows to return).
-        """
-        def create_table(tokens):
-            """
-            Determines the name and column information from tokens add
-            has the database create a new table within itself.
-            """
-            pop_and_check(tokens, "TABLE")
-            notexists = False
-            if(tokens[0] == "IF"):
-                pop_and_check(tokens, "IF")
-                pop_and_check(tokens, "NOT")
-                pop_and_check(tokens, "EXISTS")
-                notexists = True
-            table_name = tokens.pop(0)
-            pop_and_check(tokens, "(")
-            column_name_type_pairs = []
-            default_values = {}
-            while True:
-                column_name = tokens.pop(0)
-                qual_col_name = QualifiedColumnName(column_name, table_name)
-                column_type = tokens.pop(0)
-                assert column_type in {"TEXT", "INTEGER", "REAL"}
-                column_name_type_pairs.append((qual_col_name, column_type))
-                if(tokens[0] == "DEFAULT"):
-                    pop_and_check(tokens, "DEFAULT")
-                    default_val = tokens.pop(0)
-                    default_values[qual_col_name] = default_val
-                comma_or_close = tokens.pop(0)
-                if comma_or_close == ")":
-                    break
-                assert comma_or_close == ','
-            self.database.create_new_table(table_name, column_name_type_pairs, notexists, default_values)
-
-        def create_view(tokens):
-            pop_and_check(tokens, "VIEW")
-            view_name = tokens.pop(0)
-            pop_and_check(tokens, "AS")
-            self.view_queries[view_name] = tokens
-            test_view = self.view_queries[view_name]
-            
-        def insert(tokens):
-            """
-            Determines the table name and row values to add.
-            """
-            def get_comma_seperated_contents(tokens):
-                contents = []
-                pop_and_check(tokens, "(")
-                while True:
-                    item = tokens.pop(0)
-                    contents.append(item)
-                    comma_or_close = tokens.pop(0)
-                    if comma_or_close == ")":
-                        return contents
-                    assert comma_or_close == ',', comma_or_close
-
-            pop_and_check(tokens, "INSERT")
-            if(self.begin_transaction == True):
-                self.needs_exclusive = True
-                self.database.add_reserved_lock(self.id_)
-            else:
-                self.database.add_reserved_lock(self.id_)
-                self.database.add_exclusive_lock(self.id_)
-                self.database.release_reserved_lock(self.id_)
-                self.database.release_exclusive_lock(self.id_)
-            pop_and_check(tokens, "INTO")
-            table_name = tokens.pop(0)
-            if tokens[0] == "DEFAULT":
-                pop_and_check(tokens, "DEFAULT")
-                pop_and_check(tokens, "VALUES")
-                if self.begin_transaction == True:
-                    self.temp_database.insert_default_into(table_name)
-                else:
-                    self.database.insert_default_into(table_name)
-            else:
-                if tokens[0] == "(":
-                    col_names = get_comma_seperated_contents(tokens)
-                    qual_col_names = [QualifiedColumnName(col_name, table_name)
-                                      for col_name in col_names]
-                else:
-                    qual_col_names = None
-                pop_and_check(tokens, "VALUES")
-                while tokens:
-                    row_contents = get_comma_seperated_contents(tokens)
-                    if qual_col_names:
-                        assert len(row_contents) == len(qual_col_names)
-                    if self.begin_transaction == True:
-                        self.temp_database.insert_into(table_name,
-                                              row_contents,
-                                              qual_col_names=qual_col_names)
-                    else:
-                        self.database.insert_into(table_name,
-                                                  row_contents,
-                                                  qual_col_names=qual_col_names)
-                    if tokens:
-                        pop_and_check(tokens, ",")
-
-        def get_qualified_column_name(tokens):
-            """
-            Returns comsumes tokens to  generate tuples to create
-            a QualifiedColumnName.
-            """
-            possible_col_name = tokens.pop(0)
-            if tokens and tokens[0] == '.':
-                tokens.pop(0)
-                actual_col_name = tokens.pop(0)
-                table_name = possible_col_name
-                return QualifiedColumnName(actual_col_name, table_name)
-            return QualifiedColumnName(possible_col_name)
-
-        def update(tokens):
-            pop_and_check(tokens, "UPDATE")
-            if(self.begin_transaction == True):
-                self.needs_exclusive = True
-                self.database.add_reserved_lock(self.id_)
-            else:
-                self.database.add_reserved_lock(self.id_)
-                self.database.add_exclusive_lock(self.id_)
-                self.database.release_reserved_lock(self.id_)
-                self.database.release_exclusive_lock(self.id_)
-            table_name = tokens.pop(0)
-            pop_and_check(tokens, "SET")
-            update_clauses = []
-            while tokens:
-                qual_name = get_qualified_column_name(tokens)
-                if not qual_name.table_name:
-                    qual_name.table_name = table_name
-                pop_and_check(tokens, '=')
-                constant = tokens.pop(0)
-                update_clause = UpdateClause(qual_name, constant)
-                update_clauses.append(update_clause)
-                if tokens:
-                    if tokens[0] == ',':
-                        tokens.pop(0)
-                        continue
-                    elif tokens[0] == "WHERE":
-                        break
-
-            where_clause = get_where_clause(tokens, table_name)
-            if self.begin_transaction == True:
-                self.temp_database.update(table_name, update_clauses, where_clause)
-            else:
-                self.database.update(table_name, update_clauses, where_clause)
+            self.execute(prepared, value_set)
+        return Cursor(self, [])
 
-        def delete(tokens):
-            pop_and_check(tokens, "DELETE")
-            if(self.begin_transaction == True):
-                self.needs_exclusive = True
-                self.database.add_reserved_lock(self.id_)
-            else:
-                self.database.add_reserved_lock(self.id_)
-                self.database.add_exclusive_lock(self.id_)
-                self.database.release_reserved_lock(self.id_)
-                self.database.release_exclusive_lock(self.id_)
-            pop_and_check(tokens, "FROM")
-            table_name = tokens.pop(0)
-            where_clause = get_where_clause(tokens, table_name)
-            if self.begin_transaction == True:
-                self.temp_database.delete(table_name, where_clause)
-            else:
-                self.database.delete(table_name, where_clause)
+    def execute(self, statement, parameters=()):
+        """
+        Takes a SQL statement (or a PreparedStatement) and the values for
+        its ? placeholders, in order.
+        Returns a Cursor over the result tuples (empty unless select
+        statement with rows to return).
+        """
+        if self.profile_callback is not None:
+            return self._profiled_execute(statement, parameters)
+        if not isinstance(statement, PreparedStatement):
+            statement = self.prepare(statement)
+        rows, release = self._run(statement, parameters)
+        return Cursor(self, rows, release)
 
-        def get_where_clause(tokens, table_name):
-            if not tokens or tokens[0] != "WHERE":
-                return None
-            tokens.pop(0)
-            qual_col_name = get_qualified_column_name(tokens)
-            if not qual_col_name.table_name:
-                qual_col_name.table_name = table_name
-            operators = {">", "<", "=", "!=", "IS"}
-            found_operator = tokens.pop(0)
-            assert found_operator in operators
-            if tokens[0] == "NOT":
-                tokens.pop(0)
-                found_operator += " NOT"
-            constant = tokens.pop(0)
-            if constant is None:
-                assert found_operator in {"IS", "IS NOT"}
-            if found_operator in {"IS", "IS NOT"}:
-                assert constant is None
-            return WhereClause(qual_col_name, found_operator, constant)
-
-        def select(tokens):
-            """
-            Determines the table name, output_columns, and order_by_columns.
-            """
-            tokens_copy = copy.deepcopy(tokens)
-            def get_from_join_clause(tokens):
-                left_table_name = tokens.pop(0)
-                if tokens[0] != "LEFT":
-                    return FromJoinClause(left_table_name, None, None, None)
-                pop_and_check(tokens, "LEFT")
-                pop_and_check(tokens, "OUTER")
-                pop_and_check(tokens, "JOIN")
-                right_table_name = tokens.pop(0)
-                pop_and_check(tokens, "ON")
-                left_col_name = get_qualified_column_name(tokens)
-                pop_and_check(tokens, "=")
-                right_col_name = get_qualified_column_name(tokens)
-                return FromJoinClause(left_table_name,
-                                      right_table_name,
-                                      left_col_name,
-                                      right_col_name)
-            pop_and_check(tokens, "SELECT")
-            if(self.begin_transaction == True):
-                self.database.add_shared_lock(self.id_)
+    def _run(self, prepared, parameters):
+        """
+        Runs a PreparedStatement. Returns its rows and the function to
+        call once they have been read (None if there is none).
+        """
+        assert len(parameters) == prepared.parameter_count, \
+            "Incorrect number of bindings supplied"
+        if self.trace_callback is not None:
+            self.trace_callback(prepared.sql)
+        runner = getattr(self, STATEMENT_RUNNERS[type(prepared.statement)])
+        try:
+            if (type(prepared.statement) is SelectStatement and
+                    self.database.result_cache is not None):
+                rows = self._cached_select(prepared, parameters)
             else:
-                self.database.add_shared_lock(self.id_)
-                self.database.remove_shared_lock(self.id_)
+                rows = runner(prepared.statement, parameters)
+        except BaseException:
+            self._release_statement_locks()
+            raise
+        if not self.statement_shared:
+            return rows, None
+        self.statement_shared = False
+        database = self.database
+        id_ = self.id_
+        if isinstance(rows, list):
+            database.release_shared_lock(id_)
+            return rows, None
+        return rows, lambda: database.release_shared_lock(id_)
 
-            is_distinct = tokens[0] == "DISTINCT"
-            if is_distinct:
-                tokens.pop(0)
+    def _profiled_execute(self, statement, parameters):
+        """
+        execute, filling in a StatementProfile of the statement as it is
+        prepared and run and as its rows are read.
+        """
+        sql = statement
+        if isinstance(statement, PreparedStatement):
+            sql = statement.sql
+        profile = StatementProfile(sql)
+        outer = getattr(_PROFILING, "profile", None)
+        _PROFILING.profile = profile
+        start = time.perf_counter()
+        try:
+            if not isinstance(statement, PreparedStatement):
+                statement = self.prepare(statement)
+            rows, release = self._run(statement, parameters)
+        finally:
+            _PROFILING.profile = outer
+            profile.elapsed += time.perf_counter() - start
+        database = self.database
+        callback = self.profile_callback
 
-            output_columns = []
-            aggregates = []
-            while True:
-                if tokens[0] == "max" or tokens[0] == "min":
-                    min_or_max = tokens.pop(0)
-                    aggregates.append(min_or_max)
-                    pop_and_check(tokens,"(")
-                    qual_col_name = get_qualified_column_name(tokens)
-                    output_columns.append(qual_col_name)
-                    pop_and_check(tokens,")")
-                else:
-                    qual_col_name = get_qualified_column_name(tokens)
-                    output_columns.append(qual_col_name)
-                    aggregates.append(None)
-                comma_or_from = tokens.pop(0)
-                if comma_or_from == "FROM":
-                    break
-                assert comma_or_from == ','
-            """
-            Select From View
-            """
-            if tokens[0] in self.view_queries and self.view_select == False:
-                view_name = tokens[0]
-                for qual_col in output_columns:
-                    qual_col.table_name = view_name
-                view_query = copy.deepcopy(self.view_queries[view_name])
-                view_query_tokens = copy.deepcopy(self.view_queries[view_name])
-                view_query_result = list(select(view_query))
-                if view_query_result == []:
-                    return []
-                else:
-                    column_name_type_pairs = []
-                    column_names = []
-                    view_query_tokens.pop(0)
-                    is_distinct = tokens[0] == "DISTINCT"
-                    if is_distinct:
-                        tokens.pop(0)
-                    while True:
-                        col = view_query_tokens.pop(0)
-                        if view_query_tokens[0] == '.':
-                            view_query_tokens.pop(0)
-                            col = view_query_tokens.pop(0)
-                        column_names.append(col)
-                        comma_or_from = view_query_tokens.pop(0)
-                        if comma_or_from == "FROM":
-                                break
-                        assert comma_or_from == ','
-                    table_name = view_query_tokens.pop(0)
-                    if column_names[0] == "*":
-                        column_names = self.database.tables[table_name].column_names
-                    row_1 = view_query_result[0]
-                    for i in range(len(row_1)):
-                        if isinstance(row_1[i], str):
-                            column_type = "TEXT"
-                        else:
-                            column_type = "INTEGER"
-                        if isinstance(column_names[i], QualifiedColumnName):
-                            column_name_type_pairs.append((QualifiedColumnName(column_names[i].col_name, view_name),column_type))
-                        else:
-                            column_name_type_pairs.append((QualifiedColumnName(column_names[i], view_name),column_type))
-                    self.database.create_new_table(view_name, column_name_type_pairs, False, {})
-                    for view_query_val in view_query_result:
-                        self.database.insert_into(view_name, list(view_query_val))
-                    self.view_select = True
-                    result = select(tokens_copy)
-                    self.database.delete_table(view_name)
-                    return result
-            else:
-                # FROM or JOIN
-
-                from_join_clause = get_from_join_clause(tokens)
-                table_name = from_join_clause.left_table_name
-                # WHERE
-                where_clause = get_where_clause(tokens, table_name)
-    
-                # ORDER BY
-                pop_and_check(tokens, "ORDER")
-                pop_and_check(tokens, "BY")
-                order_by_columns = []
-                if self.view_select == True:
-                    for output_col in output_columns:
-                        output_col.table_name = table_name
-                    while True:
-                        col_name = tokens.pop(0)
-                        qual_col_name = QualifiedColumnName(col_name,table_name)
-                        collate = None
-                        descend = False
-                        if not tokens:
-                            order_by_columns.append((qual_col_name,collate,descend))
-                            break
-                        if tokens[0] == "COLLATE":
-                            pop_and_check(tokens,"COLLATE")
-                            collate_name = tokens.pop(0)
-                            collate = self.collations[collate_name]
-                        if not tokens:
-                            order_by_columns.append((qual_col_name,collate,descend))
-                            break
-                        if tokens[0] == "DESC":
-                            pop_and_check(tokens,"DESC")
-                            descend = True
-                        order_by_columns.append((qual_col_name,collate,descend))
-                        if not tokens:
-                            break
-                        pop_and_check(tokens, ",")
-                    self.view_select = False
-                else:
-                    while True:
-                        qual_col_name = get_qualified_column_name(tokens)
-                        collate = None
-                        descend = False
-                        if not tokens:
-                            order_by_columns.append((qual_col_name,collate,descend))
-                            break
-                        if tokens[0] == "COLLATE":
-                            pop_and_check(tokens,"COLLATE")
-                            collate_name = tokens.pop(0)
-                            collate = self.collations[collate_name]
-                        if not tokens:
-                            order_by_columns.append((qual_col_name,collate,descend))
-                            break
-                        if tokens[0] == "DESC":
-                            pop_and_check(tokens,"DESC")
-                            descend = True
-                        order_by_columns.append((qual_col_name,collate,descend))
-                        if not tokens:
-                            break
-                        pop_and_check(tokens, ",")
-                if self.begin_transaction == True:
-                    result = self.temp_database.select(
-                    output_columns,
-                    order_by_columns,
-                    from_join_clause=from_join_clause,
-                    where_clause=where_clause,
-                    is_distinct=is_distinct)
-                else:
-                    result = self.database.select(
-                    output_columns,
-                    order_by_columns,
-                    from_join_clause=from_join_clause,
-                    where_clause=where_clause,
-                    is_distinct=is_distinct)
-                if "min" in aggregates or "max" in aggregates:
-                    result_list = list(result)
-                    aggregated_list = []
-                    for i in range(len(aggregates)):
-                        aggr = aggregates[i]
-                        if aggr == "min":
-                            min_val = result_list[0][i]
-                            for row in result_list:
-                                if row[i] < min_val:
-                                    min_val = row[i]
-                            check_for_val = min_val
-                        else:
-                            max_val = result_list[0][i]
-                            for row in result_list:
-                                if row[i] > max_val:
-                                    max_val = row[i]
-                            check_for_val = max_val
-                        aggregated_list.append(check_for_val)
-                    return [tuple(aggregated_list)]
-                else:
-                    return result
-                
-        def drop(tokens):
-            pop_and_check(tokens, "DROP")
-            pop_and_check(tokens, "TABLE")
-            ifexists = False
-            if(tokens[0] == "IF"):
-                pop_and_check(tokens, "IF")
-                pop_and_check(tokens, "EXISTS")
-                ifexists = True
-            table_name = tokens.pop(0)
-            if(self.begin_transaction == True):
-                self.temp_database.drop(table_name, ifexists)
-            else:
-                self.database.drop(table_name, ifexists)
-                
-        def rollback(tokens):
-            assert self.begin_transaction == True
-            pop_and_check(tokens, "ROLLBACK")
-            pop_and_check(tokens, "TRANSACTION")
+        def finish():
+            if release is not None:
+                release()
+            database.count_statement(profile)
+            callback(profile)
+        if isinstance(rows, list):
+            profile.rows_returned = len(rows)
+            finish()
+            return Cursor(self, rows)
+        return Cursor(self, profile.returned(rows), finish)
+
+    def _release_statement_locks(self):
+        """
+        Lets go of the locks a failed statement outside a transaction
+        took.
+        """
+        if self.statement_shared:
+            self.statement_shared = False
+            self.database.release_shared_lock(self.id_)
+        if self.begin_transaction == False:
             self.database.release_exclusive_lock(self.id_)
             self.database.release_reserved_lock(self.id_)
-            self.database.remove_shared_lock(self.id_)
-            self.begin_transaction = False
-            self.needs_exclusive = False
-            self.temp_database = None
-            
-        self.database = _ALL_DATABASES[self.filename]
-
-        tokens = tokenize(statement)
-        last_semicolon = tokens.pop()
-        assert last_semicolon == ";"
 
-        if tokens[0] == "CREATE":
-            create(tokens)
-            return []
-        elif tokens[0] == "INSERT":
-            insert(tokens)
-            return []
-        elif tokens[0] == "UPDATE":
-            update(tokens)
-            return []
-        elif tokens[0] == "DELETE":
-            delete(tokens)
-            return []
-        elif tokens[0] == "SELECT":
-            return select(tokens)
-        elif tokens[0] == "DROP":
-            drop(tokens)
-            return []
-        elif tokens[0] == "ROLLBACK":
-            rollback(tokens)
-            return []
-        elif tokens[0] == "BEGIN":
-            begin(tokens)
+    def _target(self):
+        """
+        Returns the database that statements read and change: the open
+        transaction if there is one.
+        """
+        if self.begin_transaction == True:
+            return self.temp_database
+        return self.database
+
+    def _lock_for_write(self):
+        if(self.begin_transaction == True):
+            self.needs_exclusive = True
+            self.database.add_reserved_lock(self.id_, self.timeout)
+        else:
+            # Held until _log_autocommit has logged the change.
+            self.database.add_reserved_lock(self.id_, self.timeout)
+            self.database.add_exclusive_lock(self.id_, self.timeout)
+
+    def _lock_for_read(self):
+        if(self.begin_transaction == True):
+            self.database.add_shared_lock(self.id_, self.timeout)
+        elif not self.statement_shared:
+            # Held, like sqlite3's, until the statement's cursor has
+            # returned its last row or is closed.
+            self.database.add_shared_lock(self.id_, self.timeout)
+            self.statement_shared = True
+
+    def _begin(self, statement, parameters):
+        if statement.mode == "IMMEDIATE":
+            self.database.add_reserved_lock(self.id_, self.timeout)
+        elif statement.mode == "EXCLUSIVE":
+            self.database.add_exclusive_lock(self.id_, self.timeout)
+        assert self.begin_transaction == False
+        self.begin_transaction = True
+        self.temp_database = Transaction(self.database)
+        return []
+
+    def _commit(self, statement, parameters):
+        assert self.begin_transaction == True
+        if self.needs_exclusive:
+            self.database.add_exclusive_lock(self.id_, self.timeout)
+        profile = current_profile()
+        if profile is not None:
+            started = profile.begin()
+        # The changes go into the log while the locks still order this
+        # commit; waiting for them to reach the disk does not need to.
+        self.temp_database.install()
+        lsn = self.database.write_log(self.temp_database.effects)
+        self.database.commit(self.id_, self.needs_exclusive)
+        self.begin_transaction = False
+        self.temp_database = None
+        self.needs_exclusive = False
+        self.database.sync_log(lsn)
+        if profile is not None:
+            profile.end("log", started)
+        return []
+
+    def _rollback(self, statement, parameters):
+        assert self.begin_transaction == True
+        self.database.release_exclusive_lock(self.id_)
+        self.database.release_reserved_lock(self.id_)
+        self.database.remove_shared_lock(self.id_)
+        self.begin_transaction = False
+        self.needs_exclusive = False
+        self.temp_database = None
+        return []
+
+    def _log_autocommit(self):
+        """
+        Commits a change made outside a transaction to the log.
+        """
+        if self.begin_transaction == False:
+            profile = current_profile()
+            if profile is not None:
+                started = profile.begin()
+            effects = self.database.effects
+            self.database.effects = []
+            lsn = self.database.write_log(effects)
+            self.database.release_exclusive_lock(self.id_)
+            self.database.release_reserved_lock(self.id_)
+            self.database.sync_log(lsn)
+            if profile is not None:
+                profile.end("log", started)
+
+    def _create_table(self, statement, parameters):
+        self._lock_for_write()
+        self._target().create_new_table(statement.table_name,
+                                        statement.column_name_type_pairs,
+                                        statement.notexists,
+                                        statement.default_values)
+        self._log_autocommit()
+        return []
+
+    def _create_index(self, statement, parameters):
+        self._lock_for_write()
+        self._target().create_index(statement.index_name,
+                                    statement.table_name,
+                                    statement.col_name,
+                                    statement.notexists)
+        self._log_autocommit()
+        return []
+
+    def _create_view(self, statement, parameters):
+        if not statement.materialized:
+            self.view_queries[statement.view_name] = statement.select
             return []
-        elif tokens[0] == "COMMIT":
-            commit(tokens)
+        assert statement.view_name not in self.view_queries, \
+            "View already exists: " + statement.view_name
+        for name in statement.select.from_join_clause[:2]:
+            # Plain views belong to one connection; the materialized
+            # view is shared by all of them.
+            assert name not in self.view_queries, \
+                "A materialized view cannot select from view " + name
+        self._lock_for_write()
+        self._target().create_materialized_view(statement.view_name,
+                                                statement.select,
+                                                statement.select_tokens)
+        self._log_autocommit()
+        return []
+
+    def _drop_table(self, statement, parameters):
+        self._lock_for_write()
+        self._target().drop(statement.table_name, statement.ifexists)
+        self._log_autocommit()
+        return []
+
+    def _drop_index(self, statement, parameters):
+        self._lock_for_write()
+        self._target().drop_index(statement.index_name, statement.ifexists)
+        self._log_autocommit()
+        return []
+
+    def _drop_view(self, statement, parameters):
+        if not statement.materialized:
+            assert (statement.ifexists or
+                    statement.view_name in self.view_queries), \
+                "No such view: " + statement.view_name
+            self.view_queries.pop(statement.view_name, None)
             return []
+        self._lock_for_write()
+        self._target().drop_materialized_view(statement.view_name,
+                                              statement.ifexists)
+        self._log_autocommit()
+        return []
+
+    def _insert(self, statement, parameters):
+        self._lock_for_write()
+        database = self._target()
+        if statement.rows is None:
+            database.insert_default_into(statement.table_name)
+        elif len(statement.rows) == 1:
+            database.insert_into(statement.table_name,
+                                 [bind(value, parameters)
+                                  for value in statement.rows[0]],
+                                 qual_col_names=statement.qual_col_names)
         else:
-            raise AssertionError(
-                "Unexpected first word in statements: " + tokens[0])
+            database.insert_many(statement.table_name,
+                                 [[bind(value, parameters)
+                                   for value in row_contents]
+                                  for row_contents in statement.rows],
+                                 qual_col_names=statement.qual_col_names)
+        self._log_autocommit()
+        return []
+
+    def _update(self, statement, parameters):
+        self._lock_for_write()
+        update_clauses = [UpdateClause(update_clause.col_name,
+                                       bind(update_clause.constant, parameters))
+                          for update_clause in statement.update_clauses]
+        self._target().update(statement.table_name, update_clauses,
+                              bind_where(statement.where_clause, parameters),
+                              executor=self.executor)
+        self._log_autocommit()
+        return []
+
+    def _delete(self, statement, parameters):
+        self._lock_for_write()
+        self._target().delete(statement.table_name,
+                              bind_where(statement.where_clause, parameters),
+                              executor=self.executor)
+        self._log_autocommit()
+        return []
+
+    def _select(self, statement, parameters):
+        self._lock_for_read()
+        source = None
+        view_name = statement.from_join_clause.left_table_name
+        if self._is_view(view_name):
+            assert statement.from_join_clause.right_table_name is None
+            source = (self._source_column_names(view_name),
+                      self._view_rows(view_name))
+        return self._target().select(source=source,
+                                     **self._select_arguments(statement,
+                                                              parameters))
+
+    def _cached_select(self, prepared, parameters):
+        """
+        Runs a SELECT through the database's result cache. Only SELECTs
+        outside a transaction that read tables (not views) are cached.
+        """
+        statement = prepared.statement
+        database = self.database
+        names = [name for name in statement.from_join_clause[:2]
+                 if name is not None]
+        if (self.begin_transaction == True or
+                any(name in self.view_queries or name not in database.tables
+                    for name in names)):
+            return self._select(statement, parameters)
+        self._lock_for_read()
+        # A collation registered again under the same name sorts anew.
+        collations = tuple(database.collations.get(collation_name)
+                           for _, collation_name, _
+                           in statement.order_by_columns)
+        key = (prepared.key, tuple(parameters), collations)
+        try:
+            hash(key)
+        except TypeError:
+            # Parameters that cannot be told apart by value.
+            return self._select(statement, parameters)
+        versions = tuple(database.tables[name].version for name in names)
+        cache = database.result_cache
+        rows = cache.get(key, versions)
+        if rows is not None:
+            return rows
+        rows = self._select(statement, parameters)
+        if isinstance(rows, list):
+            cache.put(key, versions, rows)
+            return rows
+        return cache.recording(key, versions, rows)
+
+    def set_result_cache(self, max_rows):
+        """
+        Keeps the results of recent SELECTs on this connection's database
+        in a ResultCache of up to max_rows rows, shared with every other
+        connection to it. 0 turns the cache off.
+        """
+        self.database.result_cache = (ResultCache(max_rows) if max_rows
+                                      else None)
+
+    def _select_arguments(self, statement, parameters):
+        """
+        Returns the keyword arguments of Database.select for statement.
+        """
+        order_by_columns = []
+        for qual_col_name, collation_name, descend in statement.order_by_columns:
+            collate = None
+            if collation_name is not None:
+                collate = self.database.collation(collation_name)
+            order_by_columns.append((qual_col_name, collate, descend))
+        limit = bind(statement.limit, parameters)
+        if limit is not None and limit < 0:
+            # As in sqlite3, a negative LIMIT is no limit at all.
+            limit = None
+        return dict(
+            output_columns=statement.output_columns,
+            order_by_columns=order_by_columns,
+            from_join_clause=statement.from_join_clause,
+            where_clause=bind_where(statement.where_clause, parameters),
+            is_distinct=statement.is_distinct,
+            aggregates=statement.aggregates,
+            group_by_columns=statement.group_by_columns,
+            having_clause=bind_where(statement.having_clause, parameters),
+            limit=limit,
+            offset=max(bind(statement.offset, parameters), 0),
+            executor=self.executor)
+
+    def _is_view(self, name):
+        return name in self.view_queries or name in self._target().views
+
+    def _explain(self, statement, parameters):
+        """
+        Returns the plan of a SELECT, UPDATE or DELETE without running
+        it: its operators with their estimated rows and costs, or for
+        EXPLAIN QUERY PLAN one line per step, as sqlite3 prints them.
+        """
+        self._lock_for_read()
+        explained = statement.statement
+        database = self._target()
+        if type(explained) is SelectStatement:
+            source = None
+            view_name = explained.from_join_clause.left_table_name
+            if self._is_view(view_name):
+                assert explained.from_join_clause.right_table_name is None
+                source = self._source_column_names(view_name)
+            step = database.explain_select(
+                source=source, **self._select_arguments(explained,
+                                                        parameters))
+        else:
+            step = database.explain_change(
+                explained.table_name,
+                bind_where(explained.where_clause, parameters))
+        if statement.query_plan:
+            return query_plan_rows(step)
+        return explain_rows(step)
+
+    def _analyze(self, statement, parameters):
+        self._lock_for_read()
+        self._target().analyze(statement.table_name)
+        return []
+
+    def _copy(self, statement, parameters):
+        columns = None
+        if statement.qual_col_names is not None:
+            columns = [qual_col_name.col_name
+                       for qual_col_name in statement.qual_col_names]
+        self.bulk_load(statement.table_name, bind(statement.path, parameters),
+                       statement.format, columns, statement.header)
+        return []
+
+    def bulk_load(self, table_name, source, format="csv", columns=None,
+                  header=False, null=""):
+        """
+        Appends the records of source, a path, a file or an iterable of
+        lines, to table_name. format is "csv" or "jsonl" (a JSON array or
+        object per line). columns names the columns the values of each
+        record go in (every column, in order, by default); with header
+        the first CSV record names them, and JSON objects name their own.
+        Text is converted to the type of its column as sqlite3 converts
+        it, and in CSV the text null is read as NULL. The records are
+        read, converted and appended in batches of BULK_LOAD_ROWS, without
+        going through SQL. Returns the number of rows loaded.
+        """
+        assert format in {"csv", "jsonl"}, \
+            "Unknown bulk load format: {}".format(format)
+        if isinstance(source, str):
+            with open(source, newline="", encoding="utf-8") as file:
+                return self.bulk_load(table_name, file, format, columns,
+                                      header, null)
+        records = (csv.reader(source) if format == "csv" else
+                   (json_record(line) for line in source if line.strip()))
+        if header:
+            assert format == "csv" and columns is None
+            columns = next(records, None)
+        self._lock_for_write()
+        try:
+            database = self._target()
+            assert table_name in database.tables
+            count = database.bulk_insert(table_name, record_batches(
+                database.tables[table_name], records, columns,
+                null if format == "csv" else None))
+        except BaseException:
+            self._release_statement_locks()
+            raise
+        self._log_autocommit()
+        return count
+
+    def _view_rows(self, view_name):
+        """
+        Returns the rows of a view. A plain view's query becomes part of
+        the outer query's pipeline; a materialized view's cached rows are
+        recomputed first if they are out of date.
+        """
+        if view_name in self.view_queries:
+            return self._select(self.view_queries[view_name], ())
+        database = self._target()
+        view = database.views[view_name]
+        if view.entries is None:
+            view = database.writable_view(view_name)
+            view.refresh(database, lambda: self._select(view.select, ()))
+        return view.rows()
+
+    def _source_column_names(self, name):
+        """
+        Returns the column names of a table or view.
+        """
+        if name in self.view_queries:
+            select = self.view_queries[name]
+        elif name in self._target().views:
+            select = self._target().views[name].select
+        else:
+            return self._target().tables[name].column_names
+        column_names = []
+        for qual_col_name, function in zip(select.output_columns,
+                                           select.aggregates):
+            if function is not None:
+                column_names.append("{}({})".format(function,
+                                                    qual_col_name.col_name))
+            elif qual_col_name.col_name == "*":
+                for source_name in select.from_join_clause[:2]:
+                    if source_name is not None:
+                        column_names.extend(
+                            column_name.col_name for column_name in
+                            self._source_column_names(source_name))
+            else:
+                column_names.append(qual_col_name.col_name)
+        return tuple(QualifiedColumnName(column_name, name)
+                     for column_name in column_names)
 
     def close(self):
         """
-        Empty method that will be used in future projects
+        Rolls back the open transaction, if there is one, lets go of
+        every lock this connection holds and stops profiling it.
+        """
+        self.reset()
+        self.set_profile_callback(None)
+
+    def reset(self):
+        """
+        Rolls back the open transaction, if there is one, and lets go of
+        every lock this connection holds. Cursors left open let go of
+        their locks under the id the connection had, so it takes a new
+        one: they cannot release locks taken from now on.
         """
-        pass
+        if self.begin_transaction == True:
+            self._rollback(None, ())
+        self.database.remove_shared_lock(self.id_)
+        self.database.release_reserved_lock(self.id_)
+        self.database.release_exclusive_lock(self.id_)
+        self.statement_shared = False
+        self.id_ = next(_CONNECTION_IDS)
+
+
+class Cursor(object):
+    """
+    The rows a statement returns, produced on demand. A SELECT's operator
+    pipeline only runs as far as the rows that have been fetched. release,
+    if given, is called once the last row has been fetched or the cursor
+    is closed.
+    """
+
+    arraysize = 1
+
+    def __init__(self, connection, rows, release=None):
+        self.connection = connection
+        self._rows = iter(rows)
+        self._release = release
+
+    def __iter__(self):
+        return self
 
+    def __next__(self):
+        try:
+            return next(self._rows)
+        except StopIteration:
+            self.close()
+            raise
 
-def connect(filename):
+    def fetchone(self):
+        row = next(self._rows, None)
+        if row is None:
+            self.close()
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = list(itertools.islice(self._rows, size))
+        if len(rows) < size:
+            self.close()
+        return rows
+
+    def fetchall(self):
+        rows = list(self._rows)
+        self.close()
+        return rows
+
+    def close(self):
+        self._rows = iter(())
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __del__(self):
+        self.close()
+
+
+def connect(filename, cached_statements=128, timeout=LOCK_TIMEOUT):
     """
     Creates a Connection object with the given filename
     """
-    global _TRANSACTION_CNTR
-    _TRANSACTION_CNTR = _TRANSACTION_CNTR + 1
-    return Connection(filename)
+    return Connection(filename, cached_statements, timeout)
+
+
+class DatabaseRegistry(dict):
+    """
+    The Database open for each filename, shared by every connection to
+    it. open makes or finds one under a lock, so connections made at
+    once on several threads still share it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mutex = threading.Lock()
+
+    def open(self, filename):
+        with self.mutex:
+            database = self.get(filename)
+            if database is None:
+                database = self[filename] = Database(filename)
+            return database
+
+    def close(self, filename):
+        """
+        Closes the Database open for filename, once no connection uses
+        it; the next connection to it opens the file again.
+        """
+        with self.mutex:
+            database = self.pop(filename, None)
+        if database is not None:
+            database.close()
+
+
+_ALL_DATABASES = DatabaseRegistry()
+
+
+class ConnectionPool:
+    """
+    size connections to the database filename, made up front and handed
+    out again and again, so each keeps its prepared statements from one
+    use to the next. Plain views created through any of them are seen
+    by all of them; collations are the database's already. A connection
+    given back is reset (see Connection.reset). acquire waits up to
+    timeout seconds (None for as long as it takes) for one to be given
+    back while they are all out.
+    """
+
+    def __init__(self, filename, size=5, cached_statements=128,
+                 timeout=LOCK_TIMEOUT):
+        assert size >= 1
+        self.filename = filename
+        self.size = size
+        self.views = {}
+        self.connections = []
+        self.lent = set()
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            connection = Connection(filename, cached_statements, timeout)
+            connection.view_queries = self.views
+            self.connections.append(connection)
+            self.idle.put(connection)
+
+    def acquire(self, timeout=None):
+        try:
+            connection = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception("no connection free in the pool") from None
+        self.lent.add(id(connection))
+        return connection
+
+    def release(self, connection):
+        assert id(connection) in self.lent, \
+            "The connection is not out of this pool"
+        self.lent.discard(id(connection))
+        try:
+            connection.reset()
+        finally:
+            self.idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Hands out a connection for the with block, taking it back after.
+        """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        """
+        Closes every connection, given back or not, once the pool is no
+        longer used.
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+def shared_executor(workers, processes=False):
+    """
+    Returns the pool of workers threads, or processes, shared by every
+    connection that asks for the same one.
+    """
+    key = (workers, processes)
+    with _EXECUTORS_LOCK:
+        if key not in _EXECUTORS:
+            if processes:
+                executor = concurrent.futures.ProcessPoolExecutor(workers)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    workers, thread_name_prefix="morsel")
+            _EXECUTORS[key] = executor
+        return _EXECUTORS[key]
 
 
 class QualifiedColumnName:
+    """
+    A column name, qualified by its table's name or not (None). Names are
+    not changed once made: key, the interned (col_name, table_name) pair,
+    and its hash are worked out up front, as names are looked up far
+    more often than they are made.
+    """
+    __slots__ = ("col_name", "table_name", "key", "_hash")
 
     def __init__(self, col_name, table_name=None):
+        if type(col_name) is str:
+            col_name = sys.intern(col_name)
+        if type(table_name) is str:
+            table_name = sys.intern(table_name)
         self.col_name = col_name
         self.table_name = table_name
+        self.key = (col_name, table_name)
+        self._hash = hash(self.key)
 
     def __str__(self):
         return "QualifiedName({}.{})".format(
             self.table_name, self.col_name)
 
     def __eq__(self, other):
-        same_col = self.col_name == other.col_name
-        if not same_col:
-            return False
-        both_have_tables = (self.table_name is not None and
-                            other.col_name is not None)
-        if not both_have_tables:
-            return True
-        return self.table_name == other.table_name
+        if not isinstance(other, QualifiedColumnName):
+            return NotImplemented
+        return self.key == other.key
 
-    def __ne__(self, other):
-        return not (self == other)
+    def matches(self, other):
+        """
+        True if the two name the same column, taking a name without a
+        table to match that column of any table.
+        """
+        return self.col_name == other.col_name and (
+            self.table_name is None or other.table_name is None or
+            self.table_name == other.table_name)
 
     def __hash__(self):
-        return hash((self.col_name, self.table_name))
+        return self._hash
 
     def __repr__(self):
         return str(self)
@@ -576,381 +970,4603 @@ class Database:
 
     def __init__(self, filename):
         self.filename = filename
+        self.path = None if filename == ":memory:" else filename
         self.tables = {}
-        self.shared_locks = set([])
-        self.exclusive_lock = None
-        self.reserved_lock = None
-        
-    def add_reserved_lock(self, id_):
-        if self.reserved_lock == None and self.exclusive_lock == None:
-            self.reserved_lock = id_
-        elif self.reserved_lock == id_:
-            pass
-        elif self.exclusive_lock == id_:
-            pass
-        else:
-            raise Exception()
+        self.views = {}
+        self.logged = self.path is not None
+        self.effects = []
+        self.wal = None
+        self.checkpointer = None
+        self.mapping = None
+        self.mapped_columns = weakref.WeakSet()
+        self.locks = LockManager()
+        self.result_cache = None
+        self.collations = {}
+        self.totals = {"statements": 0, "elapsed": 0.0, "rows_examined": 0,
+                       "rows_returned": 0, "lock_wait": 0.0, "phases": {}}
+        self.totals_mutex = threading.Lock()
+        if self.path is not None:
+            self.open_file()
+
+    def open_file(self):
+        """
+        Loads the database file, if there is one, and replays the log
+        segments written since its last checkpoint. A torn record at the
+        end of the log (from a crash mid-write) is cut off.
+        """
+        checkpoint_generation = 0
+        if os.path.isfile(self.path) and os.path.getsize(self.path):
+            self.tables, view_tokens, checkpoint_generation, \
+                self.mapping = read_database(self.path)
+            for table in self.tables.values():
+                self.mapped_columns.update(table.columns)
+            for view_name, encoded in view_tokens.items():
+                select_tokens = decode_tokens(encoded)
+                self.views[view_name] = MaterializedView(
+                    view_name, parse_select(deque(select_tokens)),
+                    select_tokens)
+        old_generation = checkpoint_generation
+        while os.path.exists(wal_path(self.path, old_generation)):
+            # Already in the database file; left by an interrupted
+            # checkpoint.
+            os.remove(wal_path(self.path, old_generation))
+            old_generation -= 1
+        generation = checkpoint_generation + 1
+        while True:
+            records, end = read_log(wal_path(self.path, generation))
+            for effects in records:
+                for effect in effects:
+                    self.replay(effect)
+            if not os.path.exists(wal_path(self.path, generation + 1)):
+                break
+            generation += 1
+        if os.path.exists(wal_path(self.path, generation)):
+            os.truncate(wal_path(self.path, generation), end)
+        self.wal = WriteAheadLog(self.path, generation)
         
+    def add_reserved_lock(self, id_, timeout=LOCK_TIMEOUT):
+        self.locks.add_reserved(id_, timeout)
+
     def release_reserved_lock(self, id_):
-        if(self.reserved_lock == id_):
-            self.reserved_lock = None
-    
-    def add_shared_lock(self, id_):
-        if self.exclusive_lock == id_:
-            pass
-        elif self.exclusive_lock != None:
-            raise Exception()
-        self.shared_locks.add(id_)
-    
+        self.locks.release_reserved(id_)
+
+    def add_shared_lock(self, id_, timeout=LOCK_TIMEOUT):
+        self.locks.add_shared(id_, timeout)
+
+    def release_shared_lock(self, id_):
+        self.locks.release_shared(id_)
+
     def remove_shared_lock(self, id_):
-        if id_ in self.shared_locks:
-            self.shared_locks.remove(id_)
-        
+        self.locks.remove_shared(id_)
+
     def release_exclusive_lock(self, id_):
-        if(self.exclusive_lock == id_):
-            self.exclusive_lock = None
-        
-    def add_exclusive_lock(self, id_):
-        if self.exclusive_lock != None and self.exclusive_lock != id_:
-            raise Exception()
-        if self.reserved_lock != None and self.reserved_lock != id_:
-            raise Exception()
-        if len(self.shared_locks) == 0 or (len(self.shared_locks) == 1 and id_ in self.shared_locks):
-            self.exclusive_lock = id_
-        else:
-            raise Exception()
-        
-    def commit(self, id_, needs_exclusive):
+        self.locks.release_exclusive(id_)
+
+    def add_exclusive_lock(self, id_, timeout=LOCK_TIMEOUT):
+        self.locks.add_exclusive(id_, timeout)
+
+    def record(self, effect):
+        """
+        Notes a change to the tables, to be logged when it commits.
+        """
+        if self.logged:
+            self.effects.append(effect)
+
+    def write_log(self, effects):
+        """
+        Appends effects to the log as one committed transaction and
+        returns its log sequence number for sync_log, or None if nothing
+        was written.
+        """
+        if self.wal is None or not effects:
+            return None
+        lsn = self.wal.write(effects)
+        if self.wal.size > WAL_CHECKPOINT_SIZE:
+            self.checkpoint()
+        return lsn
+
+    def sync_log(self, lsn):
+        if lsn is not None:
+            self.wal.sync(lsn)
+
+    def checkpoint(self):
+        """
+        Starts writing the tables into the database file on a background
+        thread, unless one is already running, and returns that thread.
+        Commits from now on go to a new log segment; the old segments are
+        removed once the file is in place. The tables are only frozen
+        here; their rows are copied on the background thread.
+        """
+        if self.checkpointer is not None and self.checkpointer.is_alive():
+            return self.checkpointer
+        tables = {table_name: table.snapshot()
+                  for table_name, table in self.tables.items()}
+        view_tokens = {view_name: encode_tokens(view.tokens)
+                       for view_name, view in self.views.items()}
+        generation = self.wal.rotate()
+        self.checkpointer = threading.Thread(
+            target=self._write_checkpoint,
+            args=(tables, view_tokens, generation), daemon=True)
+        self.checkpointer.start()
+        return self.checkpointer
+
+    def _write_checkpoint(self, tables, view_tokens, generation):
+        for table in tables.values():
+            for column in table.columns:
+                column.unfreeze(table.row_count)
+        new_path = self.path + "-new"
+        catalog = write_database(tables, view_tokens, new_path, generation)
+        self.replace_file(tables, catalog, new_path)
+        while os.path.exists(wal_path(self.path, generation)):
+            os.remove(wal_path(self.path, generation))
+            generation -= 1
+
+    def replace_file(self, tables, catalog, new_path):
+        """
+        Renames the file a checkpoint wrote (tables, as written, and its
+        catalog) over the database file. Columns never read so far are
+        moved to their copy in the new file, and the old file's mapping
+        is closed first, so it is never mapped while it is replaced.
+        Columns still in the old file but not among tables (those of
+        tables dropped since) are read before it goes.
+        """
+        moved = {}
+        for entry in catalog["tables"]:
+            for column, written in zip(tables[entry["name"]].columns,
+                                       entry["columns"]):
+                if column.source is not None:
+                    moved[id(column.source)] = written
+        with _LOAD_LOCK:
+            columns = [column for column in self.mapped_columns
+                       if column.source is not None]
+            for column in columns:
+                if id(column.source) not in moved:
+                    column.values  # Reads it in.
+            if self.mapping is not None:
+                self.mapping.close()
+            os.replace(new_path, self.path)
+            self.mapping = None
+            self.mapped_columns = weakref.WeakSet()
+            columns = [column for column in columns
+                       if column.source is not None]
+            if not columns:
+                return
+            with open(self.path, "rb") as file:
+                self.mapping = mmap.mmap(file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            for column in columns:
+                written = moved[id(column.source)]
+                column.source = MappedColumn(self.mapping,
+                                             written["encoding"],
+                                             written["extents"])
+                self.mapped_columns.add(column)
+
+    def close(self):
+        """
+        Waits for a running checkpoint, then closes the log and the
+        mapped database file. The database is not used afterwards.
+        """
+        if self.checkpointer is not None:
+            self.checkpointer.join()
+        if self.wal is not None:
+            self.wal.close()
+        with _LOAD_LOCK:
+            if self.mapping is not None:
+                self.mapping.close()
+                self.mapping = None
+
+    def replay(self, effect):
+        """
+        Applies one logged effect (see record) to the tables.
+        """
+        kind, table_name = effect[0], effect[1]
+        if kind == "create_table":
+            self.tables[table_name] = new_table(table_name, effect[2],
+                                                effect[3])
+        elif kind == "drop_table":
+            del self.tables[table_name]
+        elif kind == "create_view":
+            select_tokens = decode_tokens(effect[2])
+            self.views[table_name] = MaterializedView(
+                table_name, parse_select(deque(select_tokens)), select_tokens)
+        elif kind == "drop_view":
+            del self.views[table_name]
+        elif kind == "create_index":
+            table = self.tables[table_name]
+            table.create_index(effect[2], table.column_names[effect[3]])
+        elif kind == "drop_index":
+            self.tables[table_name].drop_index(effect[2])
+        elif kind == "insert":
+            self.tables[table_name].append_columns(list(zip(*effect[2])))
+        elif kind == "update":
+            table = self.tables[table_name]
+            row_ids = effect[3]
+            if row_ids is None:
+                row_ids = range(table.row_count)
+            table.update_rows(row_ids, effect[2])
+        else:
+            assert kind == "delete"
+            self.tables[table_name].delete_rows(effect[2])
+
+    def commit(self, id_, needs_exclusive, timeout=LOCK_TIMEOUT):
         if needs_exclusive:
-            self.add_exclusive_lock(id_)
+            self.add_exclusive_lock(id_, timeout)
         self.release_exclusive_lock(id_)
         self.remove_shared_lock(id_)
         self.release_reserved_lock(id_)
 
     def create_new_table(self, table_name, column_name_type_pairs, notexists, default_values):
+        if table_name in self.views:
+            assert notexists, "View already exists: " + table_name
+            return []
         if notexists:
             if(table_name not in self.tables):
                 self.tables[table_name] = Table(table_name, column_name_type_pairs)
                 self.tables[table_name].set_default(default_values)
+            else:
+                return []
         else:
             assert table_name not in self.tables
             self.tables[table_name] = Table(table_name, column_name_type_pairs)
             self.tables[table_name].set_default(default_values)
+        table = self.tables[table_name]
+        self.record(["create_table", table_name] + table.schema())
         return []
         
-    def delete_table(self, table_name):
-        del self.tables[table_name]
+    def writable_table(self, table_name):
+        """
+        Returns the table to apply a change to.
+        """
+        assert table_name in self.tables
+        return self.tables[table_name]
 
     def insert_into(self, table_name, row_contents, qual_col_names=None):
-        assert table_name in self.tables
-        table = self.tables[table_name]
+        table = self.writable_table(table_name)
         table.insert_new_row(row_contents, qual_col_names=qual_col_names)
+        self._record_insert(table)
         return []
         
+    def insert_many(self, table_name, rows, qual_col_names=None):
+        """
+        Inserts rows (see Table.insert_many) as one block.
+        """
+        table = self.writable_table(table_name)
+        start = table.row_count
+        table.insert_many(rows, qual_col_names)
+        if table.row_count == start:
+            return []
+        self.maintain_views(table_name, "insert",
+                            range(start, table.row_count))
+        if self.logged:
+            self.effects.append(["insert", table_name,
+                                 table.rows_between(start, table.row_count)])
+        return []
+
     def insert_default_into(self, table_name):
-        assert table_name in self.tables
-        table = self.tables[table_name]
+        table = self.writable_table(table_name)
         table.insert_new_default_row()
+        self._record_insert(table)
         return []
 
-    def update(self, table_name, update_clauses, where_clause):
-        assert table_name in self.tables
-        table = self.tables[table_name]
-        table.update(update_clauses, where_clause)
-
-    def delete(self, table_name, where_clause):
-        assert table_name in self.tables
-        table = self.tables[table_name]
-        table.delete(where_clause)
+    def bulk_insert(self, table_name, batches):
+        """
+        Appends each of batches, a list of the values of every column of
+        table_name, as one block. If a batch fails none of them are kept.
+        Returns the number of rows appended.
+        """
+        table = self.writable_table(table_name)
+        first_row = table.row_count
+        first_effect = len(self.effects)
+        try:
+            for columns in batches:
+                start = table.row_count
+                table.append_columns(columns)
+                self.maintain_views(table_name, "insert",
+                                    range(start, table.row_count))
+                if self.logged:
+                    self.effects.append(["insert", table_name,
+                                         list(zip(*columns))])
+        except BaseException:
+            row_ids = range(first_row, table.row_count)
+            table.delete_rows(row_ids)
+            self.maintain_views(table_name, "delete", row_ids)
+            del self.effects[first_effect:]
+            raise
+        return table.row_count - first_row
+
+    def _record_insert(self, table):
+        self.maintain_views(table.name, "insert")
+        if not self.logged:
+            return
+        row = table.row(table.row_count - 1)
+        last = self.effects[-1] if self.effects else None
+        if last and last[0] == "insert" and last[1] == table.name:
+            last[2].append(row)
+        else:
+            self.effects.append(["insert", table.name, [row]])
+
+    def update(self, table_name, update_clauses, where_clause,
+               executor=None):
+        table = self.writable_table(table_name)
+        row_ids = table.update(update_clauses, where_clause, executor)
+        self.maintain_views(table_name, "update", row_ids)
+        if row_ids:
+            assignments = [[table.column_position(update_clause.col_name),
+                            update_clause.constant]
+                           for update_clause in update_clauses]
+            if isinstance(row_ids, range):
+                row_ids = None
+            self.record(["update", table_name, assignments, row_ids])
+
+    def delete(self, table_name, where_clause, executor=None):
+        table = self.writable_table(table_name)
+        row_ids = table.delete(where_clause, executor)
+        self.maintain_views(table_name, "delete", row_ids)
+        if row_ids is None or row_ids:
+            self.record(["delete", table_name, row_ids])
         
     def drop(self, table_name, ifexists):
         if ifexists:
-            if table_name in self.tables:
-                del self.tables[table_name]
+            if table_name not in self.tables:
+                return
         else:
             assert table_name in self.tables
-            del self.tables[table_name]
+        for view in self.views.values():
+            assert table_name not in view.table_names, \
+                "Materialized view {} depends on table {}".format(
+                    view.name, table_name)
+        del self.tables[table_name]
+        self.record(["drop_table", table_name])
+
+    def create_materialized_view(self, view_name, select, select_tokens):
+        assert view_name not in self.views and view_name not in self.tables, \
+            "Table or view already exists: " + view_name
+        view = MaterializedView(view_name, select, select_tokens)
+        for table_name in view.table_names:
+            assert table_name in self.tables, "No such table: " + table_name
+        self.views[view_name] = view
+        self.record(["create_view", view_name, encode_tokens(select_tokens)])
+
+    def drop_materialized_view(self, view_name, ifexists):
+        if ifexists and view_name not in self.views:
+            return
+        assert view_name in self.views, "No such view: " + view_name
+        del self.views[view_name]
+        self.record(["drop_view", view_name])
+
+    def writable_view(self, view_name):
+        """
+        Returns the materialized view to apply a change to.
+        """
+        return self.views[view_name]
+
+    def maintain_views(self, table_name, change, row_ids=None):
+        """
+        Brings the materialized views over table_name up to date with a
+        change to it (see MaterializedView.apply).
+        """
+        if not self.views:
+            return
+        for view_name in [view_name for view_name, view in self.views.items()
+                          if table_name in view.table_names]:
+            self.writable_view(view_name).apply(self.tables[table_name],
+                                                change, row_ids)
+
+    def find_index(self, index_name):
+        for table in self.tables.values():
+            if index_name in table.index_names():
+                return table
+        return None
+
+    def create_index(self, index_name, table_name, qual_col_name, notexists):
+        if notexists and self.find_index(index_name):
+            return
+        assert self.find_index(index_name) is None
+        table = self.writable_table(table_name)
+        table.create_index(index_name, qual_col_name)
+        self.record(["create_index", table_name, index_name,
+                     table.column_position(qual_col_name)])
+
+    def drop_index(self, index_name, ifexists):
+        table = self.find_index(index_name)
+        if ifexists and table is None:
+            return
+        assert table is not None
+        self.writable_table(table.name).drop_index(index_name)
+        self.record(["drop_index", table.name, index_name])
 
     def select(self, output_columns, order_by_columns,
                from_join_clause,
-               where_clause=None, is_distinct=False):
+               where_clause=None, is_distinct=False, join_strategy=None,
+               aggregates=None, group_by_columns=(), having_clause=None,
+               limit=None, offset=0, source=None, executor=None):
+        """
+        source, if given, is the (column names, rows) of a view to select
+        from in place of the FROM table. executor, if given, runs the
+        full scans of large tables in parallel (see parallel_select).
+        """
+        aggregated = bool(group_by_columns or (aggregates and any(aggregates)))
+        if source is None:
+            plan = self.plan_source(
+                from_join_clause, where_clause, join_strategy,
+                referenced_columns(output_columns, aggregates, where_clause,
+                                   group_by_columns, having_clause,
+                                   order_by_columns))
+            if (executor is not None and type(plan) is AccessPath and
+                    plan.index_name is None and
+                    self.tables[plan.table_name].row_count > MORSEL_ROWS and
+                    (aggregated or order_by_columns or
+                     (plan.residual and limit is None))):
+                return self.parallel_select(
+                    plan, executor, output_columns, order_by_columns,
+                    is_distinct, aggregates, group_by_columns,
+                    having_clause, limit, offset)
+            column_names, rows = self.run_source(plan, executor)
+        else:
+            column_names, rows = source
+            if where_clause:
+                rows = filter(compile_predicate(where_clause, column_names),
+                              rows)
+        if aggregated:
+            return aggregate_rows(column_names, rows, output_columns,
+                                  aggregates, group_by_columns,
+                                  having_clause, order_by_columns,
+                                  is_distinct, limit, offset)
+        return project_rows(column_names, rows, output_columns,
+                            order_by_columns, is_distinct, limit, offset)
+
+    def parallel_select(self, plan, executor, output_columns,
+                        order_by_columns, is_distinct, aggregates,
+                        group_by_columns, having_clause, limit, offset):
+        """
+        Runs a SELECT over a full scan (plan) morsel by morsel on executor.
+        Each morsel is filtered, then either aggregated into partial
+        groups or sorted (only its first offset + limit rows kept), and
+        the morsels' results are merged here, in table order: groups are
+        combined, and the sorted runs are merged by the final sort, which
+        finds them already in order. Ties come out as from one scan.
+        """
+        table = self.tables[plan.table_name]
+        column_names = table.column_names_at(plan.positions)
+        profile = current_profile()
+        if profile is not None:
+            # The workers' time is charged to the scan that waits for them.
+            profile.rows_examined += table.row_count
+            started = profile.begin()
+        if group_by_columns or (aggregates and any(aggregates)):
+            aggregate = plan_aggregate(column_names, output_columns,
+                                       aggregates, group_by_columns,
+                                       having_clause, order_by_columns)
+            partial_groups = table.morsels(
+                executor, plan.positions, scan_morsel, column_names,
+                plan.residual, None, None,
+                (aggregate.items, aggregate.group_positions))
+            if profile is not None:
+                profile.end("scan", started)
+            return aggregate_rows(column_names, None, output_columns,
+                                  aggregates, group_by_columns,
+                                  having_clause, order_by_columns,
+                                  is_distinct, limit, offset,
+                                  partial_groups=partial_groups)
+        sort_keys = [(find_column(column_names, qual_col_name), collate,
+                      descend)
+                     for qual_col_name, collate, descend in order_by_columns]
+        if (isinstance(executor, concurrent.futures.ProcessPoolExecutor) and
+                any(collate is not None for _, collate, _ in sort_keys)):
+            # Collation functions need not survive pickling; sort here.
+            sort_keys = []
+        stop = None
+        if limit is not None and not is_distinct:
+            stop = offset + limit
+        runs = table.morsels(executor, plan.positions, scan_morsel,
+                             column_names, plan.residual, sort_keys, stop,
+                             None)
+        if profile is not None:
+            profile.end("scan", started)
+        return project_rows(column_names, itertools.chain.from_iterable(runs),
+                            output_columns, order_by_columns, is_distinct,
+                            limit, offset)
+
+    def explain_select(self, output_columns, order_by_columns,
+                       from_join_clause,
+                       where_clause=None, is_distinct=False,
+                       join_strategy=None, aggregates=None,
+                       group_by_columns=(), having_clause=None,
+                       limit=None, offset=0, source=None, executor=None):
+        """
+        Returns the PlanStep tree of the operators select would run,
+        without running them. source, if given, is the column names of
+        the view selected from.
+        """
+        if source is None:
+            plan = self.plan_source(
+                from_join_clause, where_clause, join_strategy,
+                referenced_columns(output_columns, aggregates, where_clause,
+                                   group_by_columns, having_clause,
+                                   order_by_columns))
+            step = describe_source(plan, self.tables)
+        else:
+            step = PlanStep("SCAN", from_join_clause.left_table_name,
+                            ", ".join(column_name.col_name
+                                      for column_name in source),
+                            None, None, ())
+            if where_clause:
+                step = PlanStep("FILTER", describe_condition(where_clause),
+                                "", None, None, (step,))
+        rows, cost = step.rows, step.cost
+        known = rows is not None
+        if group_by_columns or (aggregates and any(aggregates)):
+            detail = ""
+            if group_by_columns:
+                detail = "GROUP BY " + ", ".join(
+                    sql_name(qual_col_name)
+                    for qual_col_name in group_by_columns)
+            if known:
+                cost += rows
+                rows = max(1.0, rows / 10) if group_by_columns else 1.0
+            step = PlanStep("AGGREGATE", detail, "", rows, cost, (step,))
+            if having_clause:
+                step = PlanStep("FILTER", "HAVING", "", rows, cost, (step,))
+        stop = None if limit is None else offset + limit
+        # As in finish_rows, DISTINCT goes first if only output columns
+        # are sorted on.
+        distinct_first = is_distinct and all(
+            any(column.col_name == "*" or column.matches(qual_col_name)
+                for column in output_columns)
+            for qual_col_name, _, _ in order_by_columns)
+        if distinct_first:
+            if known:
+                cost += rows
+            step = PlanStep("DISTINCT", "", "", rows, cost, (step,))
+        if order_by_columns:
+            operator = "SORT"
+            if stop is not None and (distinct_first or not is_distinct):
+                operator = "TOP-K SORT"
+            if known:
+                cost += rows * math.log2(rows + 1)
+            step = PlanStep(operator, ", ".join(
+                sql_name(qual_col_name) + (" DESC" if descend else "")
+                for qual_col_name, _, descend in order_by_columns),
+                "", rows, cost, (step,))
+        if is_distinct and not distinct_first:
+            if known:
+                cost += rows
+            step = PlanStep("DISTINCT", "", "", rows, cost, (step,))
+        if offset or stop is not None:
+            if known and stop is not None:
+                rows = min(rows, float(limit))
+            step = PlanStep("LIMIT", "{} OFFSET {}".format(limit, offset),
+                            "", rows, cost, (step,))
+        return step
+
+    def plan_source(self, from_join_clause, where_clause=None,
+                    join_strategy=None, columns=None):
+        """
+        Plans how to read the rows (matching where_clause) of the FROM
+        table or LEFT OUTER JOIN: an AccessPath or a JoinPlan that only
+        reads the given columns (None for all of them).
+        """
         assert from_join_clause.left_table_name in self.tables
-        if from_join_clause.right_table_name:
-            assert from_join_clause.right_table_name in self.tables
-            left_table = self.tables[from_join_clause.left_table_name]
-            right_table = self.tables[from_join_clause.right_table_name]
-            all_columns = itertools.chain(
-                zip(left_table.column_names, left_table.column_types),
-                zip(right_table.column_names, right_table.column_types))
-            left_col = from_join_clause.left_join_col_name
-            right_col = from_join_clause.right_join_col_name
-            join_table = Table("", all_columns)
-            combined_rows = []
-            for left_row in left_table.rows:
-                left_value = left_row[left_col]
-                found_match = False
-                for right_row in right_table.rows:
-                    right_value = right_row[right_col]
-                    if left_value is None:
-                        break
-                    if right_value is None:
-                        continue
-                    if left_row[left_col] == right_row[right_col]:
-                        new_row = dict(left_row)
-                        new_row.update(right_row)
-                        combined_rows.append(new_row)
-                        found_match = True
-                        continue
-                if left_value is None or not found_match:
-                    new_row = dict(left_row)
-                    new_row.update(zip(right_row.keys(),
-                                       itertools.repeat(None)))
-                    combined_rows.append(new_row)
-
-            join_table.rows = combined_rows
-            table = join_table
-        else:
-            table = self.tables[from_join_clause.left_table_name]
-        return table.select_rows(output_columns, order_by_columns,
-                                 where_clause=where_clause,
-                                 is_distinct=is_distinct)
+        left_table = self.tables[from_join_clause.left_table_name]
+        if not from_join_clause.right_table_name:
+            return left_table.access_path(where_clause,
+                                          left_table.positions_of(columns))
 
+        assert from_join_clause.right_table_name in self.tables
+        right_table = self.tables[from_join_clause.right_table_name]
+        left_pos, right_pos = resolve_join_columns(
+            left_table, right_table,
+            from_join_clause.left_join_col_name,
+            from_join_clause.right_join_col_name)
+        left_positions = right_positions = None
+        if columns is not None:
+            column_names = left_table.column_names + right_table.column_names
+            width = len(left_table.column_names)
+            positions = {find_column(column_names, qual_col_name)
+                         for qual_col_name in columns}
+            left_positions = sorted({position for position in positions
+                                     if position < width} | {left_pos})
+            right_positions = sorted({position - width
+                                      for position in positions
+                                      if position >= width} | {right_pos})
+            if len(left_positions) == width:
+                left_positions = None
+            if len(right_positions) == len(right_table.column_names):
+                right_positions = None
+        # Conditions on the left table alone are checked, through its
+        # indexes, before joining. The LEFT OUTER JOIN keeps every left
+        # row, so nothing can be pushed into the right table and the
+        # tables cannot trade places.
+        left_conditions = []
+        other_conditions = []
+        for condition in conjuncts(where_clause):
+            if all(column.table_name == left_table.name
+                   for column in expression_columns(condition)):
+                left_conditions.append(condition)
+            else:
+                other_conditions.append(condition)
+        left = left_table.access_path(conjunction(left_conditions),
+                                      left_positions)
+        right = right_table.access_path(None, right_positions)
+        if join_strategy is None:
+            # Merging needs no hash table, but only inputs already in
+            # join key order can be merged.
+            join_strategy = "hash"
+            if (left_table.column_sorted(left_pos) and
+                    right_table.column_sorted(right_pos)):
+                join_strategy = "merge"
+        residual = conjunction(other_conditions)
+        rows = (left.rows * max(1.0, right_table.rows_per_value(right_pos)) *
+                estimate_selectivity(residual))
+        cost = left.cost + right.cost + (left.rows + right.rows) * JOIN_ROW_COST
+        return JoinPlan(join_strategy, left, right, left_pos, right_pos,
+                        residual, rows, cost)
 
-class Table:
+    def run_source(self, plan, executor=None):
+        """
+        Returns the column names and rows of a plan from plan_source.
+        executor, if given, filters the left table of a join in parallel.
+        """
+        if type(plan) is AccessPath:
+            return self.tables[plan.table_name].read(plan)
+        left_table = self.tables[plan.left.table_name]
+        right_table = self.tables[plan.right.table_name]
+        profile = current_profile()
+        if profile is not None:
+            started = profile.begin()
+        left_row_ids = left_table.path_row_ids(plan.left, executor)
+        if profile is not None:
+            profile.end("scan", started)
+        left_keys = left_table.columns[plan.left_position]
+        if left_row_ids is not None:
+            left_keys = left_keys.take(left_row_ids)
+        right_keys = right_table.columns[plan.right_position]
+        column_names = (left_table.column_names_at(plan.left.positions) +
+                        right_table.column_names_at(plan.right.positions))
+        join = JOIN_STRATEGIES[plan.strategy]
+        left_rows = left_table.scan(left_row_ids, plan.left.positions)
+        right_rows = right_table.scan(None, plan.right.positions)
+        if profile is not None:
+            # The left rows were examined finding left_row_ids.
+            left_rows = profile.timed(left_rows, "scan")
+            right_rows = profile.timed(right_rows, "scan", examined=True)
+        rows = join(left_rows, left_keys, right_rows, right_keys,
+                    len(plan.right.positions
+                        if plan.right.positions is not None
+                        else right_table.column_names))
+        if plan.residual:
+            rows = filter(compile_predicate(plan.residual, column_names),
+                          rows)
+        if profile is not None:
+            rows = profile.timed(rows, "join")
+        return column_names, rows
 
-    def __init__(self, name, column_name_type_pairs):
-        self.name = name
-        self.column_name_type_pairs = column_name_type_pairs
-        self.column_names, self.column_types = zip(*column_name_type_pairs)
-        self.rows = []
-        self.default_values = {}
+    def explain_change(self, table_name, where_clause):
+        """
+        Returns the PlanStep of how an UPDATE or DELETE finds its rows.
+        """
+        assert table_name in self.tables
+        return describe_source(
+            self.tables[table_name].access_path(where_clause), self.tables)
 
-    def insert_new_row(self, row_contents, qual_col_names=None):
-        if not qual_col_names:
-            qual_col_names = self.column_names
-        assert len(qual_col_names) == len(row_contents)
-        row = dict(zip(qual_col_names, row_contents))
-        for null_default_col in set(self.column_names) - set(qual_col_names):
-            if null_default_col in self.default_values:
-                row[null_default_col] = self.default_values[null_default_col]
+    def analyze(self, table_name=None):
+        if table_name is None:
+            for table in self.tables.values():
+                table.analyze()
+            return
+        assert table_name in self.tables, "No such table: " + table_name
+        self.tables[table_name].analyze()
+
+    def create_collation(self, collation_name, compare, key=None):
+        """
+        Registers a Collation under collation_name, or removes it if
+        neither compare nor key is given.
+        """
+        if compare is None and key is None:
+            self.collations.pop(collation_name, None)
+            return
+        self.collations[collation_name] = Collation(collation_name, compare,
+                                                    key)
+
+    def collation(self, collation_name):
+        assert collation_name in self.collations, \
+            "no such collation sequence: " + collation_name
+        return self.collations[collation_name]
+
+    def count_statement(self, profile):
+        """
+        Adds a finished statement's StatementProfile to the totals of
+        every profiled statement run on this database.
+        """
+        with self.totals_mutex:
+            totals = self.totals
+            totals["statements"] += 1
+            totals["elapsed"] += profile.elapsed
+            totals["rows_examined"] += profile.rows_examined
+            totals["rows_returned"] += profile.rows_returned
+            totals["lock_wait"] += profile.lock_wait
+            phases = totals["phases"]
+            for phase, seconds in profile.phases.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def counters(self):
+        """
+        Returns the totals of the statements profiled so far (see
+        Connection.set_profile_callback).
+        """
+        with self.totals_mutex:
+            return dict(self.totals, phases=dict(self.totals["phases"]))
+
+
+class LockManager:
+    """
+    The SHARED, RESERVED and EXCLUSIVE locks on a Database, held by
+    connection ids as in sqlite3. Any number of connections read under
+    SHARED, alongside at most one writer preparing its changes under
+    RESERVED; EXCLUSIVE, to install them, needs every other SHARED lock
+    released. A conflicting request waits until the holders let go or
+    its timeout runs out, and while a writer waits for EXCLUSIVE new
+    readers queue behind it (sqlite3's PENDING) so it is not starved. A
+    wait that could never end, because a holder belongs to the waiting
+    thread or waits on it through other threads, raises at once.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.shared = {}
+        self.reserved = None
+        self.exclusive = None
+        self.pending = None
+        self.owners = {}
+        self.waiting = {}
+
+    def add_shared(self, id_, timeout=LOCK_TIMEOUT):
+        """
+        Takes one more SHARED hold for id_; each is given back by
+        release_shared, or all at once by remove_shared.
+        """
+        with self.mutex:
+            if self._shared_blockers(id_):
+                self._wait(id_, timeout, self._shared_blockers)
+            self.owners[id_] = threading.get_ident()
+            self.shared[id_] = self.shared.get(id_, 0) + 1
+
+    def _shared_blockers(self, id_):
+        if self.exclusive is not None and self.exclusive != id_:
+            return {self.exclusive}
+        if (self.pending is not None and self.pending != id_ and
+                id_ not in self.shared):
+            return {self.pending}
+        return None
+
+    def release_shared(self, id_):
+        with self.mutex:
+            count = self.shared.get(id_)
+            if count is None:
+                return
+            if count > 1:
+                self.shared[id_] = count - 1
+                return
+            del self.shared[id_]
+            self._released(id_)
+
+    def remove_shared(self, id_):
+        with self.mutex:
+            if self.shared.pop(id_, None) is not None:
+                self._released(id_)
+
+    def add_reserved(self, id_, timeout=LOCK_TIMEOUT):
+        with self.mutex:
+            if ((self.reserved is not None and self.reserved != id_) or
+                    (self.exclusive is not None and self.exclusive != id_)):
+                self._wait(id_, timeout, self._reserved_blockers)
+            self.owners[id_] = threading.get_ident()
+            self.reserved = id_
+
+    def _reserved_blockers(self, id_):
+        return {holder for holder in (self.reserved, self.exclusive)
+                if holder is not None and holder != id_}
+
+    def release_reserved(self, id_):
+        with self.mutex:
+            if self.reserved == id_:
+                self.reserved = None
+                self._released(id_)
+
+    def add_exclusive(self, id_, timeout=LOCK_TIMEOUT):
+        with self.mutex:
+            if ((self.reserved is not None and self.reserved != id_) or
+                    (self.exclusive is not None and self.exclusive != id_) or
+                    len(self.shared) > (id_ in self.shared)):
+                self._wait(id_, timeout, self._exclusive_blockers,
+                           pending=True)
+            self.owners[id_] = threading.get_ident()
+            self.exclusive = id_
+
+    def _exclusive_blockers(self, id_):
+        blockers = self._reserved_blockers(id_)
+        if len(self.shared) > (id_ in self.shared):
+            blockers.update(holder for holder in self.shared
+                            if holder != id_)
+        return blockers
+
+    def release_exclusive(self, id_):
+        with self.mutex:
+            if self.exclusive == id_:
+                self.exclusive = None
+                self._released(id_)
+
+    def _released(self, id_):
+        if (id_ not in self.shared and self.reserved != id_ and
+                self.exclusive != id_):
+            self.owners.pop(id_, None)
+        if self.waiting:
+            self.condition.notify_all()
+
+    def _wait(self, id_, timeout, blockers, pending=False):
+        """
+        Waits, with the condition held, until blockers(id_) returns no
+        holders. With pending, new readers are held off while it waits.
+        """
+        me = threading.get_ident()
+        deadline = None
+        waited_since = None
+        try:
+            while True:
+                holders = blockers(id_)
+                if not holders:
+                    return
+                problem = self._deadlock(me, holders)
+                if problem is not None:
+                    raise Exception(problem)
+                if (pending and self.pending is None and
+                        self.reserved in (None, id_) and
+                        self.exclusive is None):
+                    self.pending = id_
+                if timeout is None:
+                    remaining = None
+                else:
+                    if deadline is None:
+                        deadline = time.monotonic() + timeout
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception("database is locked")
+                self.waiting[me] = holders
+                if waited_since is None:
+                    waited_since = time.perf_counter()
+                self.condition.wait(remaining)
+        finally:
+            self.waiting.pop(me, None)
+            if waited_since is not None:
+                profile = current_profile()
+                if profile is not None:
+                    waited = time.perf_counter() - waited_since
+                    profile.lock_wait += waited
+                    profile.phases["lock"] = (profile.phases.get("lock", 0.0)
+                                              + waited)
+                    profile.inner += waited
+            if pending and self.pending == id_:
+                self.pending = None
+                self.condition.notify_all()
+
+    def _deadlock(self, me, holders):
+        """
+        Returns why waiting for holders would never end, or None: a
+        holder belongs to this thread, or waits (through any chain of
+        waiting threads) for one that does.
+        """
+        seen = set()
+        stack = list(holders)
+        while stack:
+            holder = stack.pop()
+            if holder in seen:
+                continue
+            seen.add(holder)
+            owner = self.owners.get(holder)
+            if owner == me:
+                if holder in holders:
+                    return "database is locked"
+                return "deadlock detected"
+            stack.extend(self.waiting.get(owner, ()))
+        return None
+
+
+class ResultCache:
+    """
+    The rows of recent SELECTs on a Database, each kept with the versions
+    that the tables it read had when it ran, and served only while they
+    still have them. Once more than max_rows rows are kept (an empty
+    result counting as one), the least recently used results go first.
+    """
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.mutex = threading.Lock()
+
+    def get(self, key, versions):
+        """
+        Returns the rows kept for key if the tables still have versions,
+        or None.
+        """
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == versions:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, rows):
+        if len(rows) > self.max_rows:
+            return
+        with self.mutex:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (versions, rows)
+            self.rows += max(1, len(rows))
+            while self.rows > self.max_rows:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.rows -= max(1, len(evicted))
+                self.evictions += 1
+
+    def recording(self, key, versions, rows):
+        """
+        Yields rows, then keeps them for key if they all fit.
+        """
+        kept = []
+        for row in rows:
+            if kept is not None:
+                kept.append(row)
+                if len(kept) > self.max_rows:
+                    kept = None
+            yield row
+        if kept is not None:
+            self.put(key, versions, kept)
+
+    def _remove(self, key):
+        self.rows -= max(1, len(self.entries.pop(key)[1]))
+
+    def stats(self):
+        with self.mutex:
+            return {"hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries), "rows": self.rows}
+
+
+def current_profile():
+    """
+    Returns the StatementProfile of the statement this thread is running,
+    or None if it is not being profiled.
+    """
+    if not _PROFILERS:
+        return None
+    return getattr(_PROFILING, "profile", None)
+
+
+class StatementProfile:
+    """
+    Where the time of one statement went. phases holds the seconds spent
+    in each phase it went through (tokenize, parse, lock, scan, join,
+    aggregate, sort, project, distinct, log), not counting the time the
+    phases feeding it rows took; what is left of elapsed went into work
+    outside them, such as changing rows. elapsed counts the time spent
+    running the statement and producing its rows, not the time between
+    fetches. rows_examined are the rows the scans looked at, and
+    lock_wait the seconds spent waiting for other connections' locks.
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.phases = {}
+        self.elapsed = 0.0
+        self.rows_examined = 0
+        self.rows_returned = 0
+        self.lock_wait = 0.0
+        # Seconds charged to phases since the innermost begin.
+        self.inner = 0.0
+
+    def begin(self):
+        """
+        Starts timing a phase, returning what end takes.
+        """
+        outer, self.inner = self.inner, 0.0
+        return time.perf_counter(), outer
+
+    def end(self, phase, started):
+        """
+        Charges phase with the time since begin returned started, less
+        the time charged to other phases in between.
+        """
+        start, outer = started
+        elapsed = time.perf_counter() - start
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed - self.inner
+        self.inner = outer + elapsed
+
+    def timed(self, rows, phase, examined=False):
+        """
+        Yields rows, charging the time each takes to produce to phase,
+        and counting them as examined if examined.
+        """
+        rows = iter(rows)
+        while True:
+            started = self.begin()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                self.end(phase, started)
+            if examined:
+                self.rows_examined += 1
+            yield row
+
+    def returned(self, rows):
+        """
+        Yields a statement's rows, counting them and the time they take.
+        """
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                self.elapsed += time.perf_counter() - start
+            self.rows_returned += 1
+            yield row
+
+    def __repr__(self):
+        return ("StatementProfile({!r}, elapsed={:.6f}, rows_examined={}, "
+                "rows_returned={}, lock_wait={:.6f}, phases={{{}}})".format(
+                    self.sql, self.elapsed, self.rows_examined,
+                    self.rows_returned, self.lock_wait,
+                    ", ".join("{}: {:.6f}".format(phase, seconds)
+                              for phase, seconds in self.phases.items())))
+
+
+class TransactionTables(MutableMapping):
+    """
+    The tables (or materialized views) as one transaction sees them: its
+    own created, copied and dropped ones laid over the database's.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.changed = {}
+
+    def __getitem__(self, table_name):
+        if table_name in self.changed:
+            table = self.changed[table_name]
+            if table is None:
+                raise KeyError(table_name)
+            return table
+        return self.base[table_name]
+
+    def __setitem__(self, table_name, table):
+        self.changed[table_name] = table
+
+    def __delitem__(self, table_name):
+        self[table_name]
+        self.changed[table_name] = None
+
+    def __iter__(self):
+        for table_name in self.base:
+            if table_name not in self.changed:
+                yield table_name
+        for table_name, table in self.changed.items():
+            if table is not None:
+                yield table_name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class Transaction(Database):
+    """
+    An open transaction on a Database. BEGIN costs nothing: a table is
+    copied the first time the transaction changes it, COMMIT installs the
+    changed tables in the database and ROLLBACK just drops this object.
+    Locking stays with the Database.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.filename = database.filename
+        self.tables = TransactionTables(database.tables)
+        self.views = TransactionTables(database.views)
+        self.logged = database.logged
+        self.effects = []
+
+    def writable_table(self, table_name):
+        assert table_name in self.tables
+        if table_name not in self.tables.changed:
+            self.tables.changed[table_name] = self.tables.base[table_name].copy()
+        return self.tables[table_name]
+
+    def writable_view(self, view_name):
+        if view_name not in self.views.changed:
+            self.views.changed[view_name] = self.views.base[view_name].copy()
+        return self.views[view_name]
+
+    def install(self):
+        for table_name, table in self.tables.changed.items():
+            if table is None:
+                self.database.tables.pop(table_name, None)
             else:
-                row[null_default_col] = None
-        self.rows.append(row)
-        
-    def insert_new_default_row(self):
-        qual_col_names = self.column_names
-        row_contents = []
-        for col_name in qual_col_names:
-            row_contents.append(self.default_values[col_name])
-        row = dict(zip(qual_col_names, row_contents))
-        self.rows.append(row)
-
-    def update(self, update_clauses, where_clause):
-        for row in self.rows:
-            if self._row_match_where(row, where_clause):
-                for update_clause in update_clauses:
-                    row[update_clause.col_name] = update_clause.constant
-
-    def delete(self, where_clause):
-        self.rows = [row for row in self.rows
-                     if not self._row_match_where(row, where_clause)]
-                     
-    def set_default(self, default_values):
-        self.default_values = default_values
+                self.database.tables[table_name] = table
+        for view_name, view in self.views.changed.items():
+            if view is None:
+                self.database.views.pop(view_name, None)
+            else:
+                self.database.views[view_name] = view
 
-    def _row_match_where(self, row, where_clause):
-        if not where_clause:
-            return True
-        new_rows = []
-        value = row[where_clause.col_name]
 
-        op = where_clause.operator
-        cons = where_clause.constant
-        if ((op == "IS NOT" and (value is not cons)) or
-                (op == "IS" and value is cons)):
-            return True
+def find_column(column_names, qual_col_name):
+    """
+    Returns the position of qual_col_name in column_names. An unqualified
+    name matches a column of that name from any table.
+    """
+    for position, column_name in enumerate(column_names):
+        if qual_col_name.matches(column_name):
+            return position
+    raise AssertionError("No such column: {}".format(qual_col_name))
+
+
+def resolve_join_columns(left_table, right_table, first_col, second_col):
+    """
+    Returns the positions of the ON columns in the left and right
+    tables, accepting the two columns in either order.
+    """
+    if (first_col.table_name == right_table.name and
+            second_col.table_name == left_table.name):
+        first_col, second_col = second_col, first_col
+    return (left_table.column_position(first_col),
+            right_table.column_position(second_col))
+
+
+def values_sorted(values):
+    """
+    True if the non-NULL values never decrease.
+    """
+    previous = None
+    try:
+        for value in values:
+            if value is None:
+                continue
+            if previous is not None and value < previous:
+                return False
+            previous = value
+    except TypeError:
+        # Values that cannot be compared cannot be merged either.
+        return False
+    return True
+
+
+def hash_join(left_rows, left_keys, right_rows, right_keys, right_width):
+    """
+    LEFT OUTER JOIN that builds a hash table on the right join column
+    and probes it once per left row. NULL keys never match; unmatched
+    left rows are padded with NULLs for every right column.
+    """
+    buckets = {}
+    for key, right_row in zip(right_keys, right_rows):
+        if key is not None:
+            buckets.setdefault(key, []).append(right_row)
+    null_padding = (None,) * right_width
+    for key, left_row in zip(left_keys, left_rows):
+        matches = buckets.get(key) if key is not None else None
+        if not matches:
+            yield left_row + null_padding
+            continue
+        for right_row in matches:
+            yield left_row + right_row
+
+
+def merge_join(left_rows, left_keys, right_rows, right_keys, right_width):
+    """
+    LEFT OUTER JOIN over two inputs that are already ordered on their
+    join keys (NULL keys may appear anywhere). Produces the same rows,
+    in the same order, as hash_join.
+    """
+    right_keyed = [(key, right_row)
+                   for key, right_row in zip(right_keys, right_rows)
+                   if key is not None]
+    null_padding = (None,) * right_width
+    start = 0
+    for key, left_row in zip(left_keys, left_rows):
+        if key is None:
+            yield left_row + null_padding
+            continue
+        while start < len(right_keyed) and right_keyed[start][0] < key:
+            start += 1
+        found_match = False
+        i = start
+        while i < len(right_keyed) and right_keyed[i][0] == key:
+            yield left_row + right_keyed[i][1]
+            found_match = True
+            i += 1
+        if not found_match:
+            yield left_row + null_padding
+
+
+JOIN_STRATEGIES = {
+    "hash": hash_join,
+    "merge": merge_join,
+}
+
+
+def value_matches_where(value, where_clause):
+    op = where_clause.operator
+    cons = where_clause.constant
+    if ((op == "IS NOT" and (value is not cons)) or
+            (op == "IS" and value is cons)):
+        return True
+
+    if value is None or cons is None:
+        return False
+
+    if ((op == ">" and value > cons) or
+        (op == "<" and value < cons) or
+        (op == ">=" and value >= cons) or
+        (op == "<=" and value <= cons) or
+        (op == "=" and value == cons) or
+            (op == "!=" and value != cons)):
+        return True
+    return False
+
+
+_COMPARISONS = {
+    "=": lambda p, c: lambda row: row[p] == c,
+    "!=": lambda p, c: lambda row: row[p] != c and row[p] is not None,
+    ">": lambda p, c: lambda row: row[p] is not None and row[p] > c,
+    "<": lambda p, c: lambda row: row[p] is not None and row[p] < c,
+    ">=": lambda p, c: lambda row: row[p] is not None and row[p] >= c,
+    "<=": lambda p, c: lambda row: row[p] is not None and row[p] <= c,
+    "IS": lambda p, c: lambda row: row[p] is None,
+    "IS NOT": lambda p, c: lambda row: row[p] is not None,
+}
+_COLUMN_COMPARISONS = {
+    "=": lambda p, q: lambda row: row[p] == row[q] and row[p] is not None,
+    "!=": lambda p, q: lambda row: (row[p] != row[q] and row[p] is not None
+                                    and row[q] is not None),
+    ">": lambda p, q: lambda row: (row[p] is not None and row[q] is not None
+                                   and row[p] > row[q]),
+    "<": lambda p, q: lambda row: (row[p] is not None and row[q] is not None
+                                   and row[p] < row[q]),
+    ">=": lambda p, q: lambda row: (row[p] is not None and row[q] is not None
+                                    and row[p] >= row[q]),
+    "<=": lambda p, q: lambda row: (row[p] is not None and row[q] is not None
+                                    and row[p] <= row[q]),
+}
+_COMPLEMENTS = {"=": "!=", "!=": "=", ">": "<=", "<=": ">", "<": ">=",
+                ">=": "<", "IS": "IS NOT", "IS NOT": "IS"}
+
+
+def _never(row):
+    return False
+
+
+def compares_with_null(where_clause):
+    """
+    True if where_clause compares its column with NULL by anything but IS
+    or IS NOT (a NULL bound to a ? placeholder), which is never TRUE.
+    """
+    return (where_clause.constant is None and
+            where_clause.operator not in {"IS", "IS NOT"})
+
+
+def compile_predicate(where_clause, column_names):
+    """
+    Compiles a WHERE expression, once per query, into a function that
+    takes a row laid out as column_names and returns whether the
+    expression is TRUE for it.
+    """
+    return _compile_predicate(where_clause, column_names, False)
+
+
+def _compile_predicate(expression, column_names, negated):
+    # With negated set, the function returned tells whether expression is
+    # FALSE instead: NOT is pushed down to the comparisons, so a
+    # comparison with NULL, neither TRUE nor FALSE, passes no filter
+    # however many NOTs are above it.
+    kind = type(expression)
+    if kind is NotExpression:
+        return _compile_predicate(expression.operand, column_names,
+                                  not negated)
+    if kind is BooleanExpression:
+        parts = [_compile_predicate(operand, column_names, negated)
+                 for operand in expression.operands]
+        if (expression.operator == "AND") != negated:
+            if len(parts) == 2:
+                first, second = parts
+                return lambda row: first(row) and second(row)
+            return lambda row: all(part(row) for part in parts)
+        if len(parts) == 2:
+            first, second = parts
+            return lambda row: first(row) or second(row)
+        return lambda row: any(part(row) for part in parts)
+
+    position = find_column(column_names, expression.col_name)
+    if kind is WhereClause:
+        if compares_with_null(expression):
+            return _never
+        operator = expression.operator
+        if negated:
+            operator = _COMPLEMENTS[operator]
+        return _COMPARISONS[operator](position, expression.constant)
+    if kind is ColumnComparison:
+        operator = expression.operator
+        if negated:
+            operator = _COMPLEMENTS[operator]
+        return _COLUMN_COMPARISONS[operator](
+            position, find_column(column_names, expression.other_col_name))
+    negated = negated != expression.negated
+    if kind is InList:
+        values = frozenset(value for value in expression.values
+                           if value is not None)
+        if not negated:
+            return lambda row: row[position] in values
+        if None in expression.values:
+            return _never
+        return lambda row: (row[position] is not None and
+                            row[position] not in values)
+    if kind is Between:
+        low, high = expression.low, expression.high
+        # c BETWEEN low AND high is c >= low AND c <= high: with a NULL
+        # bound it is never TRUE, and FALSE only by the other bound.
+        if negated and low is None and high is not None:
+            return _COMPARISONS[">"](position, high)
+        if negated and high is None and low is not None:
+            return _COMPARISONS["<"](position, low)
+        if low is None or high is None:
+            return _never
+        if not negated:
+            return lambda row: (row[position] is not None and
+                                low <= row[position] <= high)
+        return lambda row: (row[position] is not None and
+                            (row[position] < low or row[position] > high))
+    assert kind is Like
+    if expression.pattern is None:
+        return _never
+    match = like_pattern(expression.pattern).fullmatch
 
+    def like(row):
+        value = row[position]
         if value is None:
             return False
+        return (match(value if type(value) is str else str(value))
+                is None) == negated
+    return like
 
-        if ((op == ">" and value > cons) or
-            (op == "<" and value < cons) or
-            (op == "=" and value == cons) or
-                (op == "!=" and value != cons)):
-            return True
-        return False
 
-    def select_rows(self, output_columns, order_by_columns,
-                    where_clause=None, is_distinct=False):
-        def expand_star_column(output_columns):
-            new_output_columns = []
-            for col in output_columns:
-                if col.col_name == "*":
-                    new_output_columns.extend(self.column_names)
-                else:
-                    new_output_columns.append(col)
-            return new_output_columns
-
-        def check_columns_exist(columns):
-            assert all(col in self.column_names
-                       for col in columns)
-
-        def ensure_fully_qualified(columns):
-            for col in columns:
-                if col.table_name is None:
-                    col.table_name = self.name
-
-        def sort_rows(rows, order_by_columns):
-            order_by_columns.reverse()
-            for order_by in order_by_columns:
-                column = order_by[0]
-                collate = order_by[1]
-                descend = order_by[2]
-                if collate != None:
-                    """
-                    Hints taken from https://piazza.com/class/jqh746nkrro51r?cid=701
-                    https://python-reference.readthedocs.io/en/latest/docs/functions/sorted.html
-                    https://stackoverflow.com/questions/34981262/porting-sort-with-lambda-function-to-python-3
-                    """
-                    rows = sorted(rows, key=cmp_to_key(lambda x, y: collate(x[column],y[column])), reverse = descend)
-                else:
-                    rows = sorted(rows, key=itemgetter(column), reverse = descend)
-            return rows
+def like_pattern(pattern):
+    """
+    Translates a LIKE pattern (% for any run of characters, _ for any one)
+    into a regular expression, case-insensitive for ASCII as in sqlite.
+    """
+    parts = []
+    for char in pattern:
+        if char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.ASCII | re.DOTALL)
 
-        def generate_tuples(rows, output_columns):
-            for row in rows:
-                yield tuple(row[col] for col in output_columns)
 
-        def remove_duplicates(tuples):
-            seen = set()
-            uniques = []
-            for row in tuples:
-                if row in seen:
-                    continue
-                seen.add(row)
-                uniques.append(row)
-            return uniques
+def expression_columns(where_clause):
+    """
+    Returns the columns a WHERE expression reads, each once.
+    """
+    columns = OrderedDict()
+    stack = [where_clause] if where_clause is not None else []
+    while stack:
+        expression = stack.pop()
+        kind = type(expression)
+        if kind is BooleanExpression:
+            stack.extend(reversed(expression.operands))
+        elif kind is NotExpression:
+            stack.append(expression.operand)
+        else:
+            names = [expression.col_name]
+            if kind is ColumnComparison:
+                names.append(expression.other_col_name)
+            for name in names:
+                columns.setdefault((name.col_name, name.table_name), name)
+    return list(columns.values())
 
-        expanded_output_columns = expand_star_column(output_columns)
 
-        check_columns_exist(expanded_output_columns)
-        ensure_fully_qualified(expanded_output_columns)
-        order_columns = []
-        for order_by_column in order_by_columns:
-            order_columns.append(order_by_column[0])
-        check_columns_exist(order_columns)
-        ensure_fully_qualified(order_columns)
+def conjuncts(where_clause):
+    """
+    Returns the conditions that where_clause ANDs together.
+    """
+    if where_clause is None:
+        return []
+    if (type(where_clause) is BooleanExpression
+            and where_clause.operator == "AND"):
+        return [condition for operand in where_clause.operands
+                for condition in conjuncts(operand)]
+    return [where_clause]
 
-        filtered_rows = [row for row in self.rows
-                         if self._row_match_where(row, where_clause)]
-        sorted_rows = sort_rows(filtered_rows, order_by_columns)
 
-        list_of_tuples = generate_tuples(sorted_rows, expanded_output_columns)
-        if is_distinct:
-            return remove_duplicates(list_of_tuples)
-        return list_of_tuples
+def conjunction(conditions):
+    """
+    Returns the AND of conditions, or None if there are none.
+    """
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return BooleanExpression("AND", tuple(conditions))
 
 
-def pop_and_check(tokens, same_as):
-    item = tokens.pop(0)
-    assert item == same_as, "{} != {}".format(item, same_as)
+def referenced_columns(output_columns, aggregates, where_clause,
+                       group_by_columns, having_clause, order_by_columns):
+    """
+    Returns the columns a SELECT reads from its source, or None if it
+    reads every column.
+    """
+    columns = []
+    for qual_col_name, function in zip(output_columns,
+                                       aggregates or
+                                       [None] * len(output_columns)):
+        if qual_col_name.col_name != "*":
+            columns.append(qual_col_name)
+        elif function is None:
+            return None
+    columns.extend(expression_columns(where_clause))
+    columns.extend(group_by_columns)
+    if having_clause:
+        subject = having_clause.col_name
+        if isinstance(subject, Aggregate):
+            subject = subject.col_name
+        if subject.col_name != "*":
+            columns.append(subject)
+    columns.extend(qual_col_name for qual_col_name, _, _ in order_by_columns)
+    return columns
 
 
-def collect_characters(query, allowed_characters):
-    letters = []
-    for letter in query:
-        if letter not in allowed_characters:
-            break
-        letters.append(letter)
-    return "".join(letters)
+def sql_name(qual_col_name):
+    if qual_col_name.table_name is None:
+        return qual_col_name.col_name
+    return "{}.{}".format(qual_col_name.table_name, qual_col_name.col_name)
 
 
-def remove_leading_whitespace(query, tokens):
-    whitespace = collect_characters(query, string.whitespace)
-    return query[len(whitespace):]
+def describe_condition(condition):
+    """
+    Renders a WHERE expression for EXPLAIN, with ? for its constants.
+    """
+    kind = type(condition)
+    if kind is BooleanExpression:
+        parts = []
+        for operand in condition.operands:
+            part = describe_condition(operand)
+            if type(operand) is BooleanExpression:
+                part = "(" + part + ")"
+            parts.append(part)
+        return " {} ".format(condition.operator).join(parts)
+    if kind is NotExpression:
+        return "NOT ({})".format(describe_condition(condition.operand))
+    name = condition.col_name.col_name
+    negation = "NOT " if getattr(condition, "negated", False) else ""
+    if kind is ColumnComparison:
+        return "{}{}{}".format(name, condition.operator,
+                               condition.other_col_name.col_name)
+    if kind is InList:
+        return "{} {}IN ({})".format(name, negation,
+                                     ",".join("?" * len(condition.values)))
+    if kind is Between:
+        return "{} {}BETWEEN ? AND ?".format(name, negation)
+    if kind is Like:
+        return "{} {}LIKE ?".format(name, negation)
+    if condition.constant is None:
+        return "{} {} NULL".format(name, condition.operator)
+    return "{}{}?".format(name, condition.operator)
 
 
-def remove_word(query, tokens):
-    word = collect_characters(query,
-                              string.ascii_letters + "_" + string.digits)
-    if word == "NULL":
-        tokens.append(None)
+def describe_source(plan, tables):
+    """
+    Returns the PlanStep tree of an AccessPath or JoinPlan.
+    """
+    if type(plan) is JoinPlan:
+        left = describe_source(plan.left, tables)
+        right = describe_source(plan.right, tables)
+        left_table = tables[plan.left.table_name]
+        right_table = tables[plan.right.table_name]
+        selectivity = estimate_selectivity(plan.residual)
+        step = PlanStep(
+            plan.strategy.upper() + " JOIN",
+            "LEFT OUTER JOIN {} ON {} = {}".format(
+                right_table.name,
+                sql_name(left_table.column_names[plan.left_position]),
+                sql_name(right_table.column_names[plan.right_position])),
+            "", plan.rows / selectivity if selectivity else plan.rows,
+            plan.cost, (left, right))
+        if plan.residual:
+            step = PlanStep("FILTER", describe_condition(plan.residual), "",
+                            plan.rows, plan.cost, (step,))
+        return step
+    table = tables[plan.table_name]
+    columns = ", ".join(column_name.col_name for column_name
+                        in table.column_names_at(plan.positions))
+    if plan.index_name is None:
+        step = PlanStep("SCAN", table.name, columns, float(table.row_count),
+                        plan.cost, ())
     else:
-        tokens.append(word)
-    return query[len(word):]
+        selectivity = table.selectivity(plan.residual)
+        step = PlanStep("SEARCH", "{} USING INDEX {} ({})".format(
+            table.name, plan.index_name, describe_condition(plan.condition)),
+            columns, plan.rows / selectivity if selectivity else 0.0,
+            plan.cost, ())
+    if plan.residual:
+        step = PlanStep("FILTER", describe_condition(plan.residual), "",
+                        plan.rows, plan.cost, (step,))
+    return step
 
 
-def remove_text(query, tokens):
-    if (query[0] == "'"):
-        delimiter = "'"
-    else:
-        delimiter = '"'
-    query = query[1:]
-    end_quote_index = query.find(delimiter)
-    while query[end_quote_index + 1] == delimiter:
-        # Remove Escaped Quote
-        query = query[:end_quote_index] + query[end_quote_index + 1:]
-        end_quote_index = query.find(delimiter, end_quote_index + 1)
-    text = query[:end_quote_index]
-    tokens.append(text)
-    query = query[end_quote_index + 1:]
-    return query
-
-
-def remove_integer(query, tokens):
-    int_str = collect_characters(query, string.digits)
-    tokens.append(int_str)
-    return query[len(int_str):]
-
-
-def remove_number(query, tokens):
-    query = remove_integer(query, tokens)
-    if query[0] == ".":
-        whole_str = tokens.pop()
-        query = query[1:]
-        query = remove_integer(query, tokens)
-        frac_str = tokens.pop()
-        float_str = whole_str + "." + frac_str
-        tokens.append(float(float_str))
-    else:
-        int_str = tokens.pop()
-        tokens.append(int(int_str))
-    return query
+def explain_rows(step):
+    """
+    Flattens a PlanStep tree into EXPLAIN's rows, parents first:
+    (id, parent id, operator, detail, columns read, estimated rows,
+    estimated cost).
+    """
+    rows = []
 
+    def visit(step, parent):
+        id_ = len(rows) + 1
+        rows.append((id_, parent, step.operator, step.detail, step.columns,
+                     None if step.rows is None else int(round(step.rows)),
+                     None if step.cost is None else round(step.cost, 1)))
+        for input_step in step.inputs:
+            visit(input_step, id_)
 
-def tokenize(query):
-    tokens = []
-    while query:
-        old_query = query
+    visit(step, 0)
+    return rows
 
-        if query[0] in string.whitespace:
-            query = remove_leading_whitespace(query, tokens)
-            continue
 
-        if query[0] in (string.ascii_letters + "_"):
-            query = remove_word(query, tokens)
-            continue
+_QUERY_PLAN_DETAILS = {
+    "SORT": "USE TEMP B-TREE FOR ORDER BY",
+    "TOP-K SORT": "USE HEAP FOR ORDER BY LIMIT",
+    "DISTINCT": "USE HASH TABLE FOR DISTINCT",
+}
 
-        if query[:2] == "!=":
-            tokens.append(query[:2])
-            query = query[2:]
-            continue
 
-        if query[0] in "(),;*.><=":
-            tokens.append(query[0])
-            query = query[1:]
-            continue
+def query_plan_rows(step):
+    """
+    Flattens a PlanStep tree into EXPLAIN QUERY PLAN's rows, in the
+    order the steps run, as sqlite3 lays them out: (id, parent id,
+    notused, detail).
+    """
+    rows = []
 
-        if query[0] in {"'", '"'}:
-            query = remove_text(query, tokens)
-            continue
+    def visit(step):
+        for input_step in step.inputs:
+            visit(input_step)
+        if step.operator in {"SCAN", "SEARCH"}:
+            detail = step.operator + " " + step.detail
+        elif step.operator.endswith("JOIN"):
+            detail = "USE {} FOR {}".format(step.operator, step.detail)
+        elif step.operator == "AGGREGATE" and step.detail:
+            detail = "USE HASH TABLE FOR GROUP BY"
+        elif step.operator in _QUERY_PLAN_DETAILS:
+            detail = _QUERY_PLAN_DETAILS[step.operator]
+        else:
+            return
+        rows.append((len(rows) + 1, 0, 0, detail))
 
-        if query[0] in string.digits:
-            query = remove_number(query, tokens)
-            continue
+    visit(step)
+    return rows
 
-        if len(query) == len(old_query):
-            raise AssertionError(
-                "Query didn't get shorter. query = {}".format(query))
 
-    return tokens
+class Collation:
+    """
+    A collation registered by create_collation. compare, as in sqlite3,
+    returns a negative number, zero or a positive number as its first
+    argument sorts before, with or after its second. key, if given, maps
+    a value to a sort key that orders the same way: sorting then calls
+    it once per value, instead of compare once per comparison, and the
+    keys of the last COLLATION_KEYS_CACHED values are kept for the next
+    sort (or an index) to reuse.
+    """
+
+    def __init__(self, name, compare=None, key=None):
+        assert compare is not None or key is not None
+        self.name = name
+        self.compare = compare
+        self.key = key
+        if key is not None:
+            self.sort_key = lru_cache(COLLATION_KEYS_CACHED)(key)
+        else:
+            self.sort_key = cmp_to_key(compare)
+
+    def __repr__(self):
+        return "Collation({!r})".format(self.name)
+
+
+class Descending:
+    """
+    Inverts the ordering of a sort key component, for the DESC columns
+    of an ORDER BY that mixes directions.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def storage_class_key(value):
+    """
+    Orders values the way sqlite3 does: NULL, then numbers, then text.
+    """
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+def make_sort_key(sort_keys, mixed_types=False):
+    """
+    Builds one key function for every ORDER BY column, so that rows are
+    sorted once instead of once per column. With mixed_types, NULLs and
+    values of different types are ordered as sqlite3 orders them.
+    """
+    descending = {descend for _, _, descend in sort_keys}
+    mixed_directions = len(descending) > 1
+    if not mixed_types and not any(collate for _, collate, _ in sort_keys):
+        if not mixed_directions:
+            return itemgetter(*[position for position, _, _ in sort_keys])
+
+    parts = []
+    for position, collate, descend in sort_keys:
+        if collate is not None:
+            collate = collate.sort_key
+        parts.append((position, collate, descend and mixed_directions))
+
+    if len(parts) == 1 and not mixed_types:
+        # A single collated column: the key is the collation's own.
+        position, collate, _ = parts[0]
+
+        def key(row):
+            value = row[position]
+            if value is None:
+                return value
+            return collate(value)
+        return key
+
+    def key(row):
+        components = []
+        for position, collate, descend in parts:
+            value = row[position]
+            if collate is not None and value is not None:
+                value = collate(value)
+            if mixed_types:
+                value = storage_class_key(value)
+            components.append(Descending(value) if descend else value)
+        return components
+    return key
+
+
+def sort_rows(rows, sort_keys, limit=None, distinct=False):
+    """
+    Pulls every row, then yields them ordered by sort_keys, a list of
+    (position, collate, descend). With a limit only the first limit
+    rows are kept, selected with a bounded heap. With distinct, only
+    the first of equal rows is kept, and only those are sorted.
+    """
+    if distinct:
+        rows = unique_rows(rows, sort_keys)
+    else:
+        rows = list(rows)
+    reverse = all(descend for _, _, descend in sort_keys)
+
+    def ordered(key):
+        if limit is None:
+            return sorted(rows, key=key, reverse=reverse)
+        if reverse:
+            return heapq.nlargest(limit, rows, key=key)
+        return heapq.nsmallest(limit, rows, key=key)
+
+    try:
+        rows = ordered(make_sort_key(sort_keys))
+    except TypeError:
+        # NULLs or values of different types in a sort column.
+        rows = ordered(make_sort_key(sort_keys, mixed_types=True))
+    yield from rows
+
+
+def unique_rows(rows, sort_keys):
+    """
+    Returns the distinct rows for sort_rows to sort. If the sort keys
+    read every column without a collation, equal rows cannot be told
+    apart by the order they come in, so they are collected straight into
+    a set, the only copy of them held. Otherwise the first of equal rows
+    is kept, so ties come out in the order they were found.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return []
+    rows = itertools.chain((first,), rows)
+    positions = {position for position, _, _ in sort_keys}
+    if (positions.issuperset(range(len(first))) and
+            not any(collate for _, collate, _ in sort_keys)):
+        return set(rows)
+    return list(remove_duplicates(rows))
+
+
+def output_sort_keys(sort_keys, output_positions):
+    """
+    Returns sort_keys with their positions in rows projected to
+    output_positions, or None if one sorts on a column left out.
+    """
+    if output_positions is None:
+        return sort_keys
+    output_keys = []
+    for position, collate, descend in sort_keys:
+        if position not in output_positions:
+            return None
+        output_keys.append((output_positions.index(position), collate,
+                            descend))
+    return output_keys
+
+
+def finish_rows(rows, sort_keys, output_positions, is_distinct,
+                limit=None, offset=0):
+    """
+    Runs the ORDER BY, projection, DISTINCT and LIMIT/OFFSET operators
+    over rows. output_positions is None to keep rows as they are. When
+    the rows are only sorted on columns that are output, DISTINCT runs
+    before the sort, which then sorts distinct rows alone.
+    """
+    stop = None if limit is None else offset + limit
+    profile = current_profile()
+    distinct_first = None
+    if is_distinct and sort_keys:
+        distinct_first = output_sort_keys(sort_keys, output_positions)
+    if sort_keys and distinct_first is None:
+        rows = sort_rows(rows, sort_keys,
+                         limit=None if is_distinct else stop)
+        if profile is not None:
+            rows = profile.timed(rows, "sort")
+    if output_positions is not None:
+        rows = project(rows, output_positions)
+        if profile is not None:
+            rows = profile.timed(rows, "project")
+    if distinct_first is not None:
+        rows = sort_rows(rows, distinct_first, limit=stop, distinct=True)
+        if profile is not None:
+            rows = profile.timed(rows, "sort")
+    elif is_distinct:
+        rows = remove_duplicates(rows)
+        if profile is not None:
+            rows = profile.timed(rows, "distinct")
+    if offset or stop is not None:
+        rows = itertools.islice(rows, offset, stop)
+    return rows
+
+
+def project(rows, positions):
+    if len(positions) == 1:
+        position = positions[0]
+        return ((row[position],) for row in rows)
+    return map(itemgetter(*positions), rows)
+
+
+def remove_duplicates(rows):
+    seen = set()
+    for row in rows:
+        if row in seen:
+            continue
+        seen.add(row)
+        yield row
+
+
+def project_rows(column_names, rows, output_columns, order_by_columns,
+                 is_distinct=False, limit=None, offset=0):
+    """
+    Stacks the sort, projection, DISTINCT and LIMIT operators on top of
+    rows laid out as column_names. Nothing is pulled from rows until the
+    result is read, and without ORDER BY nothing is held in memory
+    beyond DISTINCT's set of rows already seen.
+    """
+    output_positions = []
+    for col in output_columns:
+        if col.col_name == "*":
+            output_positions.extend(range(len(column_names)))
+        else:
+            output_positions.append(find_column(column_names, col))
+    if output_positions == list(range(len(column_names))):
+        output_positions = None
+    sort_keys = [(find_column(column_names, col), collate, descend)
+                 for col, collate, descend in order_by_columns]
+    return finish_rows(rows, sort_keys, output_positions, is_distinct,
+                       limit, offset)
+
+
+class CountAll:
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class Count:
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        if value is not None:
+            self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class Sum:
+    __slots__ = ("total",)
+
+    def __init__(self):
+        self.total = None
+
+    def add(self, value):
+        if value is not None:
+            self.total = value if self.total is None else self.total + value
+
+    def merge(self, other):
+        self.add(other.total)
+
+    def result(self):
+        return self.total
+
+
+class Avg:
+    __slots__ = ("total", "count")
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class Min:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+
+    def merge(self, other):
+        self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Max:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+    def merge(self, other):
+        self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class LastValue:
+    """
+    A column selected without an aggregate: GROUP BY columns, or any
+    other column, which (as in sqlite3) takes a value from the group.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        self.value = value
+
+    def merge(self, other):
+        # other saw later rows of the group.
+        self.value = other.value
+
+    def result(self):
+        return self.value
+
+
+AGGREGATE_FUNCTIONS = {
+    "count": Count,
+    "sum": Sum,
+    "avg": Avg,
+    "min": Min,
+    "max": Max,
+}
+
+
+def plan_aggregate(column_names, output_columns, aggregates,
+                   group_by_columns, having_clause, order_by_columns):
+    """
+    Works out the accumulators a grouped SELECT keeps for each group (as
+    (kind, column position) items) and where the output columns, ORDER
+    BY, HAVING and GROUP BY columns find their values.
+    """
+    items = []
+
+    def add_item(function, qual_col_name):
+        if function is None:
+            item = (LastValue, find_column(column_names, qual_col_name))
+        elif qual_col_name.col_name == "*":
+            assert function == "count"
+            item = (CountAll, None)
+        else:
+            item = (AGGREGATE_FUNCTIONS[function],
+                    find_column(column_names, qual_col_name))
+        if item in items and function is not None:
+            return items.index(item)
+        items.append(item)
+        return len(items) - 1
+
+    if not aggregates:
+        aggregates = [None] * len(output_columns)
+    output_items = []
+    for qual_col_name, function in zip(output_columns, aggregates):
+        if function is None and qual_col_name.col_name == "*":
+            for column_name in column_names:
+                output_items.append(add_item(None, column_name))
+        else:
+            output_items.append(add_item(function, qual_col_name))
+    items_by_column = {position: i for i, (kind, position)
+                       in enumerate(items) if kind is LastValue}
+
+    sort_keys = []
+    for qual_col_name, collate, descend in order_by_columns:
+        position = find_column(column_names, qual_col_name)
+        if position not in items_by_column:
+            items_by_column[position] = add_item(None, qual_col_name)
+        sort_keys.append((items_by_column[position], collate, descend))
+    having_item = None
+    if having_clause:
+        subject = having_clause.col_name
+        if isinstance(subject, Aggregate):
+            having_item = add_item(subject.function, subject.col_name)
+        else:
+            having_item = add_item(None, subject)
+
+    group_positions = [find_column(column_names, qual_col_name)
+                       for qual_col_name in group_by_columns]
+    if output_items == list(range(len(items))):
+        output_items = None
+    return AggregatePlan(items, output_items, sort_keys, having_item,
+                         group_positions)
+
+
+def accumulate_groups(rows, items, group_positions):
+    """
+    One pass of hash aggregation: returns the accumulators for items
+    kept per GROUP BY key of rows.
+    """
+    groups = {}
+    for row in rows:
+        key = tuple([row[position] for position in group_positions])
+        accumulators = groups.get(key)
+        if accumulators is None:
+            accumulators = groups[key] = [kind() for kind, _ in items]
+        for accumulator, (kind, position) in zip(accumulators, items):
+            accumulator.add(row[position] if position is not None else None)
+    return groups
+
+
+def merge_groups(partial_groups):
+    """
+    Combines the groups accumulated over consecutive slices of the rows,
+    taken in order, into the groups of all of them.
+    """
+    groups = {}
+    for partial in partial_groups:
+        for key, accumulators in partial.items():
+            merged = groups.get(key)
+            if merged is None:
+                groups[key] = accumulators
+                continue
+            for accumulator, other in zip(merged, accumulators):
+                accumulator.merge(other)
+    return groups
+
+
+def aggregate_rows(column_names, rows, output_columns, aggregates,
+                   group_by_columns, having_clause, order_by_columns,
+                   is_distinct=False, limit=None, offset=0,
+                   partial_groups=None):
+    """
+    Hash aggregation: one pass over rows keeps a set of accumulators per
+    GROUP BY key (a single group without GROUP BY), then HAVING, ORDER BY
+    and DISTINCT run over the much smaller list of groups. partial_groups,
+    if given, are groups already accumulated over slices of the rows
+    (see scan_morsels), merged in place of reading rows.
+    """
+    plan = plan_aggregate(column_names, output_columns, aggregates,
+                          group_by_columns, having_clause, order_by_columns)
+    profile = current_profile()
+    if profile is not None:
+        started = profile.begin()
+    if partial_groups is None:
+        groups = accumulate_groups(rows, plan.items, plan.group_positions)
+    else:
+        groups = merge_groups(partial_groups)
+    if profile is not None:
+        profile.end("aggregate", started)
+    if not groups and not plan.group_positions:
+        groups[()] = [kind() for kind, _ in plan.items]
+
+    results = (tuple(accumulator.result() for accumulator in accumulators)
+               for accumulators in groups.values())
+    having_item = plan.having_item
+    if having_item is not None:
+        results = (result for result in results
+                   if value_matches_where(result[having_item], having_clause))
+    return finish_rows(results, plan.sort_keys, plan.output_items,
+                       is_distinct, limit, offset)
+
+
+_COLUMN_TYPECODES = {"INTEGER": "q", "REAL": "d"}
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+_COLUMN_DATA_FIELDS = {"typecode", "values", "nulls", "null_count"}
+
+
+# The types of values that a typed column stores as they are (REAL
+# turns ints into floats), so a block of them goes into its array at once.
+_BLOCK_TYPES = {"q": {int, type(None)}, "d": {float, int, type(None)}}
+
+
+class ColumnVector:
+    """
+    Storage for one column of a Table. INTEGER and REAL columns keep their
+    values in an array('q') or array('d') with a one-byte-per-row null map
+    beside it; TEXT columns keep a list of interned strings. A typed
+    vector that is handed a value its array cannot hold (a string in an
+    INTEGER column, say) falls back to a plain list for good.
+    """
+
+    # Set while a checkpoint has yet to copy the values and nulls this
+    # column had when it was frozen; changing them in place copies them
+    # first.
+    shared = False
+
+    def __init__(self, column_type):
+        self.column_type = column_type
+        self.typecode = _COLUMN_TYPECODES.get(column_type)
+        if self.typecode:
+            self.values = array(self.typecode)
+            self.nulls = bytearray()
+        else:
+            self.values = []
+            self.nulls = None
+        self.null_count = 0
+        self.source = None
+
+    @classmethod
+    def mapped(cls, column_type, source):
+        """
+        Returns a column whose data stays in the database file, described
+        by source (a MappedColumn), until it is first used.
+        """
+        column = cls.__new__(cls)
+        column.column_type = column_type
+        column.source = source
+        return column
+
+    def __getattr__(self, name):
+        # Only reached while a mapped column has not been read yet. The
+        # data is decoded on the side and filled in at once, so another
+        # thread never sees half of it.
+        if name not in _COLUMN_DATA_FIELDS or "source" not in self.__dict__:
+            raise AttributeError(name)
+        with _LOAD_LOCK:
+            source = self.source
+            if source is not None:
+                loaded = ColumnVector.__new__(ColumnVector)
+                decode_column(loaded, source.encoding, source.read_segments())
+                self.__dict__.update(loaded.__dict__)
+                self.source = None
+        return getattr(self, name)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        if not self.typecode or not self.null_count:
+            return iter(self.values)
+        return (None if is_null else value
+                for value, is_null in zip(self.values, self.nulls))
+
+    def __getitem__(self, row_id):
+        if self.typecode and self.nulls[row_id]:
+            return None
+        return self.values[row_id]
+
+    def __setitem__(self, row_id, value):
+        if self.shared:
+            self._unshare()
+        value = self._coerce(value)
+        if not self.typecode:
+            self.values[row_id] = value
+        elif value is None:
+            self.null_count += 1 - self.nulls[row_id]
+            self.nulls[row_id] = 1
+            self.values[row_id] = 0
+        elif self._fits(value):
+            self.null_count -= self.nulls[row_id]
+            self.nulls[row_id] = 0
+            self.values[row_id] = value
+        else:
+            self._fall_back_to_list()
+            self.values[row_id] = value
+
+    def append(self, value):
+        value = self._coerce(value)
+        if not self.typecode:
+            self.values.append(value)
+        elif value is None:
+            self.values.append(0)
+            self.nulls.append(1)
+            self.null_count += 1
+        elif self._fits(value):
+            self.values.append(value)
+            self.nulls.append(0)
+        else:
+            self._fall_back_to_list()
+            self.values.append(value)
+
+    def take(self, row_ids):
+        """
+        Returns the values at row_ids, in order.
+        """
+        if not row_ids:
+            return []
+        getter = itemgetter(*row_ids)
+        if len(row_ids) == 1:
+            return [self[row_ids[0]]]
+        values = getter(self.values)
+        if self.typecode and self.null_count:
+            return [None if is_null else value
+                    for value, is_null in zip(values, getter(self.nulls))]
+        return values
+
+    def extend(self, values):
+        """
+        Appends values as append would, one by one, but as a block when
+        the column can hold all of them.
+        """
+        types = set(map(type, values))
+        if not self.typecode:
+            if types <= {str}:
+                self.values.extend(map(sys.intern, values))
+                return
+        elif types <= _BLOCK_TYPES[self.typecode]:
+            nulls = bytearray(len(values))
+            if type(None) in types:
+                nulls = bytearray(value is None for value in values)
+                values = [0 if value is None else value for value in values]
+            try:
+                block = array(self.typecode, values)
+            except OverflowError:
+                pass
+            else:
+                self.values.extend(block)
+                self.nulls.extend(nulls)
+                self.null_count += nulls.count(1)
+                return
+        for value in values:
+            self.append(value)
+
+    def slice(self, start, stop):
+        """
+        Returns the values of rows start to stop, NULLs as None.
+        """
+        values = self.values[start:stop]
+        if self.typecode and self.null_count:
+            return [None if is_null else value
+                    for value, is_null in zip(values, self.nulls[start:stop])]
+        return values
+
+    def keep(self, mask):
+        """
+        Drops every row whose entry in mask is false.
+        """
+        if self.typecode:
+            self.values = array(self.typecode,
+                                itertools.compress(self.values, mask))
+            self.nulls = bytearray(itertools.compress(self.nulls, mask))
+            self.null_count = self.nulls.count(1)
+        else:
+            self.values = list(itertools.compress(self.values, mask))
+
+    def remove(self, row_ids):
+        """
+        Drops the rows row_ids (sorted), moving the rows after each down
+        in place: cheaper than keep for a few rows.
+        """
+        if self.shared:
+            self._unshare()
+        for row_id in reversed(row_ids):
+            del self.values[row_id]
+            if self.typecode:
+                self.null_count -= self.nulls[row_id]
+                del self.nulls[row_id]
+
+    def clear(self):
+        self.__init__(self.column_type)
+
+    def copy(self):
+        column = ColumnVector(self.column_type)
+        column.typecode = self.typecode
+        column.values = self.values[:]
+        column.nulls = self.nulls[:] if self.nulls is not None else None
+        column.null_count = self.null_count
+        return column
+
+    def freeze(self):
+        """
+        Returns a column that holds this one's values and nulls as they
+        are now, without copying them, for a checkpoint to copy later
+        with unfreeze. Rows appended meanwhile do not disturb them; a
+        change in place makes this column copy them for itself first.
+        """
+        column = ColumnVector.__new__(ColumnVector)
+        column.column_type = self.column_type
+        column.typecode = self.typecode
+        column.values = self.values
+        column.nulls = self.nulls
+        column.null_count = self.null_count
+        column.source = None
+        column.origin = self
+        self.shared = True
+        return column
+
+    def unfreeze(self, row_count):
+        """
+        Copies the first row_count values and nulls of a frozen column (a
+        block at a time, so that commits on other threads are not held
+        up) and lets the column it was frozen from change them in place
+        again. Does nothing to any other column.
+        """
+        origin = self.__dict__.pop("origin", None)
+        if origin is None:
+            return
+        self.values = copy_rows(self.values, row_count)
+        if self.nulls is not None:
+            self.nulls = copy_rows(self.nulls, row_count)
+        origin.shared = False
+
+    def _unshare(self):
+        self.values = self.values[:]
+        if self.nulls is not None:
+            self.nulls = self.nulls[:]
+        self.shared = False
+
+    def _coerce(self, value):
+        if isinstance(value, str):
+            return sys.intern(str(value))
+        if self.column_type == "REAL" and type(value) is int:
+            # REAL affinity, as in sqlite3.
+            try:
+                return float(value)
+            except OverflowError:
+                return value
+        return value
+
+    def _fits(self, value):
+        if self.typecode == "q":
+            return type(value) is int and _INT64_MIN <= value <= _INT64_MAX
+        return type(value) is float
+
+    def _fall_back_to_list(self):
+        self.values = list(self)
+        self.typecode = None
+        self.nulls = None
+        self.null_count = 0
+
+
+# Most keys a block of SortedKeys holds before it is split in two.
+SORTED_BLOCK_KEYS = 1000
+# Deleted rows an Index tracks as gaps before it renumbers its rows.
+INDEX_GAPS = 1024
+# Up to this many rows are deleted from a column one by one, each
+# moving the rows after it down, instead of copying the rows kept.
+FEW_ROWS = 64
+
+
+class SortedKeys:
+    """
+    Distinct keys in order, kept as a list of sorted blocks of at most
+    SORTED_BLOCK_KEYS keys with the last key of each beside them, so
+    adding or removing a key moves at most a block of its neighbours
+    rather than every key after it. Positions count keys from the first
+    as in a sorted list.
+    """
+
+    def __init__(self, keys=()):
+        keys = list(keys)
+        # Blocks start half full, leaving room for keys to come.
+        size = SORTED_BLOCK_KEYS // 2
+        self.blocks = [keys[start:start + size]
+                       for start in range(0, len(keys), size)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.length = len(keys)
+        self.offsets = None
+
+    def copy(self):
+        keys = SortedKeys()
+        keys.blocks = [list(block) for block in self.blocks]
+        keys.maxes = list(self.maxes)
+        keys.length = self.length
+        return keys
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def add(self, key):
+        """
+        Adds a key not already held. Raises TypeError, changing nothing,
+        if it cannot be ordered among the others.
+        """
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+        else:
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                i -= 1
+                self.blocks[i].append(key)
+                self.maxes[i] = key
+            else:
+                bisect.insort(self.blocks[i], key)
+            block = self.blocks[i]
+            if len(block) > SORTED_BLOCK_KEYS:
+                half = len(block) // 2
+                self.blocks.insert(i + 1, block[half:])
+                self.maxes.insert(i + 1, block[-1])
+                del block[half:]
+                self.maxes[i] = block[-1]
+        self.length += 1
+        self.offsets = None
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+        self.length -= 1
+        self.offsets = None
+
+    def _offsets(self):
+        if self.offsets is None:
+            self.offsets = [0]
+            self.offsets.extend(itertools.accumulate(map(len, self.blocks)))
+        return self.offsets
+
+    def bisect_left(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return self.length
+        return self._offsets()[i] + bisect.bisect_left(self.blocks[i], key)
+
+    def bisect_right(self, key):
+        i = bisect.bisect_right(self.maxes, key)
+        if i == len(self.maxes):
+            return self.length
+        return self._offsets()[i] + bisect.bisect_right(self.blocks[i], key)
+
+    def __getitem__(self, position):
+        offsets = self._offsets()
+        i = bisect.bisect_right(offsets, position) - 1
+        return self.blocks[i][position - offsets[i]]
+
+    def between(self, start, end):
+        """
+        Returns the keys from position start up to (not including) end.
+        """
+        if start >= end:
+            return []
+        offsets = self._offsets()
+        i = bisect.bisect_right(offsets, start) - 1
+        return list(itertools.islice(
+            itertools.chain.from_iterable(self.blocks[i:]),
+            start - offsets[i], end - offsets[i]))
+
+
+class Index:
+    """
+    Secondary index on one column of a Table. A hash map from each value
+    to the sorted ids of the rows holding it answers =, !=, IS and IS NOT;
+    the distinct non-NULL values, in SortedKeys, answer < and >.
+
+    A row is kept under the id it had when indexed. Deleting rows moves
+    the rows after them down in the table, but here only leaves their
+    ids behind as gaps, sorted, which are counted off the ids lookups
+    return. Once there are more than INDEX_GAPS the ids are renumbered.
+    """
+
+    def __init__(self, name, column_name):
+        self.name = name
+        self.column_name = column_name
+        self.buckets = {}
+        self.sorted_keys = SortedKeys()
+        self.ordered = True
+        self.gaps = []
+
+    def copy(self):
+        index = Index(self.name, self.column_name)
+        index.buckets = {value: list(row_ids)
+                         for value, row_ids in self.buckets.items()}
+        index.sorted_keys = self.sorted_keys.copy()
+        index.ordered = self.ordered
+        index.gaps = list(self.gaps)
+        return index
+
+    def _stored_id(self, row_id):
+        """
+        Returns the id the row now numbered row_id is kept under.
+        """
+        gaps = self.gaps
+        stored = row_id
+        while gaps:
+            moved = row_id + bisect.bisect_right(gaps, stored)
+            if moved == stored:
+                break
+            stored = moved
+        return stored
+
+    def _row_ids(self, stored_ids):
+        """
+        Returns, as a new list, the current ids of the rows kept under
+        stored_ids (sorted).
+        """
+        gaps = self.gaps
+        if not gaps:
+            return list(stored_ids)
+        return [stored - bisect.bisect_left(gaps, stored)
+                for stored in stored_ids]
+
+    def build(self, column):
+        self.gaps = []
+        self.buckets = {}
+        for row_id, value in enumerate(column):
+            bucket = self.buckets.get(value)
+            if bucket is None:
+                self.buckets[value] = [row_id]
+            else:
+                bucket.append(row_id)
+        try:
+            self.sorted_keys = SortedKeys(sorted(key for key in self.buckets
+                                                 if key is not None))
+            self.ordered = True
+        except TypeError:
+            # Mixed types have no order; < and > fall back to scanning.
+            self.sorted_keys = SortedKeys()
+            self.ordered = False
+
+    def add(self, value, row_id):
+        row_id = self._stored_id(row_id)
+        bucket = self.buckets.get(value)
+        if bucket is not None:
+            bisect.insort(bucket, row_id)
+            return
+        self.buckets[value] = [row_id]
+        if value is not None and self.ordered:
+            try:
+                self.sorted_keys.add(value)
+            except TypeError:
+                self.sorted_keys = SortedKeys()
+                self.ordered = False
+
+    def extend(self, values, first_row_id):
+        """
+        Adds the values of the rows numbered from first_row_id on, which
+        come after every row already indexed.
+        """
+        new_keys = []
+        buckets = self.buckets
+        # Every gap lies before the new rows.
+        first_row_id += len(self.gaps)
+        for row_id, value in enumerate(values, first_row_id):
+            bucket = buckets.get(value)
+            if bucket is None:
+                buckets[value] = [row_id]
+                if value is not None:
+                    new_keys.append(value)
+            else:
+                bucket.append(row_id)
+        if new_keys and self.ordered:
+            try:
+                if len(new_keys) * SORTED_BLOCK_KEYS < len(self.sorted_keys):
+                    for key in new_keys:
+                        self.sorted_keys.add(key)
+                else:
+                    self.sorted_keys = SortedKeys(sorted(itertools.chain(
+                        self.sorted_keys, new_keys)))
+            except TypeError:
+                self.sorted_keys = SortedKeys()
+                self.ordered = False
+
+    def remove(self, value, row_id):
+        self._discard(value, self._stored_id(row_id))
+
+    def _discard(self, value, stored):
+        bucket = self.buckets[value]
+        del bucket[bisect.bisect_left(bucket, stored)]
+        if bucket:
+            return
+        del self.buckets[value]
+        if value is not None and self.ordered:
+            self.sorted_keys.remove(value)
+
+    def remove_rows(self, row_ids, values):
+        """
+        Removes the rows row_ids (sorted), which held values, as the
+        table drops them and numbers the rows after them down.
+        """
+        removed = [self._stored_id(row_id) for row_id in row_ids]
+        for value, stored in zip(values, removed):
+            self._discard(value, stored)
+        self.gaps = list(heapq.merge(self.gaps, removed))
+        if len(self.gaps) > INDEX_GAPS:
+            self._renumber()
+
+    def _renumber(self):
+        """
+        Numbers the kept rows as the table does, leaving no gaps.
+        """
+        gaps = self.gaps
+        first = gaps[0]
+        for bucket in self.buckets.values():
+            if bucket[-1] < first:
+                continue
+            start = bisect.bisect_left(bucket, first)
+            bucket[start:] = [stored - bisect.bisect_left(gaps, stored)
+                              for stored in bucket[start:]]
+        self.gaps = []
+
+    def lookup(self, where_clause, row_count):
+        """
+        Returns the sorted ids of the rows matching where_clause (a
+        comparison, IN list or BETWEEN on this index's column), or None
+        if this index cannot answer it.
+        """
+        if type(where_clause) is InList:
+            if where_clause.negated:
+                return None
+            return self._row_ids(sorted(itertools.chain.from_iterable(
+                self.buckets.get(value, ())
+                for value in set(where_clause.values) if value is not None)))
+        if type(where_clause) is Between:
+            if where_clause.negated:
+                return None
+            if where_clause.low is None or where_clause.high is None:
+                return []
+            return self._range(where_clause.low, True,
+                               where_clause.high, True)
+        if compares_with_null(where_clause):
+            return []
+        op = where_clause.operator
+        cons = where_clause.constant
+        if op in {"=", "IS"}:
+            return self._row_ids(self.buckets.get(cons, ()))
+        if op in {"!=", "IS NOT"}:
+            keep = bytearray(b"\x01") * row_count
+            for row_id in self._row_ids(self.buckets.get(None, ())):
+                keep[row_id] = 0
+            if cons is not None:
+                for row_id in self._row_ids(self.buckets.get(cons, ())):
+                    keep[row_id] = 0
+            return list(itertools.compress(range(row_count), keep))
+        if op[0] == ">":
+            return self._range(cons, op == ">=", None, False)
+        return self._range(None, False, cons, op == "<=")
+
+    def estimate(self, where_clause, row_count):
+        """
+        Returns how many rows lookup would return for where_clause, or
+        None if this index cannot answer it. Equality and IN lists are
+        counted exactly; a range is estimated from the share of the
+        distinct keys it spans.
+        """
+        if type(where_clause) is InList:
+            if where_clause.negated:
+                return None
+            return sum(len(self.buckets.get(value, ()))
+                       for value in set(where_clause.values)
+                       if value is not None)
+        if type(where_clause) is Between:
+            if where_clause.negated:
+                return None
+            if where_clause.low is None or where_clause.high is None:
+                return 0
+            return self._range_estimate(where_clause.low, True,
+                                        where_clause.high, True, row_count)
+        if compares_with_null(where_clause):
+            return 0
+        op = where_clause.operator
+        cons = where_clause.constant
+        if op in {"=", "IS"}:
+            return len(self.buckets.get(cons, ()))
+        if op in {"!=", "IS NOT"}:
+            matches = row_count - len(self.buckets.get(None, ()))
+            if cons is not None:
+                matches -= len(self.buckets.get(cons, ()))
+            return matches
+        if op[0] == ">":
+            return self._range_estimate(cons, op == ">=", None, False,
+                                        row_count)
+        return self._range_estimate(None, False, cons, op == "<=", row_count)
+
+    def _key_range(self, low, low_inclusive, high, high_inclusive):
+        """
+        Returns the slice of sorted_keys between low and high (either
+        None for no bound) as (start, end), or None if the keys cannot
+        be ordered.
+        """
+        if not self.ordered:
+            return None
+        keys = self.sorted_keys
+        try:
+            start, end = 0, len(keys)
+            if low is not None:
+                start = (keys.bisect_left(low) if low_inclusive else
+                         keys.bisect_right(low))
+            if high is not None:
+                end = (keys.bisect_right(high) if high_inclusive else
+                       keys.bisect_left(high))
+        except TypeError:
+            return None
+        return start, end
+
+    def _range(self, low, low_inclusive, high, high_inclusive):
+        """
+        Returns the sorted ids of the rows with values between low and
+        high (either None for no bound), or None if the keys cannot be
+        ordered.
+        """
+        key_range = self._key_range(low, low_inclusive, high, high_inclusive)
+        if key_range is None:
+            return None
+        keys = self.sorted_keys.between(*key_range)
+        if len(keys) == 1:
+            return self._row_ids(self.buckets[keys[0]])
+        return self._row_ids(sorted(itertools.chain.from_iterable(
+            self.buckets[key] for key in keys)))
+
+    def _range_estimate(self, low, low_inclusive, high, high_inclusive,
+                        row_count):
+        key_range = self._key_range(low, low_inclusive, high, high_inclusive)
+        if key_range is None:
+            return None
+        start, end = key_range
+        if end <= start:
+            return 0
+        if end - start == 1:
+            return len(self.buckets[self.sorted_keys[start]])
+        non_null = row_count - len(self.buckets.get(None, ()))
+        return non_null * (end - start) / len(self.sorted_keys)
+
+    def values_per_key(self, row_count):
+        """
+        Returns the average number of rows holding each non-NULL value.
+        """
+        keys = len(self.buckets) - (None in self.buckets)
+        if not keys:
+            return 0.0
+        return (row_count - len(self.buckets.get(None, ()))) / keys
+
+
+_INDEXED_CONDITIONS = {WhereClause, InList, Between}
+
+# Relative costs the planner compares access paths and joins by: reading
+# a row in a scan, fetching one through an index, and joining one row.
+SCAN_ROW_COST = 1.0
+INDEX_ROW_COST = 2.0
+JOIN_ROW_COST = 1.5
+HISTOGRAM_BUCKETS = 16
+# Statistics are recomputed once this share of the rows has changed.
+STALE_STATISTICS = 0.2
+_DEFAULT_SELECTIVITY = {"=": 0.1, "IS": 0.1, "!=": 0.9, "IS NOT": 0.9}
+
+
+class ColumnStatistics(namedtuple("ColumnStatistics",
+                                  ["row_count", "nulls", "distinct",
+                                   "histogram"])):
+    """
+    What ANALYZE learns about one column: its NULL and distinct value
+    counts and an equi-depth histogram, the sorted non-NULL values at
+    HISTOGRAM_BUCKETS + 1 evenly spaced ranks (None if the values cannot
+    be ordered).
+    """
+
+    def selectivity(self, condition):
+        """
+        Returns the estimated fraction of rows matching condition (a
+        comparison with a constant, IN list or BETWEEN), or None.
+        """
+        if not self.row_count:
+            return 0.0
+        non_null = (self.row_count - self.nulls) / self.row_count
+        equal = non_null / self.distinct if self.distinct else 0.0
+        kind = type(condition)
+        if kind is InList:
+            values = {value for value in condition.values if value is not None}
+            fraction = min(non_null, equal * len(values))
+            return non_null - fraction if condition.negated else fraction
+        if kind is Between:
+            if condition.low is None or condition.high is None:
+                return 0.0
+            share = self._share(condition.low, condition.high)
+            if share is None:
+                return None
+            return non_null * (1 - share if condition.negated else share)
+        if compares_with_null(condition):
+            return 0.0
+        op = condition.operator
+        cons = condition.constant
+        if op == "IS":
+            return self.nulls / self.row_count if cons is None else equal
+        if op == "IS NOT":
+            return non_null if cons is None else 1 - equal
+        if op == "=":
+            return equal
+        if op == "!=":
+            return non_null - equal
+        if op[0] == ">":
+            share = self._share(cons, None)
+        else:
+            share = self._share(None, cons)
+        return None if share is None else non_null * share
+
+    def _share(self, low, high):
+        """
+        Returns the share of the non-NULL values between low and high
+        (either None for no bound), read off the histogram.
+        """
+        if self.histogram is None:
+            return None
+        if not self.histogram:
+            return 0.0
+        try:
+            start = 0 if low is None else bisect.bisect_left(self.histogram,
+                                                             low)
+            end = len(self.histogram) if high is None else \
+                bisect.bisect_right(self.histogram, high)
+        except TypeError:
+            return None
+        return max(end - start, 0) / len(self.histogram)
+
+
+def analyze_column(column):
+    values = [value for value in column if value is not None]
+    distinct = len(set(values))
+    try:
+        values.sort()
+    except TypeError:
+        histogram = None
+    else:
+        histogram = [values[rank * (len(values) - 1) // HISTOGRAM_BUCKETS]
+                     for rank in range(HISTOGRAM_BUCKETS + 1)] if values else []
+    return ColumnStatistics(len(column), len(column) - len(values), distinct,
+                            histogram)
+
+
+def estimate_selectivity(condition, leaf_selectivity=None):
+    """
+    Returns the estimated fraction of rows matching condition. Each
+    comparison, IN list, BETWEEN or LIKE is estimated by
+    leaf_selectivity if it returns a number, otherwise by a fixed guess;
+    AND and OR combine their operands as if they were independent.
+    """
+    if not condition:
+        return 1.0
+    kind = type(condition)
+    if kind is BooleanExpression:
+        fractions = [estimate_selectivity(operand, leaf_selectivity)
+                     for operand in condition.operands]
+        if condition.operator == "AND":
+            product = 1.0
+            for fraction in fractions:
+                product *= fraction
+            return product
+        remaining = 1.0
+        for fraction in fractions:
+            remaining *= 1 - fraction
+        return 1 - remaining
+    if kind is NotExpression:
+        return 1 - estimate_selectivity(condition.operand, leaf_selectivity)
+    if leaf_selectivity is not None:
+        fraction = leaf_selectivity(condition)
+        if fraction is not None:
+            return fraction
+    if kind is WhereClause:
+        return _DEFAULT_SELECTIVITY.get(condition.operator, 1 / 3)
+    if kind is InList:
+        fraction = min(1.0, 0.1 * len(condition.values))
+        return 1 - fraction if condition.negated else fraction
+    if kind in {Between, Like}:
+        return 0.75 if condition.negated else 0.25
+    return 1 / 3
+
+
+def match_morsel(columns, start, stop, column_names, residual):
+    """
+    Returns the ids of the rows start to stop, whose values of
+    column_names are in columns, that match residual.
+    """
+    predicate = compile_predicate(residual, column_names)
+    return list(itertools.compress(range(start, stop),
+                                   map(predicate, zip(*columns))))
+
+
+def scan_morsel(columns, start, stop, column_names, residual, sort_keys,
+                limit, aggregation):
+    """
+    Runs the part of a SELECT that one morsel of its rows can do alone:
+    filtering by residual, then either accumulating the groups of
+    aggregation, an (items, group positions) pair, or sorting by
+    sort_keys (keeping the first limit rows). Returns the groups or the
+    list of rows.
+    """
+    if columns:
+        rows = zip(*columns)
+    else:
+        rows = itertools.repeat((), stop - start)
+    if residual:
+        rows = filter(compile_predicate(residual, column_names), rows)
+    if aggregation is not None:
+        return accumulate_groups(rows, *aggregation)
+    if sort_keys:
+        return list(sort_rows(rows, sort_keys, limit))
+    return list(rows)
+
+
+_NUMERIC_TEXT = re.compile(r"\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)"
+                           r"([eE][-+]?[0-9]+)?\s*\Z")
+# Text that int() or float() would take but sqlite3 keeps as text.
+_NOT_NUMERIC = {"INTEGER": re.compile(r"[^-+0-9\s]"),
+                "REAL": re.compile(r"[^-+0-9.eE\s]")}
+
+
+def numeric_affinity(text, column_type):
+    """
+    Returns text converted as sqlite3 converts text stored in an INTEGER
+    or REAL column: to a number if it reads as one, else left as text.
+    """
+    if _NUMERIC_TEXT.match(text) is None:
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        value = float(text)
+    if (column_type == "INTEGER" and value.is_integer() and
+            _INT64_MIN <= value <= _INT64_MAX):
+        return int(value)
+    return value
+
+
+def coerce_values(values, column_type, null):
+    """
+    Returns the values of a bulk loaded column, with text converted by
+    the column's type (see numeric_affinity), the text null (unless
+    None) as NULL and JSON true and false as 1 and 0.
+    """
+    if column_type == "TEXT":
+        if null is None or null not in values:
+            return values
+        return [None if value == null else value for value in values]
+    if ((null is None or null not in values) and
+            set(map(type, values)) == {str}):
+        try:
+            if _NOT_NUMERIC[column_type].search("".join(values)) is None:
+                return list(map(int if column_type == "INTEGER" else float,
+                                values))
+        except ValueError:
+            pass
+    converted = []
+    for value in values:
+        if type(value) is str:
+            value = (None if value == null else
+                     numeric_affinity(value, column_type))
+        elif type(value) is bool:
+            value = int(value)
+        converted.append(value)
+    return converted
+
+
+def record_batches(table, records, column_names=None, null=None):
+    """
+    Groups records into batches of BULK_LOAD_ROWS rows of table, each a
+    list of the values of every column. A record is a list of values in
+    the order of column_names (every column, by default) or a dict from
+    column name to value; the columns it leaves out take their default.
+    """
+    def positions_of(names):
+        return [table.column_position(QualifiedColumnName(name, table.name))
+                for name in names]
+
+    positions = list(range(len(table.columns)))
+    if column_names is not None:
+        positions = positions_of(column_names)
+
+    def full_row(record):
+        row = list(table.default_row)
+        if isinstance(record, dict):
+            record_positions = positions_of(record)
+            record = record.values()
+        else:
+            assert len(record) == len(positions), \
+                "Expected {} values, got {}".format(len(positions),
+                                                    len(record))
+            record_positions = positions
+        for position, value in zip(record_positions, record):
+            row[position] = value
+        return row
+
+    for batch in iter(lambda: list(itertools.islice(records, BULK_LOAD_ROWS)),
+                      []):
+        batch_positions = positions
+        if dict in set(map(type, batch)):
+            batch_positions = range(len(table.columns))
+            batch = [full_row(record) for record in batch]
+        else:
+            lengths = set(map(len, batch))
+            assert lengths == {len(positions)}, \
+                "Expected {} values, got {}".format(
+                    len(positions), sorted(lengths - {len(positions)}))
+        columns = [[default] * len(batch) for default in table.default_row]
+        for position, values in zip(batch_positions, zip(*batch)):
+            columns[position] = coerce_values(
+                list(values), table.column_types[position], null)
+        yield columns
+
+
+def json_record(line):
+    """
+    Reads a line of JSON Lines: an array of values or an object from
+    column name to value.
+    """
+    record = json.loads(line)
+    assert isinstance(record, (list, dict)), \
+        "Expected a JSON array or object: {}".format(line.strip())
+    values = record.values() if isinstance(record, dict) else record
+    assert not any(isinstance(value, (list, dict)) for value in values), \
+        "Nested JSON values cannot be loaded: {}".format(line.strip())
+    return record
+
+
+class Table:
+
+    def __init__(self, name, column_name_type_pairs):
+        self.name = name
+        self.column_name_type_pairs = column_name_type_pairs
+        self.column_names, self.column_types = zip(*column_name_type_pairs)
+        self.columns = [ColumnVector(column_type)
+                        for column_type in self.column_types]
+        self.row_count = 0
+        self.default_values = {}
+        self.default_row = [None] * len(self.columns)
+        self.indexes = {}
+        self._positions = {}
+        self.modifications = 0
+        self.version = next(_TABLE_VERSIONS)
+        self.statistics = {}
+        self._sorted = {}
+
+    def column_position(self, qual_col_name):
+        position = self._positions.get(qual_col_name.key)
+        if position is None:
+            position = find_column(self.column_names, qual_col_name)
+            self._positions[qual_col_name.key] = position
+        return position
+
+    def copy(self):
+        table = Table(self.name, self.column_name_type_pairs)
+        table.column_names = self.column_names
+        table.columns = [column.copy() for column in self.columns]
+        table.row_count = self.row_count
+        table.default_values = self.default_values
+        table.default_row = self.default_row
+        table.indexes = {index_name: index.copy()
+                         for index_name, index in self.indexes.items()}
+        table._positions = self._positions
+        table.modifications = self.modifications
+        table.version = self.version
+        table.statistics = dict(self.statistics)
+        table._sorted = dict(self._sorted)
+        return table
+
+    def snapshot(self):
+        """
+        Returns this table as it is now, to write to the database file:
+        its index definitions without the indexes, and its columns frozen
+        (see ColumnVector.freeze) or left on disk, if they were never read.
+        """
+        table = Table(self.name, self.column_name_type_pairs)
+        table.column_names = self.column_names
+        table.columns = [column.freeze() if column.source is None
+                         else ColumnVector.mapped(column.column_type,
+                                                  column.source)
+                         for column in self.columns]
+        table.row_count = self.row_count
+        table.default_values = self.default_values
+        table.default_row = self.default_row
+        del table.indexes
+        table.pending_indexes = self.index_positions()
+        table._positions = self._positions
+        return table
+
+    def schema(self):
+        """
+        Returns the column names and types and the default values (by
+        column position), as new_table takes them.
+        """
+        return [[[column_name.col_name, column_type]
+                 for column_name, column_type in zip(self.column_names,
+                                                     self.column_types)],
+                [[self.column_position(qual_col_name), value]
+                 for qual_col_name, value in self.default_values.items()]]
+
+    def row(self, row_id):
+        return [column[row_id] for column in self.columns]
+
+    def create_index(self, index_name, qual_col_name):
+        position = self.column_position(qual_col_name)
+        index = Index(index_name, self.column_names[position])
+        index.build(self.columns[position])
+        self.indexes[index_name] = index
+
+    def __getattr__(self, name):
+        # The indexes of a table read from the database file are built
+        # the first time they are needed.
+        if name != "indexes":
+            raise AttributeError(name)
+        with _LOAD_LOCK:
+            if "pending_indexes" in self.__dict__:
+                indexes = {}
+                for index_name, position in self.pending_indexes:
+                    index = Index(index_name, self.column_names[position])
+                    index.build(self.columns[position])
+                    indexes[index_name] = index
+                self.indexes = indexes
+                del self.pending_indexes
+            elif "indexes" not in self.__dict__:
+                raise AttributeError(name)
+        return self.__dict__["indexes"]
+
+    def index_names(self):
+        pending = self.__dict__.get("pending_indexes")
+        if pending is not None:
+            return [index_name for index_name, _ in pending]
+        return list(self.indexes)
+
+    def index_positions(self):
+        """
+        Returns (index name, column position) pairs without building any
+        index that is still pending.
+        """
+        pending = self.__dict__.get("pending_indexes")
+        if pending is not None:
+            return list(pending)
+        return [(index_name, self.column_position(index.column_name))
+                for index_name, index in self.indexes.items()]
+
+    def drop_index(self, index_name):
+        del self.indexes[index_name]
+
+    def _indexes_on(self, position):
+        return [index for index in self.indexes.values()
+                if self.column_position(index.column_name) == position]
+
+    def _rebuild_indexes(self):
+        for index in self.indexes.values():
+            index.build(self.columns[self.column_position(index.column_name)])
+
+    def scan(self, row_ids=None, positions=None):
+        """
+        Yields every row as a tuple, or only the rows in row_ids, holding
+        only the columns at positions if given.
+        """
+        columns = self.columns
+        if positions is not None:
+            columns = [columns[position] for position in positions]
+            if not columns:
+                return itertools.repeat((), self.row_count if row_ids is None
+                                        else len(row_ids))
+        if row_ids is None:
+            return zip(*columns)
+        return zip(*(column.take(row_ids) for column in columns))
+
+    def column_names_at(self, positions):
+        if positions is None:
+            return self.column_names
+        return tuple(self.column_names[position] for position in positions)
+
+    def positions_of(self, qual_col_names):
+        """
+        Returns the sorted positions of the columns in qual_col_names, or
+        None for every column: if qual_col_names is None or covers them.
+        """
+        if qual_col_names is None:
+            return None
+        positions = sorted({self.column_position(qual_col_name)
+                            for qual_col_name in qual_col_names})
+        if len(positions) == len(self.columns):
+            return None
+        return positions
+
+    def _append_row(self, values):
+        row_id = self.row_count
+        # Pending indexes are built before the new row is in the columns.
+        indexes = self.indexes
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.row_count += 1
+        self.modifications += 1
+        self.version = next(_TABLE_VERSIONS)
+        for index in indexes.values():
+            index.add(self.columns[self.column_position(index.column_name)]
+                      [row_id], row_id)
+
+    def append_columns(self, columns):
+        """
+        Appends a block of rows given as the values of every column.
+        """
+        if not columns or not columns[0]:
+            return
+        first_row = self.row_count
+        # Pending indexes are built before the new rows are in the columns.
+        indexes = self.indexes
+        for column, values in zip(self.columns, columns):
+            column.extend(values)
+        self.row_count += len(columns[0])
+        self.modifications += len(columns[0])
+        self.version = next(_TABLE_VERSIONS)
+        for index in indexes.values():
+            column = self.columns[self.column_position(index.column_name)]
+            index.extend(column.slice(first_row, self.row_count), first_row)
+
+    def insert_many(self, rows, qual_col_names=None):
+        """
+        Appends rows, each holding the values of qual_col_names (every
+        column, in order, by default; the others take their defaults),
+        as one block. Nothing is appended if a row has the wrong number
+        of values.
+        """
+        width = len(qual_col_names) if qual_col_names else len(self.columns)
+        lengths = set(map(len, rows))
+        assert lengths <= {width}, \
+            "Expected {} values, got {}".format(width,
+                                                sorted(lengths - {width}))
+        if not qual_col_names:
+            self.append_columns(list(zip(*rows)))
+            return
+        columns = [[default] * len(rows) for default in self.default_row]
+        for qual_col_name, values in zip(qual_col_names, zip(*rows)):
+            columns[self.column_position(qual_col_name)] = values
+        self.append_columns(columns)
+
+    def rows_between(self, start, stop):
+        return list(zip(*(column.slice(start, stop)
+                          for column in self.columns)))
+
+    def insert_new_row(self, row_contents, qual_col_names=None):
+        if not qual_col_names:
+            assert len(self.columns) == len(row_contents)
+            self._append_row(row_contents)
+            return
+        assert len(qual_col_names) == len(row_contents)
+        values = list(self.default_row)
+        for qual_col_name, value in zip(qual_col_names, row_contents):
+            values[self.column_position(qual_col_name)] = value
+        self._append_row(values)
+
+    def insert_new_default_row(self):
+        self._append_row(self.default_row)
+
+    def update(self, update_clauses, where_clause, executor=None):
+        """
+        Returns the ids of the rows it changed.
+        """
+        row_ids = self.where_row_ids(where_clause, executor)
+        if row_ids is None:
+            row_ids = range(self.row_count)
+        self.update_rows(row_ids,
+                         [(self.column_position(update_clause.col_name),
+                           update_clause.constant)
+                          for update_clause in update_clauses])
+        return row_ids
+
+    def update_rows(self, row_ids, assignments):
+        """
+        Sets the column at each position in assignments to its value in
+        the rows row_ids.
+        """
+        self.modifications += len(row_ids) * len(assignments)
+        self.version = next(_TABLE_VERSIONS)
+        for position, value in assignments:
+            column = self.columns[position]
+            indexes = self._indexes_on(position)
+            if len(row_ids) > self.row_count // 4:
+                # Cheaper to rebuild than to move every entry.
+                for row_id in row_ids:
+                    column[row_id] = value
+                for index in indexes:
+                    index.build(column)
+                continue
+            for row_id in row_ids:
+                old_value = column[row_id]
+                column[row_id] = value
+                for index in indexes:
+                    index.remove(old_value, row_id)
+                    index.add(column[row_id], row_id)
+
+    def delete(self, where_clause, executor=None):
+        """
+        Returns the ids of the rows it removed, or None if it removed
+        every row.
+        """
+        row_ids = self.where_row_ids(where_clause, executor)
+        self.delete_rows(row_ids)
+        return row_ids
+
+    def delete_rows(self, row_ids):
+        """
+        Removes the rows row_ids (sorted), or every row if row_ids is None.
+        """
+        if row_ids is None:
+            for column in self.columns:
+                column.clear()
+            self.modifications += self.row_count
+            self.version = next(_TABLE_VERSIONS)
+            self.row_count = 0
+            self._rebuild_indexes()
+            return
+        if not row_ids:
+            return
+        self.modifications += len(row_ids)
+        self.version = next(_TABLE_VERSIONS)
+        # Rebuilding is cheaper than moving most entries of the indexes.
+        rebuild = len(row_ids) > self.row_count // 4
+        removed = []
+        if not rebuild:
+            removed = [(index, self.columns[self.column_position(
+                index.column_name)].take(row_ids))
+                for index in self.indexes.values()]
+        if len(row_ids) <= FEW_ROWS:
+            for column in self.columns:
+                column.remove(row_ids)
+        else:
+            keep = bytearray(b"\x01") * self.row_count
+            for row_id in row_ids:
+                keep[row_id] = 0
+            for column in self.columns:
+                column.keep(keep)
+        self.row_count -= len(row_ids)
+        if rebuild:
+            self._rebuild_indexes()
+        for index, values in removed:
+            index.remove_rows(row_ids, values)
+
+    def set_default(self, default_values):
+        self.default_values = default_values
+        self.default_row = [None] * len(self.columns)
+        for qual_col_name, value in default_values.items():
+            self.default_row[self.column_position(qual_col_name)] = value
+
+    def analyze(self):
+        """
+        Gathers fresh statistics on every column.
+        """
+        self.statistics = {position: (self.modifications,
+                                      analyze_column(column))
+                           for position, column in enumerate(self.columns)}
+
+    def column_statistics(self, position):
+        """
+        Returns the statistics on a column, or None if the table was
+        never analyzed. Once too many rows have changed since they were
+        gathered they are gathered again.
+        """
+        entry = self.statistics.get(position)
+        if entry is None:
+            return None
+        if self.modifications - entry[0] > STALE_STATISTICS * self.row_count:
+            entry = self.statistics[position] = (
+                self.modifications, analyze_column(self.columns[position]))
+        return entry[1]
+
+    def column_sorted(self, position):
+        """
+        True if the non-NULL values of a column never decrease. The
+        answer holds until the table next changes.
+        """
+        entry = self._sorted.get(position)
+        if entry is None or entry[0] != self.modifications:
+            entry = self._sorted[position] = (
+                self.modifications, values_sorted(self.columns[position]))
+        return entry[1]
+
+    def selectivity(self, condition):
+        """
+        Returns the estimated fraction of rows matching condition.
+        """
+        return estimate_selectivity(condition, self._leaf_selectivity)
+
+    def _leaf_selectivity(self, condition):
+        if type(condition) not in _INDEXED_CONDITIONS or not self.row_count:
+            return None
+        position = self.column_position(condition.col_name)
+        for index in self._indexes_on(position):
+            matches = index.estimate(condition, self.row_count)
+            if matches is not None:
+                return matches / self.row_count
+        statistics = self.column_statistics(position)
+        if statistics is None:
+            return None
+        return statistics.selectivity(condition)
+
+    def rows_per_value(self, position):
+        """
+        Returns the estimated number of rows holding each non-NULL value
+        of a column (1 if nothing is known about it).
+        """
+        for index in self._indexes_on(position):
+            return index.values_per_key(self.row_count)
+        statistics = self.column_statistics(position)
+        if statistics is None or not statistics.distinct:
+            return 1.0
+        return (statistics.row_count - statistics.nulls) / statistics.distinct
+
+    def access_path(self, where_clause, positions=None):
+        """
+        Chooses how to find the rows matching where_clause: a full scan,
+        or an index on one of the conditions it ANDs together, whichever
+        is estimated to cost less. The rest of where_clause is left as
+        the residual to check on the rows found.
+        """
+        row_count = float(self.row_count)
+        best_cost = row_count * SCAN_ROW_COST
+        best = None
+        conditions = conjuncts(where_clause)
+        for condition in conditions:
+            if type(condition) not in _INDEXED_CONDITIONS:
+                continue
+            position = self.column_position(condition.col_name)
+            for index in self._indexes_on(position):
+                matches = index.estimate(condition, self.row_count)
+                if matches is None:
+                    continue
+                cost = matches * INDEX_ROW_COST + math.log2(row_count + 1)
+                if (type(condition) is WhereClause and
+                        condition.operator in {"!=", "IS NOT"}):
+                    # The lookup walks a mask over every row.
+                    cost += row_count * SCAN_ROW_COST / 2
+                if cost < best_cost:
+                    best_cost = cost
+                    best = (index, condition, matches)
+        if best is None:
+            return AccessPath(self.name, None, None, where_clause, positions,
+                              row_count * self.selectivity(where_clause),
+                              best_cost)
+        index, condition, matches = best
+        residual = conjunction([other for other in conditions
+                                if other is not condition])
+        return AccessPath(self.name, index.name, condition, residual,
+                          positions, matches * self.selectivity(residual),
+                          best_cost)
+
+    def _lookup(self, path):
+        """
+        Returns the sorted ids of the rows path's index finds (None for
+        every row) and the residual condition left to check on them.
+        """
+        if path.index_name is None:
+            return None, path.residual
+        row_ids = self.indexes[path.index_name].lookup(path.condition,
+                                                       self.row_count)
+        if row_ids is None:
+            return None, conjunction([path.condition] +
+                                     conjuncts(path.residual))
+        return row_ids, path.residual
+
+    def path_row_ids(self, path, executor=None):
+        """
+        Returns the sorted ids of the rows path finds, or None for every
+        row. Only the columns the residual condition reads are pulled
+        through its predicate, and only for the rows the index leaves.
+        executor, if given, checks the rows of a large full scan morsel
+        by morsel.
+        """
+        row_ids, residual = self._lookup(path)
+        profile = current_profile()
+        if profile is not None:
+            profile.rows_examined += (self.row_count if row_ids is None
+                                      else len(row_ids))
+        if not residual:
+            return row_ids
+        names = expression_columns(residual)
+        positions = [self.column_position(name) for name in names]
+        if (row_ids is None and executor is not None and
+                self.row_count > MORSEL_ROWS):
+            return list(itertools.chain.from_iterable(self.morsels(
+                executor, positions, match_morsel, names, residual)))
+        columns = [self.columns[position] for position in positions]
+        if row_ids is None:
+            row_ids = range(self.row_count)
+            values = zip(*columns)
+        else:
+            values = zip(*(column.take(row_ids) for column in columns))
+        predicate = compile_predicate(residual, names)
+        return list(itertools.compress(row_ids, map(predicate, values)))
+
+    def read(self, path):
+        """
+        Returns the column names and the rows path finds, holding only
+        path's columns. The compiled residual predicate checks rows as
+        they are pulled.
+        """
+        row_ids, residual = self._lookup(path)
+        column_names = self.column_names_at(path.positions)
+        rows = self.scan(row_ids, path.positions)
+        profile = current_profile()
+        if profile is not None:
+            rows = profile.timed(rows, "scan", examined=True)
+        if residual:
+            rows = filter(compile_predicate(residual, column_names), rows)
+            if profile is not None:
+                rows = profile.timed(rows, "scan")
+        return column_names, rows
+
+    def where_row_ids(self, where_clause, executor=None):
+        """
+        Returns the sorted ids of the rows matching where_clause, or None
+        if there is no where_clause.
+        """
+        if not where_clause:
+            return None
+        profile = current_profile()
+        if profile is None:
+            return self.path_row_ids(self.access_path(where_clause), executor)
+        started = profile.begin()
+        row_ids = self.path_row_ids(self.access_path(where_clause), executor)
+        profile.end("scan", started)
+        return row_ids
+
+    def morsels(self, executor, positions, worker, *arguments):
+        """
+        Splits the rows into morsels of MORSEL_ROWS and returns, in row
+        order, the results of worker(columns, start, stop, *arguments)
+        run on executor for each, columns being the morsel's values of
+        the columns at positions (None for all of them).
+        """
+        columns = self.columns
+        if positions is not None:
+            columns = [columns[position] for position in positions]
+        results = []
+        pending = deque()
+        for start in range(0, self.row_count, MORSEL_ROWS):
+            if len(pending) == MORSELS_IN_FLIGHT:
+                results.append(pending.popleft().result())
+            stop = min(start + MORSEL_ROWS, self.row_count)
+            pending.append(executor.submit(
+                worker, [column.slice(start, stop) for column in columns],
+                start, stop, *arguments))
+        results.extend(future.result() for future in pending)
+        return results
+
+
+class MaterializedView:
+    """
+    The cached result of a materialized view's query, shared by every
+    connection. A view that only filters and projects one table keeps an
+    entry per row of it (the projected row, or None if the row does not
+    match) and follows each insert, update and delete row by row. Any
+    other view is recomputed by the next read after its tables change.
+    entries is None while the view is out of date.
+    """
+
+    def __init__(self, name, select, tokens):
+        self.name = name
+        self.select = select
+        self.tokens = tokens
+        self.table_names = set(select.from_join_clause[:2]) - {None}
+        self.incremental = (select.from_join_clause.right_table_name is None
+                            and not any(select.aggregates)
+                            and not select.group_by_columns
+                            and not select.is_distinct
+                            and not select.order_by_columns
+                            and select.limit is None and not select.offset)
+        self.entries = None
+        self.project = None
+        self.predicate = None
+
+    def copy(self):
+        view = MaterializedView(self.name, self.select, self.tokens)
+        if self.entries is not None:
+            view.entries = list(self.entries)
+        view.project = self.project
+        view.predicate = self.predicate
+        return view
+
+    def rows(self):
+        if not self.incremental:
+            return iter(self.entries)
+        return (entry for entry in self.entries if entry is not None)
+
+    def refresh(self, database, run_select):
+        """
+        Recomputes the view from database, through run_select unless it
+        can be maintained row by row.
+        """
+        if not self.incremental:
+            self.entries = list(run_select())
+            return
+        table = database.tables[self.select.from_join_clause.left_table_name]
+        positions = []
+        for col in self.select.output_columns:
+            if col.col_name == "*":
+                positions.extend(range(len(table.column_names)))
+            else:
+                positions.append(find_column(table.column_names, col))
+        if len(positions) == 1:
+            position = positions[0]
+            self.project = lambda row: (row[position],)
+        else:
+            self.project = itemgetter(*positions)
+        if self.select.where_clause:
+            self.predicate = compile_predicate(self.select.where_clause,
+                                               table.column_names)
+        self.entries = [self._entry(row) for row in table.scan()]
+
+    def _entry(self, row):
+        if self.predicate is not None and not self.predicate(row):
+            return None
+        return self.project(row)
+
+    def apply(self, table, change, row_ids):
+        """
+        Follows a change to table: "insert" of row_ids (None meaning its
+        last row), or "update" or "delete" of row_ids (None meaning every
+        row).
+        """
+        if self.entries is None:
+            return
+        if not self.incremental:
+            self.entries = None
+        elif change == "insert":
+            if row_ids is None:
+                row_ids = [table.row_count - 1]
+            self.entries.extend(self._entry(table.row(row_id))
+                                for row_id in row_ids)
+        elif change == "update":
+            for row_id in row_ids:
+                self.entries[row_id] = self._entry(table.row(row_id))
+        elif row_ids is None:
+            self.entries = []
+        elif row_ids:
+            keep = bytearray(b"\x01") * len(self.entries)
+            for row_id in row_ids:
+                keep[row_id] = 0
+            self.entries = list(itertools.compress(self.entries, keep))
+
+
+PAGE_SIZE = 4096
+_FILE_MAGIC = b"PYDBFILE"
+_FILE_HEADER = struct.Struct("<8sIQQ")
+
+
+class MappedColumn(namedtuple("MappedColumn", ["mapping", "encoding",
+                                               "extents"])):
+    """
+    Where one column's data sits in a mapped database file: its encoding
+    and the (first page, byte length) extent of each of its segments.
+    """
+
+    def read_segments(self):
+        return [read_extent(self.mapping, page, length)
+                for page, length in self.extents]
+
+
+def read_extent(mapping, page, length):
+    start = page * PAGE_SIZE
+    return mapping[start:start + length]
+
+
+def write_extent(file, data):
+    """
+    Writes data at the next page boundary of file and returns its extent.
+    """
+    page = file.tell() // PAGE_SIZE
+    file.write(data)
+    file.write(bytes(-len(data) % PAGE_SIZE))
+    return [page, len(data)]
+
+
+def copy_rows(values, row_count):
+    """
+    Returns a copy of the first row_count entries of values (a list,
+    array or bytearray), CHECKPOINT_COPY_ROWS at a time.
+    """
+    rows = values[:0]
+    for start in range(0, row_count, CHECKPOINT_COPY_ROWS):
+        rows += values[start:min(start + CHECKPOINT_COPY_ROWS, row_count)]
+    return rows
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def encode_column(column):
+    """
+    Returns the encoding of column and its data as a list of segments.
+    Typed columns are written as their raw little-endian arrays (and null
+    map, if there are NULLs); a TEXT column as its string lengths, -1 for
+    NULL, and one UTF-8 blob; anything else as JSON.
+    """
+    if column.typecode:
+        encoding = "int64" if column.typecode == "q" else "float64"
+        segments = [_little_endian(column.values).tobytes()]
+        if column.null_count:
+            segments.append(bytes(column.nulls))
+        return encoding, segments
+    if all(value is None or type(value) is str for value in column.values):
+        lengths = array("q", [-1 if value is None else len(value)
+                              for value in column.values])
+        text = "".join(value for value in column.values if value is not None)
+        return "text", [_little_endian(lengths).tobytes(),
+                        text.encode("utf-8", "surrogatepass")]
+    return "json", [json.dumps(column.values).encode("utf-8")]
+
+
+def decode_column(column, encoding, segments):
+    """
+    Fills in the data of column from segments written by encode_column.
+    """
+    column.nulls = None
+    column.null_count = 0
+    if encoding in {"int64", "float64"}:
+        column.typecode = "q" if encoding == "int64" else "d"
+        column.values = array(column.typecode)
+        column.values.frombytes(segments[0])
+        column.values = _little_endian(column.values)
+        if len(segments) > 1:
+            column.nulls = bytearray(segments[1])
+            column.null_count = column.nulls.count(1)
+        else:
+            column.nulls = bytearray(len(column.values))
+        return
+    column.typecode = None
+    if encoding == "json":
+        column.values = json.loads(segments[0].decode("utf-8"))
+        return
+    lengths = _little_endian(array("q", segments[0]))
+    text = segments[1].decode("utf-8", "surrogatepass")
+    column.values = values = []
+    start = 0
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(sys.intern(text[start:start + length]))
+            start += length
+
+
+def write_table(file, table):
+    """
+    Writes the columns of table to file and returns its catalog entry.
+    """
+    columns = []
+    for column_name, column_type, column in zip(table.column_names,
+                                                table.column_types,
+                                                table.columns):
+        if column.source is not None:
+            # Never read since the file was mapped: copy its pages as is.
+            encoding = column.source.encoding
+            segments = column.source.read_segments()
+        else:
+            encoding, segments = encode_column(column)
+        columns.append({"name": column_name.col_name,
+                        "type": column_type,
+                        "encoding": encoding,
+                        "extents": [write_extent(file, segment)
+                                    for segment in segments]})
+    return {"name": table.name,
+            "row_count": table.row_count,
+            "columns": columns,
+            "defaults": [[table.column_position(qual_col_name), value]
+                         for qual_col_name, value
+                         in table.default_values.items()],
+            "indexes": table.index_positions()}
+
+
+def new_table(table_name, columns, defaults):
+    """
+    Makes an empty table from a schema as Table.schema returns it.
+    """
+    table = Table(table_name,
+                  [(QualifiedColumnName(column_name, table_name), column_type)
+                   for column_name, column_type in columns])
+    table.set_default({table.column_names[position]: value
+                       for position, value in defaults})
+    return table
+
+
+def load_table(entry, mapping):
+    table = new_table(entry["name"],
+                      [[column["name"], column["type"]]
+                       for column in entry["columns"]],
+                      entry["defaults"])
+    table.columns = [ColumnVector.mapped(column["type"],
+                                         MappedColumn(mapping,
+                                                      column["encoding"],
+                                                      column["extents"]))
+                     for column in entry["columns"]]
+    table.row_count = entry["row_count"]
+    del table.indexes
+    table.pending_indexes = [(index_name, position)
+                             for index_name, position in entry["indexes"]]
+    return table
+
+
+def write_database(tables, view_tokens, path, wal_generation):
+    """
+    Writes tables to the file at path, on disk when this returns, and
+    returns its catalog; a checkpoint then renames it over the database
+    file (see Database.replace_file), so that is always either the old
+    database or the new one. Page 0 holds the header; each column
+    segment starts on a page of its own and the catalog (JSON) comes
+    last. The catalog also holds the materialized view definitions
+    (view_tokens, the tokens of each one's SELECT) and wal_generation,
+    the last log segment whose changes the tables include.
+    """
+    with open(path, "wb") as file:
+        file.write(bytes(PAGE_SIZE))
+        catalog = {"tables": [write_table(file, table)
+                              for table in tables.values()],
+                   "views": view_tokens,
+                   "wal_generation": wal_generation}
+        catalog_page, catalog_length = write_extent(
+            file, json.dumps(catalog).encode("utf-8"))
+        file.seek(0)
+        file.write(_FILE_HEADER.pack(_FILE_MAGIC, PAGE_SIZE, catalog_page,
+                                     catalog_length))
+        file.flush()
+        os.fsync(file.fileno())
+    return catalog
+
+
+def read_database(path):
+    """
+    Maps the database file at path and returns its tables, its
+    materialized view definitions, the log generation they include and
+    the mapping. Only the header and catalog are read here; each column
+    is read from the mapping the first time it is used.
+    """
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, page_size, catalog_page, catalog_length = \
+        _FILE_HEADER.unpack_from(mapping)
+    assert magic == _FILE_MAGIC, "{} is not a database file".format(path)
+    assert page_size == PAGE_SIZE
+    catalog = json.loads(read_extent(mapping, catalog_page,
+                                     catalog_length).decode("utf-8"))
+    tables = {entry["name"]: load_table(entry, mapping)
+              for entry in catalog["tables"]}
+    return tables, catalog["views"], catalog["wal_generation"], mapping
+
+
+WAL_CHECKPOINT_SIZE = 4 * 1024 * 1024
+_WAL_RECORD = struct.Struct("<II")
+
+
+def wal_path(path, generation):
+    return "{}-wal{}".format(path, generation)
+
+
+def read_log(path):
+    """
+    Returns the records of a log segment (each a list of effects) and
+    the offset just past the last whole one.
+    """
+    if not os.path.exists(path):
+        return [], 0
+    with open(path, "rb") as file:
+        data = file.read()
+    records = []
+    end = 0
+    while end + _WAL_RECORD.size <= len(data):
+        length, checksum = _WAL_RECORD.unpack_from(data, end)
+        start = end + _WAL_RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(json.loads(payload.decode("utf-8")))
+        end = start + length
+    return records, end
+
+
+class WriteAheadLog:
+    """
+    The log of committed changes since the last checkpoint, appended to
+    a segment file named by its generation. Each commit is one record: a
+    length and CRC-32 header and the JSON list of its effects. Committers
+    that wait for the disk while another one's fsync is running are all
+    covered by the next fsync (group commit). A segment is only opened
+    (and created) by the first record written to it.
+    """
+
+    def __init__(self, path, generation):
+        self.path = path
+        self.generation = generation
+        self.file = None
+        self.size = 0
+        if os.path.exists(wal_path(path, generation)):
+            self.size = os.path.getsize(wal_path(path, generation))
+        self.condition = threading.Condition()
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+
+    def write(self, effects):
+        """
+        Appends one commit record and returns its log sequence number.
+        """
+        payload = json.dumps(effects).encode("utf-8")
+        with self.condition:
+            if self.file is None:
+                self.file = open(wal_path(self.path, self.generation), "ab")
+            self.file.write(_WAL_RECORD.pack(len(payload),
+                                             zlib.crc32(payload)))
+            self.file.write(payload)
+            self.size += _WAL_RECORD.size + len(payload)
+            self.written += 1
+            return self.written
+
+    def sync(self, lsn):
+        """
+        Returns once the record lsn is on disk.
+        """
+        with self.condition:
+            while self.synced < lsn:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+                self.syncing = True
+                target = self.written
+                self.file.flush()
+                file = self.file
+                self.condition.release()
+                try:
+                    os.fsync(file.fileno())
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                self.synced = max(self.synced, target)
+
+    def rotate(self):
+        """
+        Closes the current segment, once it is on disk, and starts the
+        next one. Returns the generation of the closed segment.
+        """
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+            self.synced = self.written
+            self.condition.notify_all()
+            self.generation += 1
+            self.size = 0
+            return self.generation - 1
+
+    def close(self):
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+            if self.file is not None:
+                self.file.close()
+
+
+def pop_and_check(tokens, same_as):
+    item = tokens.popleft()
+    assert item == same_as, "{} != {}".format(item, same_as)
+
+
+def bind(value, parameters):
+    """
+    Returns the bound value for a ? placeholder, or value itself.
+    """
+    if isinstance(value, Parameter):
+        return parameters[value.index]
+    return value
+
+
+def bind_where(where_clause, parameters):
+    """
+    Returns where_clause (any WHERE expression) with the values of its
+    ? placeholders filled in.
+    """
+    if where_clause is None or not parameters:
+        return where_clause
+    kind = type(where_clause)
+    if kind is WhereClause:
+        return where_clause._replace(
+            constant=bind(where_clause.constant, parameters))
+    if kind is InList:
+        return where_clause._replace(values=tuple(
+            bind(value, parameters) for value in where_clause.values))
+    if kind is Between:
+        return where_clause._replace(low=bind(where_clause.low, parameters),
+                                     high=bind(where_clause.high, parameters))
+    if kind is Like:
+        return where_clause._replace(
+            pattern=bind(where_clause.pattern, parameters))
+    if kind is BooleanExpression:
+        return where_clause._replace(operands=tuple(
+            bind_where(operand, parameters)
+            for operand in where_clause.operands))
+    if kind is NotExpression:
+        return NotExpression(bind_where(where_clause.operand, parameters))
+    return where_clause
+
+
+def parse_statement(tokens):
+    """
+    Parses the tokens of one statement (without its semicolon) into a
+    statement tuple that Connection can run any number of times.
+    """
+    parsers = {
+        "CREATE": parse_create,
+        "INSERT": parse_insert,
+        "UPDATE": parse_update,
+        "DELETE": parse_delete,
+        "SELECT": parse_select,
+        "DROP": parse_drop,
+        "ROLLBACK": parse_rollback,
+        "BEGIN": parse_begin,
+        "COMMIT": parse_commit,
+        "EXPLAIN": parse_explain,
+        "ANALYZE": parse_analyze,
+        "COPY": parse_copy,
+    }
+    if tokens[0] not in parsers:
+        raise AssertionError(
+            "Unexpected first word in statements: " + str(tokens[0]))
+    return parsers[tokens[0]](tokens)
+
+
+def parse_explain(tokens):
+    pop_and_check(tokens, "EXPLAIN")
+    query_plan = tokens[0] == "QUERY"
+    if query_plan:
+        pop_and_check(tokens, "QUERY")
+        pop_and_check(tokens, "PLAN")
+    assert tokens[0] in {"SELECT", "UPDATE", "DELETE"}, tokens[0]
+    return ExplainStatement(query_plan, parse_statement(tokens))
+
+
+def parse_analyze(tokens):
+    pop_and_check(tokens, "ANALYZE")
+    if not tokens:
+        return AnalyzeStatement(None)
+    return AnalyzeStatement(tokens.popleft())
+
+
+def parse_copy(tokens):
+    """
+    COPY table [(column, ...)] FROM 'path' [FORMAT CSV | JSONL] [HEADER]
+    """
+    pop_and_check(tokens, "COPY")
+    table_name = tokens.popleft()
+    qual_col_names = None
+    if tokens[0] == "(":
+        qual_col_names = [QualifiedColumnName(col_name, table_name)
+                          for col_name in
+                          parse_comma_seperated_contents(tokens)]
+    pop_and_check(tokens, "FROM")
+    path = tokens.popleft()
+    assert isinstance(path, (QuotedText, Parameter)), path
+    format = "csv"
+    if tokens and tokens[0] == "FORMAT":
+        pop_and_check(tokens, "FORMAT")
+        format = tokens.popleft().lower()
+        assert format in {"csv", "jsonl"}, format
+    header = bool(tokens) and tokens[0] == "HEADER"
+    if header:
+        pop_and_check(tokens, "HEADER")
+    assert not tokens, "Unexpected tokens: {}".format(list(tokens))
+    return CopyStatement(table_name, qual_col_names, path, format, header)
+
+
+def parse_begin(tokens):
+    pop_and_check(tokens, "BEGIN")
+    mode = "DEFERRED"
+    if tokens[0] in {"DEFERRED", "IMMEDIATE", "EXCLUSIVE"}:
+        mode = tokens.popleft()
+    pop_and_check(tokens, "TRANSACTION")
+    return BeginStatement(mode)
+
+
+def parse_commit(tokens):
+    pop_and_check(tokens, "COMMIT")
+    pop_and_check(tokens, "TRANSACTION")
+    return CommitStatement()
+
+
+def parse_rollback(tokens):
+    pop_and_check(tokens, "ROLLBACK")
+    pop_and_check(tokens, "TRANSACTION")
+    return RollbackStatement()
+
+
+def parse_if_not_exists(tokens):
+    if tokens[0] != "IF":
+        return False
+    pop_and_check(tokens, "IF")
+    pop_and_check(tokens, "NOT")
+    pop_and_check(tokens, "EXISTS")
+    return True
+
+
+def parse_if_exists(tokens):
+    if tokens[0] != "IF":
+        return False
+    pop_and_check(tokens, "IF")
+    pop_and_check(tokens, "EXISTS")
+    return True
+
+
+def parse_create(tokens):
+    pop_and_check(tokens, "CREATE")
+    if tokens[0] == "TABLE":
+        return parse_create_table(tokens)
+    elif tokens[0] == "INDEX":
+        return parse_create_index(tokens)
+    elif tokens[0] == "MATERIALIZED":
+        pop_and_check(tokens, "MATERIALIZED")
+        return parse_create_view(tokens, materialized=True)
+    else:
+        return parse_create_view(tokens)
+
+
+def parse_create_table(tokens):
+    """
+    Determines the name and column information from tokens.
+    """
+    pop_and_check(tokens, "TABLE")
+    notexists = parse_if_not_exists(tokens)
+    table_name = tokens.popleft()
+    pop_and_check(tokens, "(")
+    column_name_type_pairs = []
+    default_values = {}
+    while True:
+        column_name = tokens.popleft()
+        qual_col_name = QualifiedColumnName(column_name, table_name)
+        column_type = tokens.popleft()
+        assert column_type in {"TEXT", "INTEGER", "REAL"}
+        column_name_type_pairs.append((qual_col_name, column_type))
+        if(tokens[0] == "DEFAULT"):
+            pop_and_check(tokens, "DEFAULT")
+            default_val = tokens.popleft()
+            default_values[qual_col_name] = default_val
+        comma_or_close = tokens.popleft()
+        if comma_or_close == ")":
+            break
+        assert comma_or_close == ','
+    return CreateTableStatement(table_name, column_name_type_pairs,
+                                notexists, default_values)
+
+
+def parse_create_index(tokens):
+    pop_and_check(tokens, "INDEX")
+    notexists = parse_if_not_exists(tokens)
+    index_name = tokens.popleft()
+    pop_and_check(tokens, "ON")
+    table_name = tokens.popleft()
+    pop_and_check(tokens, "(")
+    qual_col_name = QualifiedColumnName(tokens.popleft(), table_name)
+    pop_and_check(tokens, ")")
+    return CreateIndexStatement(index_name, table_name, qual_col_name,
+                                notexists)
+
+
+def parse_create_view(tokens, materialized=False):
+    """
+    Also keeps the tokens of the view's SELECT, which are what gets
+    written to the log and the database file.
+    """
+    pop_and_check(tokens, "VIEW")
+    view_name = tokens.popleft()
+    pop_and_check(tokens, "AS")
+    select_tokens = list(tokens)
+    assert not any(isinstance(token, Parameter) for token in select_tokens)
+    return CreateViewStatement(view_name, parse_select(tokens), materialized,
+                               select_tokens)
+
+
+def parse_drop(tokens):
+    pop_and_check(tokens, "DROP")
+    if tokens[0] == "INDEX":
+        pop_and_check(tokens, "INDEX")
+        ifexists = parse_if_exists(tokens)
+        return DropIndexStatement(tokens.popleft(), ifexists)
+    if tokens[0] in {"MATERIALIZED", "VIEW"}:
+        materialized = tokens[0] == "MATERIALIZED"
+        if materialized:
+            pop_and_check(tokens, "MATERIALIZED")
+        pop_and_check(tokens, "VIEW")
+        ifexists = parse_if_exists(tokens)
+        return DropViewStatement(tokens.popleft(), materialized, ifexists)
+    pop_and_check(tokens, "TABLE")
+    ifexists = parse_if_exists(tokens)
+    return DropTableStatement(tokens.popleft(), ifexists)
+
+
+def parse_comma_seperated_contents(tokens):
+    contents = []
+    pop_and_check(tokens, "(")
+    while True:
+        item = tokens.popleft()
+        contents.append(item)
+        comma_or_close = tokens.popleft()
+        if comma_or_close == ")":
+            return contents
+        assert comma_or_close == ',', comma_or_close
+
+
+def parse_insert(tokens):
+    """
+    Determines the table name and row values to add.
+    """
+    pop_and_check(tokens, "INSERT")
+    pop_and_check(tokens, "INTO")
+    table_name = tokens.popleft()
+    if tokens[0] == "DEFAULT":
+        pop_and_check(tokens, "DEFAULT")
+        pop_and_check(tokens, "VALUES")
+        return InsertStatement(table_name, None, None)
+    if tokens[0] == "(":
+        col_names = parse_comma_seperated_contents(tokens)
+        qual_col_names = [QualifiedColumnName(col_name, table_name)
+                          for col_name in col_names]
+    else:
+        qual_col_names = None
+    pop_and_check(tokens, "VALUES")
+    rows = []
+    while tokens:
+        row_contents = parse_comma_seperated_contents(tokens)
+        if qual_col_names:
+            assert len(row_contents) == len(qual_col_names)
+        rows.append(row_contents)
+        if tokens:
+            pop_and_check(tokens, ",")
+    return InsertStatement(table_name, qual_col_names, rows)
+
+
+def parse_qualified_column_name(tokens):
+    """
+    Consumes the tokens of a possibly table-qualified column name
+    and returns a QualifiedColumnName.
+    """
+    possible_col_name = tokens.popleft()
+    if tokens and tokens[0] == '.':
+        tokens.popleft()
+        actual_col_name = tokens.popleft()
+        table_name = possible_col_name
+        return QualifiedColumnName(actual_col_name, table_name)
+    return QualifiedColumnName(possible_col_name)
+
+
+def parse_update(tokens):
+    pop_and_check(tokens, "UPDATE")
+    table_name = tokens.popleft()
+    pop_and_check(tokens, "SET")
+    update_clauses = []
+    while tokens:
+        qual_name = parse_qualified_column_name(tokens)
+        if not qual_name.table_name:
+            qual_name = QualifiedColumnName(qual_name.col_name, table_name)
+        pop_and_check(tokens, '=')
+        constant = tokens.popleft()
+        update_clause = UpdateClause(qual_name, constant)
+        update_clauses.append(update_clause)
+        if tokens:
+            if tokens[0] == ',':
+                tokens.popleft()
+                continue
+            elif tokens[0] == "WHERE":
+                break
+
+    where_clause = parse_where_clause(tokens, table_name)
+    return UpdateStatement(table_name, update_clauses, where_clause)
+
+
+def parse_delete(tokens):
+    pop_and_check(tokens, "DELETE")
+    pop_and_check(tokens, "FROM")
+    table_name = tokens.popleft()
+    where_clause = parse_where_clause(tokens, table_name)
+    return DeleteStatement(table_name, where_clause)
+
+
+_FLIPPED_OPERATORS = {">": "<", "<": ">", ">=": "<=", "<=": ">=",
+                      "=": "=", "!=": "!="}
+
+
+def parse_comparison_operator(tokens):
+    found_operator = tokens.popleft()
+    assert found_operator in _FLIPPED_OPERATORS or found_operator == "IS"
+    if found_operator == "IS" and tokens[0] == "NOT":
+        tokens.popleft()
+        found_operator += " NOT"
+    return found_operator
+
+
+def check_comparison(operator, constant):
+    if constant is None:
+        assert operator in {"IS", "IS NOT"}
+    if operator in {"IS", "IS NOT"}:
+        assert constant is None
+
+
+def parse_comparison(tokens, subject):
+    """
+    Consumes "op constant" and returns a WhereClause comparing subject.
+    """
+    found_operator = parse_comparison_operator(tokens)
+    constant = tokens.popleft()
+    check_comparison(found_operator, constant)
+    return WhereClause(subject, found_operator, constant)
+
+
+def parse_where_clause(tokens, table_name):
+    if not tokens or tokens[0] != "WHERE":
+        return None
+    tokens.popleft()
+    return parse_expression(tokens, table_name)
+
+
+def parse_expression(tokens, table_name):
+    """
+    Consumes a boolean expression: predicates combined with NOT, AND and
+    OR (binding in that order) and parentheses.
+    """
+    operands = [parse_conjunction(tokens, table_name)]
+    while tokens and tokens[0] == "OR":
+        tokens.popleft()
+        operands.append(parse_conjunction(tokens, table_name))
+    if len(operands) == 1:
+        return operands[0]
+    return BooleanExpression("OR", tuple(operands))
+
+
+def parse_conjunction(tokens, table_name):
+    operands = [parse_negation(tokens, table_name)]
+    while tokens and tokens[0] == "AND":
+        tokens.popleft()
+        operands.append(parse_negation(tokens, table_name))
+    if len(operands) == 1:
+        return operands[0]
+    return BooleanExpression("AND", tuple(operands))
+
+
+def parse_negation(tokens, table_name):
+    if tokens[0] == "NOT":
+        tokens.popleft()
+        return NotExpression(parse_negation(tokens, table_name))
+    if tokens[0] == "(":
+        tokens.popleft()
+        expression = parse_expression(tokens, table_name)
+        pop_and_check(tokens, ")")
+        return expression
+    return parse_predicate(tokens, table_name)
+
+
+def parse_operand(tokens, table_name):
+    """
+    Consumes a column name (given table_name if it has no table) or a
+    constant.
+    """
+    if type(tokens[0]) is not str:
+        return tokens.popleft()
+    qual_col_name = parse_qualified_column_name(tokens)
+    if not qual_col_name.table_name:
+        qual_col_name = QualifiedColumnName(qual_col_name.col_name,
+                                            table_name)
+    return qual_col_name
+
+
+def parse_predicate(tokens, table_name):
+    """
+    Consumes one comparison, [NOT] IN (...), [NOT] BETWEEN ... AND ...
+    or [NOT] LIKE pattern. A comparison with the constant first is turned
+    around so that the column always comes first.
+    """
+    subject = parse_operand(tokens, table_name)
+    negated = tokens[0] == "NOT"
+    if negated:
+        tokens.popleft()
+        assert tokens[0] in {"IN", "BETWEEN", "LIKE"}
+    if tokens[0] in {"IN", "BETWEEN", "LIKE"}:
+        assert isinstance(subject, QualifiedColumnName)
+        keyword = tokens.popleft()
+        if keyword == "IN":
+            values = parse_comma_seperated_contents(tokens)
+            return InList(subject, tuple(values), negated)
+        if keyword == "BETWEEN":
+            low = tokens.popleft()
+            pop_and_check(tokens, "AND")
+            return Between(subject, low, tokens.popleft(), negated)
+        return Like(subject, tokens.popleft(), negated)
+    found_operator = parse_comparison_operator(tokens)
+    other = parse_operand(tokens, table_name)
+    if isinstance(subject, QualifiedColumnName):
+        if isinstance(other, QualifiedColumnName):
+            assert found_operator in _FLIPPED_OPERATORS
+            return ColumnComparison(subject, found_operator, other)
+        check_comparison(found_operator, other)
+        return WhereClause(subject, found_operator, other)
+    assert isinstance(other, QualifiedColumnName)
+    check_comparison(found_operator, subject)
+    return WhereClause(other, _FLIPPED_OPERATORS[found_operator], subject)
+
+
+def is_aggregate_call(tokens):
+    return (isinstance(tokens[0], str) and len(tokens) > 1 and
+            tokens[1] == "(" and tokens[0].lower() in AGGREGATE_FUNCTIONS)
+
+
+def parse_aggregate(tokens):
+    """
+    Consumes "function ( column )" or "count ( * )".
+    """
+    function = tokens.popleft().lower()
+    pop_and_check(tokens, "(")
+    qual_col_name = parse_qualified_column_name(tokens)
+    pop_and_check(tokens, ")")
+    return Aggregate(function, qual_col_name)
+
+
+def parse_from_join_clause(tokens):
+    left_table_name = tokens.popleft()
+    if not tokens or tokens[0] != "LEFT":
+        return FromJoinClause(left_table_name, None, None, None)
+    pop_and_check(tokens, "LEFT")
+    pop_and_check(tokens, "OUTER")
+    pop_and_check(tokens, "JOIN")
+    right_table_name = tokens.popleft()
+    pop_and_check(tokens, "ON")
+    left_col_name = parse_qualified_column_name(tokens)
+    pop_and_check(tokens, "=")
+    right_col_name = parse_qualified_column_name(tokens)
+    return FromJoinClause(left_table_name,
+                          right_table_name,
+                          left_col_name,
+                          right_col_name)
+
+
+def parse_select(tokens):
+    """
+    Determines the output columns, table names, where clause and
+    order_by_columns.
+    """
+    pop_and_check(tokens, "SELECT")
+    is_distinct = tokens[0] == "DISTINCT"
+    if is_distinct:
+        tokens.popleft()
+
+    output_columns = []
+    aggregates = []
+    while True:
+        if is_aggregate_call(tokens):
+            aggregate = parse_aggregate(tokens)
+            aggregates.append(aggregate.function)
+            output_columns.append(aggregate.col_name)
+        else:
+            qual_col_name = parse_qualified_column_name(tokens)
+            output_columns.append(qual_col_name)
+            aggregates.append(None)
+        comma_or_from = tokens.popleft()
+        if comma_or_from == "FROM":
+            break
+        assert comma_or_from == ','
+
+    from_join_clause = parse_from_join_clause(tokens)
+    where_clause = parse_where_clause(tokens,
+                                      from_join_clause.left_table_name)
+
+    group_by_columns = []
+    if tokens and tokens[0] == "GROUP":
+        pop_and_check(tokens, "GROUP")
+        pop_and_check(tokens, "BY")
+        group_by_columns.append(parse_qualified_column_name(tokens))
+        while tokens and tokens[0] == ",":
+            tokens.popleft()
+            group_by_columns.append(parse_qualified_column_name(tokens))
+
+    having_clause = None
+    if tokens and tokens[0] == "HAVING":
+        pop_and_check(tokens, "HAVING")
+        if is_aggregate_call(tokens):
+            subject = parse_aggregate(tokens)
+        else:
+            subject = parse_qualified_column_name(tokens)
+        having_clause = parse_comparison(tokens, subject)
+
+    order_by_columns = []
+    if tokens and tokens[0] == "ORDER":
+        pop_and_check(tokens, "ORDER")
+        pop_and_check(tokens, "BY")
+        while True:
+            qual_col_name = parse_qualified_column_name(tokens)
+            collation_name = None
+            descend = False
+            if tokens and tokens[0] == "COLLATE":
+                pop_and_check(tokens, "COLLATE")
+                collation_name = tokens.popleft()
+            if tokens and tokens[0] == "DESC":
+                pop_and_check(tokens, "DESC")
+                descend = True
+            elif tokens and tokens[0] == "ASC":
+                pop_and_check(tokens, "ASC")
+            order_by_columns.append((qual_col_name, collation_name, descend))
+            if not tokens or tokens[0] != ",":
+                break
+            pop_and_check(tokens, ",")
+
+    limit = None
+    offset = 0
+    if tokens:
+        pop_and_check(tokens, "LIMIT")
+        limit = tokens.popleft()
+        if tokens and tokens[0] == "OFFSET":
+            pop_and_check(tokens, "OFFSET")
+            offset = tokens.popleft()
+        elif tokens and tokens[0] == ",":
+            # LIMIT offset, count
+            pop_and_check(tokens, ",")
+            offset, limit = limit, tokens.popleft()
+    assert not tokens, "Unexpected tokens: {}".format(list(tokens))
+    return SelectStatement(output_columns, aggregates, is_distinct,
+                           from_join_clause, where_clause, group_by_columns,
+                           having_clause, order_by_columns, limit, offset)
+
+
+_TOKEN_PATTERN = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<word>[A-Za-z_][A-Za-z_0-9]*)
+    | (?P<number>-?[0-9]+(?P<fraction>\.[0-9]*)?)
+    | (?P<text>'(?:[^']|'')*'|"(?:[^"]|"")*")
+    | (?P<parameter>\?)
+    | (?P<symbol>!=|<>|>=|<=|[(),;*.><=])
+""", re.VERBOSE)
+
+
+def tokenize(query):
+    """
+    Splits a SQL statement into tokens in a single left-to-right pass:
+    keywords and names as strings, NULL as None, numbers (with their
+    minus sign, if any) as int or float, quoted text as QuotedText with
+    its doubled quotes collapsed, and each ? as a numbered Parameter.
+    """
+    tokens = []
+    parameter_count = 0
+    position = 0
+    match_token = _TOKEN_PATTERN.match
+    while position < len(query):
+        match = match_token(query, position)
+        if match is None:
+            raise AssertionError(
+                "Query didn't get shorter. query = {}".format(query[position:]))
+        position = match.end()
+        kind = match.lastgroup
+        if kind == "word":
+            word = match.group()
+            tokens.append(None if word == "NULL" else word)
+        elif kind == "symbol":
+            symbol = match.group()
+            tokens.append("!=" if symbol == "<>" else symbol)
+        elif kind == "number":
+            if match.group("fraction") is None:
+                tokens.append(int(match.group()))
+            else:
+                tokens.append(float(match.group()))
+        elif kind == "text":
+            text = match.group()
+            delimiter = text[0]
+            tokens.append(QuotedText(text[1:-1].replace(delimiter * 2,
+                                                        delimiter)))
+        elif kind == "parameter":
+            tokens.append(Parameter(parameter_count))
+            parameter_count += 1
+    return tokens
+
+
+def encode_tokens(tokens):
+    """
+    Returns tokens in a form JSON keeps apart: quoted text as {"text": ...}.
+    """
+    return [{"text": str(token)} if isinstance(token, QuotedText) else token
+            for token in tokens]
+
+
+def decode_tokens(encoded):
+    return [QuotedText(token["text"]) if isinstance(token, dict) else token
+            for token in encoded]
@@ -0,0 +1,73 @@
+"""
+Bulk loads: text converted to each column's type as sqlite3 converts
+it, defaults for missing columns, and all or nothing.
+"""
+import io
+import json
+import sqlite3
+
+import pytest
+
+import project
+
+CSV = """a,b,c
+12,1.5,x
+-3,7,12
+1.5,abc,
+,,
+007,1e3,  9
+"""
+
+
+@pytest.fixture
+def connection(tmp_path):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    connection.execute(
+        "CREATE TABLE t (a INTEGER, b REAL, c TEXT DEFAULT 'd');")
+    yield connection
+    project._ALL_DATABASES.close(path)
+
+
+def test_csv_values_take_their_column_types(connection):
+    expected = sqlite3.connect(":memory:")
+    expected.execute("CREATE TABLE t (a INTEGER, b REAL, c TEXT);")
+    lines = CSV.splitlines()[1:]
+    expected.executemany(
+        "INSERT INTO t VALUES (?, ?, ?);",
+        [[value or None for value in line.split(",")] for line in lines])
+    assert connection.bulk_load("t", io.StringIO(CSV), header=True) == 5
+    rows = list(connection.execute("SELECT * FROM t;"))
+    assert rows == list(expected.execute("SELECT * FROM t;"))
+    assert ([list(map(type, row)) for row in rows] ==
+            [list(map(type, row)) for row in expected.execute(
+                "SELECT * FROM t;")])
+
+
+def test_copy_from_json_lines(connection, tmp_path):
+    path = tmp_path / "rows.jsonl"
+    path.write_text("\n".join(json.dumps(record) for record in [
+        [1, 2.5, "x"], {"a": 2}, {"c": "y", "b": 3}, [None, None, None],
+    ]) + "\n")
+    connection.execute(
+        "COPY t FROM '{}' FORMAT JSONL;".format(path))
+    assert list(connection.execute("SELECT * FROM t;")) == [
+        (1, 2.5, "x"), (2, None, "d"), (None, 3.0, "y"), (None, None, None)]
+    path = tmp_path / "rows.csv"
+    path.write_text("z,5\n")
+    connection.execute("COPY t (c, a) FROM '{}';".format(path))
+    assert list(connection.execute("SELECT * FROM t WHERE a = 5;")) == [
+        (5, None, "z")]
+
+
+def test_a_failed_load_keeps_nothing(connection, monkeypatch):
+    monkeypatch.setattr(project, "BULK_LOAD_ROWS", 2)
+    lines = ["1,1,a", "2,2,b", "3,3,c", "4,4"]
+    with pytest.raises(AssertionError):
+        connection.bulk_load("t", lines)
+    assert list(connection.execute("SELECT * FROM t;")) == []
+    assert connection.bulk_load("t", lines[:3]) == 3
+    path = connection.database.path
+    project._ALL_DATABASES.close(path)
+    connection = project.connect(path)
+    assert len(list(connection.execute("SELECT * FROM t;"))) == 3
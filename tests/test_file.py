@@ -0,0 +1,111 @@
+"""
+The database file: columns left unread in the mapping survive
+checkpoints, and no mapping outlives the file it was made from.
+"""
+import threading
+
+import project
+
+
+def reopen(path):
+    project._ALL_DATABASES.close(path)
+    return project.connect(path)
+
+
+def test_checkpoint_moves_unread_columns_to_the_new_file(tmp_path):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT);")
+    connection.execute("CREATE TABLE u (c INTEGER);")
+    connection.execute("CREATE TABLE v (d REAL);")
+    for i in range(200):
+        connection.execute("INSERT INTO t VALUES (?, ?);", (i, str(i)))
+        connection.execute("INSERT INTO u VALUES (?);", (i,))
+        connection.execute("INSERT INTO v VALUES (?);", (i / 2,))
+    connection.database.checkpoint().join()
+    connection = reopen(path)
+    database = connection.database
+    first = database.mapping
+    # u is dropped while a reader still holds it; v is never read until
+    # two checkpoints later.
+    dropped = database.tables["u"]
+    connection.execute("DROP TABLE u;")
+    connection.execute("INSERT INTO t VALUES (200, '200');")
+    database.checkpoint().join()
+    second = database.mapping
+    assert first.closed and not second.closed
+    assert list(dropped.columns[0]) == list(range(200))
+    database.checkpoint().join()
+    assert second.closed
+    rows = list(connection.execute("SELECT a, b FROM t ORDER BY a;"))
+    assert rows == [(i, str(i)) for i in range(201)]
+    rows = list(connection.execute("SELECT d FROM v;"))
+    assert rows == [(i / 2,) for i in range(200)]
+    connection.execute("INSERT INTO v VALUES (0.25);")
+    project._ALL_DATABASES.close(path)
+    assert database.wal.file.closed
+
+
+def test_only_a_change_creates_a_log_segment(tmp_path):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    assert not list(tmp_path.iterdir())
+    connection.execute("CREATE TABLE t (a INTEGER);")
+    connection.execute("INSERT INTO t VALUES (1);")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["db-wal1"]
+    connection.database.checkpoint().join()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["db"]
+    for _ in range(2):
+        connection = reopen(path)
+        assert list(connection.execute("SELECT a FROM t;")) == [(1,)]
+        connection.database.checkpoint().join()
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["db"]
+    connection.execute("INSERT INTO t VALUES (2);")
+    connection = reopen(path)
+    assert list(connection.execute("SELECT a FROM t;")) == [(1,), (2,)]
+    project._ALL_DATABASES.close(path)
+
+
+def test_frozen_columns_keep_their_rows():
+    for column_type, values in (("INTEGER", [1, None, 3, 4]),
+                                ("TEXT", ["a", None, "c", "d"])):
+        column = project.ColumnVector(column_type)
+        column.extend(values)
+        frozen = column.freeze()
+        column[0] = values[3]
+        column.remove([2])
+        column.append(values[0])
+        frozen.unfreeze(len(values))
+        assert list(frozen) == values
+        assert list(column) == [values[3], None, values[3], values[0]]
+        column[1] = values[2]
+        assert list(frozen) == values
+
+
+def test_changes_during_a_checkpoint_are_replayed_once(tmp_path,
+                                                       monkeypatch):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT);")
+    connection.executemany("INSERT INTO t VALUES (?, ?);",
+                           [(i, str(i)) for i in range(100)])
+    # Hold the checkpoint back until the changes below are made.
+    changed = threading.Event()
+    copy_rows = project.copy_rows
+
+    def wait_then_copy(values, row_count):
+        changed.wait()
+        return copy_rows(values, row_count)
+
+    monkeypatch.setattr(project, "copy_rows", wait_then_copy)
+    checkpoint = connection.database.checkpoint()
+    connection.execute("UPDATE t SET b = 'u' WHERE a < 10;")
+    connection.execute("DELETE FROM t WHERE a > 90;")
+    connection.execute("INSERT INTO t VALUES (500, 'x');")
+    changed.set()
+    checkpoint.join()
+    expected = list(connection.execute("SELECT * FROM t;"))
+    assert len(expected) == 92
+    connection = reopen(path)
+    assert list(connection.execute("SELECT * FROM t;")) == expected
+    project._ALL_DATABASES.close(path)
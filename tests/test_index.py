@@ -0,0 +1,93 @@
+"""
+Indexed lookups against a copy of the same table without indexes, while
+rows are inserted, updated and deleted. The index constants are made
+small so that key blocks split and deleted rows are renumbered often.
+"""
+import random
+
+import pytest
+
+import project
+
+QUERIES = [
+    "SELECT * FROM {} WHERE a = ?;",
+    "SELECT * FROM {} WHERE a > ?;",
+    "SELECT * FROM {} WHERE a <= ?;",
+    "SELECT * FROM {} WHERE a != ?;",
+    "SELECT * FROM {} WHERE a IN (1, 2, ?);",
+    "SELECT * FROM {} WHERE a BETWEEN 10 AND ?;",
+    "SELECT * FROM {} WHERE b = 's3' AND a < ?;",
+]
+
+
+@pytest.fixture
+def small_index_blocks(monkeypatch):
+    monkeypatch.setattr(project, "INDEX_GAPS", 7)
+    monkeypatch.setattr(project, "SORTED_BLOCK_KEYS", 6)
+    monkeypatch.setattr(project, "FEW_ROWS", 3)
+
+
+def test_sorted_keys_match_a_sorted_list(small_index_blocks):
+    generator = random.Random(3)
+    keys = project.SortedKeys()
+    expected = []
+    for _ in range(2000):
+        key = generator.randrange(500)
+        if key in expected:
+            keys.remove(key)
+            expected.remove(key)
+        else:
+            keys.add(key)
+            expected.append(key)
+            expected.sort()
+        assert list(keys) == expected
+    for key in range(-1, 502, 7):
+        start = keys.bisect_left(key)
+        end = keys.bisect_right(key + 20)
+        assert keys.between(start, end) == [k for k in expected
+                                            if key <= k <= key + 20]
+        if start < len(expected):
+            assert keys[start] == expected[start]
+
+
+def test_indexed_lookups_match_scans(small_index_blocks):
+    generator = random.Random(11)
+    connection = project.connect(":memory:")
+    for table_name in ("i", "p"):
+        connection.execute("CREATE TABLE {} (a INTEGER, b TEXT);"
+                           .format(table_name))
+    connection.execute("CREATE INDEX ia ON i (a);")
+    connection.execute("CREATE INDEX ib ON i (b);")
+
+    def run(statement, parameters=()):
+        for table_name in ("i", "p"):
+            connection.execute(statement.format(table_name), parameters)
+
+    def value():
+        return generator.choice([None, generator.randrange(60)])
+
+    for _ in range(1500):
+        choice = generator.random()
+        if choice < 0.35:
+            rows = [(value(), generator.choice(
+                        [None, "s%d" % generator.randrange(30)]))
+                    for _ in range(generator.randrange(1, 4))]
+            for table_name in ("i", "p"):
+                connection.executemany(
+                    "INSERT INTO {} VALUES (?, ?);".format(table_name), rows)
+        elif choice < 0.55:
+            run("DELETE FROM {} WHERE a = ?;", (generator.randrange(60),))
+        elif choice < 0.7:
+            run("UPDATE {} SET a = ? WHERE b = ?;",
+                (value(), "s%d" % generator.randrange(30)))
+        elif choice < 0.75:
+            connection.execute("BEGIN TRANSACTION;")
+            run("DELETE FROM {} WHERE b = ?;",
+                ("s%d" % generator.randrange(30),))
+            connection.execute(generator.choice(["COMMIT TRANSACTION;",
+                                                 "ROLLBACK TRANSACTION;"]))
+        else:
+            query = generator.choice(QUERIES)
+            constant = (generator.randrange(60),)
+            assert (list(connection.execute(query.format("i"), constant)) ==
+                    list(connection.execute(query.format("p"), constant)))
@@ -0,0 +1,45 @@
+"""
+LIMIT and OFFSET against sqlite3, with and without ORDER BY (the top-K
+heap) and DISTINCT, given as literals and as parameters.
+"""
+import random
+import sqlite3
+
+import project
+
+# Orders that leave no ties, so both must give the same rows in turn.
+SELECTS = ["* FROM t", "* FROM t ORDER BY b, id",
+           "* FROM t ORDER BY b DESC, id DESC", "* FROM t ORDER BY a DESC, id",
+           "DISTINCT a FROM t", "DISTINCT b FROM t ORDER BY b DESC"]
+
+
+def test_limits_match_sqlite():
+    expected = sqlite3.connect(":memory:")
+    connection = project.connect(":memory:")
+    generator = random.Random(9)
+    rows = [(row_id, generator.choice([None, 1, 2, 3]),
+             generator.randrange(10)) for row_id in range(60)]
+    for database in (expected, connection):
+        database.execute("CREATE TABLE t (id INTEGER, a INTEGER, "
+                         "b INTEGER);")
+        database.executemany("INSERT INTO t VALUES (?, ?, ?);", rows)
+    for select in SELECTS:
+        for limit, offset in [(-1, 0), (0, 0), (5, 0), (5, 3), (-1, 10),
+                              (100, 55), (3, -2)]:
+            query = "SELECT {} LIMIT {} OFFSET {};".format(select, limit,
+                                                           offset)
+            parameterized = "SELECT {} LIMIT ? OFFSET ?;".format(select)
+            results = [list(connection.execute(query)),
+                       list(connection.execute(parameterized,
+                                               (limit, offset)))]
+            if "ORDER BY" not in select:
+                # Without ORDER BY, only which rows come out is fixed.
+                results = [sorted(result, key=repr) for result in results]
+            assert results[0] == results[1], query
+            if "ORDER BY" in select:
+                assert results[0] == list(expected.execute(query)), query
+            else:
+                assert len(results[0]) == len(list(expected.execute(query)))
+    query = "SELECT id FROM t ORDER BY b LIMIT -1;"
+    assert len(list(connection.execute(query))) == len(rows)
+    project._ALL_DATABASES.close(":memory:")
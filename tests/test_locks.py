@@ -0,0 +1,88 @@
+"""
+The lock manager: readers alongside a writer, waits that end when the
+holder lets go or time out, and waits that could never end.
+"""
+import threading
+import time
+
+import pytest
+
+import project
+
+
+def run(target, *args):
+    """
+    Runs target on a thread of its own and returns the thread, with
+    its exception, if it raised one, in .error.
+    """
+    def call():
+        try:
+            target(*args)
+        except Exception as error:
+            thread.error = error
+
+    thread = threading.Thread(target=call)
+    thread.error = None
+    thread.start()
+    return thread
+
+
+def test_readers_run_while_a_writer_prepares_its_changes():
+    writer = project.connect(":memory:")
+    reader = project.connect(":memory:")
+    writer.execute("CREATE TABLE t (a INTEGER);")
+    writer.execute("INSERT INTO t VALUES (1);")
+    writer.execute("BEGIN TRANSACTION;")
+    writer.execute("UPDATE t SET a = 2;")
+    assert list(reader.execute("SELECT a FROM t;")) == [(1,)]
+    writer.execute("COMMIT TRANSACTION;")
+    assert list(reader.execute("SELECT a FROM t;")) == [(2,)]
+    project._ALL_DATABASES.close(":memory:")
+
+
+def test_a_writer_waits_for_readers_and_holds_off_new_ones():
+    locks = project.LockManager()
+    locks.add_shared(1)
+    writer = run(locks.add_exclusive, 2, 5.0)
+    while locks.pending != 2:
+        time.sleep(0.001)
+    late_reader = run(locks.add_shared, 3, 0.05)
+    late_reader.join()
+    assert str(late_reader.error) == "database is locked"
+    assert writer.is_alive()
+    locks.release_shared(1)
+    writer.join()
+    assert writer.error is None and locks.exclusive == 2
+
+
+def test_waits_that_cannot_end_raise_at_once():
+    locks = project.LockManager()
+    locks.add_reserved(1)
+    with pytest.raises(Exception, match="database is locked"):
+        locks.add_reserved(2, timeout=None)
+    other = run(locks.add_reserved, 2, 0.05)
+    other.join()
+    assert str(other.error) == "database is locked"
+    locks.release_reserved(1)
+
+    # 1 waits for 2 to stop reading while 2 waits for 1's RESERVED.
+    locks.add_shared(1)
+    locks.add_reserved(1)
+    reading = threading.Event()
+
+    def second():
+        locks.add_shared(2)
+        reading.set()
+        try:
+            while locks.pending != 1:
+                time.sleep(0.001)
+            locks.add_reserved(2, timeout=None)
+        finally:
+            locks.remove_shared(2)
+
+    thread = run(second)
+    reading.wait()
+    locks.add_exclusive(1, timeout=5.0)
+    thread.join()
+    assert str(thread.error) == "deadlock detected"
+    assert locks.exclusive == 1
@@ -0,0 +1,19 @@
+"""
+Column names: equal names hash alike, and lookups match a name without a
+table to the column of any table.
+"""
+import project
+
+
+def test_names_are_equal_only_when_their_keys_are():
+    name = project.QualifiedColumnName
+    assert name("a", "t") == name("a", "t")
+    assert name("a") != name("a", "t")
+    assert name("a", "t") != name("a", "u")
+    assert len({name("a"), name("a", "t"), name("a", "t")}) == 2
+    assert name("a").matches(name("a", "t"))
+    assert not name("a", "u").matches(name("a", "t"))
+    columns = (name("a", "t"), name("b", "t"), name("a", "u"))
+    assert project.find_column(columns, name("a")) == 0
+    assert project.find_column(columns, name("a", "u")) == 2
+    assert project.find_column((name("b"),), name("b", "t")) == 0
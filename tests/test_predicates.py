@@ -0,0 +1,114 @@
+"""
+WHERE clauses against sqlite3: random expressions over columns with
+NULLs, through a plain scan and through an index.
+"""
+import random
+import sqlite3
+
+import pytest
+
+import project
+
+ROWS = [(row_id, a, b, s) for row_id, (a, b, s) in enumerate(
+    (a, b, s) for a in (None, 0, 2, 4) for b in (None, 1, 2, 5)
+    for s in (None, "ab", "b_c", "Abc"))]
+COMPARISONS = ["=", "!=", "<", ">", "<=", ">="]
+
+
+def digit(generator):
+    return generator.choice("012345")
+
+
+def number(generator):
+    return generator.choice(["NULL", digit(generator)])
+
+
+def predicate(generator):
+    column = generator.choice(["a", "b"])
+    kind = generator.randrange(7)
+    if kind == 0:
+        return "{} {} {}".format(column, generator.choice(COMPARISONS),
+                                 digit(generator))
+    if kind == 1:
+        return "a {} b".format(generator.choice(COMPARISONS))
+    if kind == 2:
+        return "{} IS {}NULL".format(column,
+                                     generator.choice(["", "NOT "]))
+    if kind == 3:
+        return "{} {}IN ({})".format(
+            column, generator.choice(["", "NOT "]),
+            ", ".join(number(generator)
+                      for _ in range(generator.randint(1, 3))))
+    if kind == 4:
+        return "{} {}BETWEEN {} AND {}".format(
+            column, generator.choice(["", "NOT "]), number(generator),
+            number(generator))
+    if kind == 5:
+        return "s {}LIKE '{}'".format(
+            generator.choice(["", "NOT "]),
+            generator.choice(["a%", "%b%", "_b%", "abc", "%"]))
+    return "s {} '{}'".format(generator.choice(COMPARISONS),
+                              generator.choice(["ab", "b", "Abc"]))
+
+
+def expression(generator, depth=0):
+    if depth >= 2 or generator.random() < 0.4:
+        return predicate(generator)
+    kind = generator.randrange(3)
+    if kind == 0:
+        return "NOT ({})".format(expression(generator, depth + 1))
+    return "({}) {} ({})".format(expression(generator, depth + 1),
+                                 "AND" if kind == 1 else "OR",
+                                 expression(generator, depth + 1))
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_where_clauses_match_sqlite(indexed):
+    expected = sqlite3.connect(":memory:")
+    connection = project.connect(":memory:")
+    for database in (expected, connection):
+        database.execute(
+            "CREATE TABLE t (id INTEGER, a INTEGER, b INTEGER, s TEXT);")
+        database.executemany("INSERT INTO t VALUES (?, ?, ?, ?);", ROWS)
+    if indexed:
+        connection.execute("CREATE INDEX ta ON t (a);")
+    generator = random.Random(13)
+    where_clauses = [
+        "NOT (a BETWEEN NULL AND 1)",
+        "NOT (a BETWEEN 2 AND NULL)",
+        "NOT (a BETWEEN NULL AND NULL)",
+        "a BETWEEN NULL AND 4",
+        "NOT (NOT (b NOT BETWEEN NULL AND 1))",
+    ] + [expression(generator) for _ in range(400)]
+    for where_clause in where_clauses:
+        query = "SELECT id FROM t WHERE {};".format(where_clause)
+        assert (sorted(connection.execute(query)) ==
+                sorted(expected.execute(query))), query
+    # A NULL bound to a placeholder compares as NULL does: never TRUE.
+    for where_clause in ["a {} ?", "NOT (a {} ?)", "a {} ? OR b = 1"]:
+        for operator in COMPARISONS:
+            query = "SELECT id FROM t WHERE {};".format(
+                where_clause.format(operator))
+            assert (sorted(connection.execute(query, (None,))) ==
+                    sorted(expected.execute(query, (None,)))), query
+    project._ALL_DATABASES.close(":memory:")
+
+
+def test_null_parameters_in_having_and_ranges():
+    expected = sqlite3.connect(":memory:")
+    connection = project.connect(":memory:")
+    for database in (expected, connection):
+        database.execute("CREATE TABLE t (id INTEGER, a INTEGER, "
+                         "b INTEGER, s TEXT);")
+        database.executemany("INSERT INTO t VALUES (?, ?, ?, ?);", ROWS)
+    connection.execute("CREATE INDEX tb ON t (b);")
+    connection.execute("ANALYZE;")
+    for query in [
+            "SELECT a, count(b) FROM t GROUP BY a HAVING count(b) > ?;",
+            "SELECT a, min(b) FROM t GROUP BY a HAVING min(b) <= ?;",
+            "SELECT id FROM t WHERE b < ? AND a = 2;",
+            "SELECT id FROM t WHERE a >= ? OR b BETWEEN 1 AND ?;"]:
+        parameters = (None,) * query.count("?")
+        assert (sorted(connection.execute(query, parameters)) ==
+                sorted(expected.execute(query, parameters))), query
+    project._ALL_DATABASES.close(":memory:")
@@ -0,0 +1,78 @@
+"""
+The result cache: a cached SELECT is served again only while no change
+to the tables it read, from this connection or a committed one, has
+been made since.
+"""
+import pytest
+
+import project
+
+QUERY = "SELECT a, b FROM t WHERE a < ? ORDER BY a;"
+
+
+@pytest.fixture
+def connection(tmp_path):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT);")
+    connection.execute("CREATE TABLE u (c INTEGER);")
+    connection.executemany("INSERT INTO t VALUES (?, ?);",
+                           [(i, str(i)) for i in range(10)])
+    connection.set_result_cache(100)
+    yield connection
+    project._ALL_DATABASES.close(path)
+
+
+def check(connection, expected, hit):
+    """
+    Runs QUERY twice: the first time from the cache if hit, the second
+    time always from it. Both must give the expected rows.
+    """
+    cache = connection.database.result_cache
+    hits = cache.hits
+    assert list(connection.execute(QUERY, (5,))) == expected
+    assert cache.hits == hits + hit
+    assert list(connection.execute(QUERY, (5,))) == expected
+    assert cache.hits == hits + hit + 1
+
+
+def test_changes_on_this_connection_invalidate(connection):
+    rows = [(i, str(i)) for i in range(5)]
+    check(connection, rows, False)
+    connection.execute("INSERT INTO u VALUES (1);")
+    check(connection, rows, True)
+    connection.execute("INSERT INTO t VALUES (-1, 'x');")
+    rows = [(-1, "x")] + rows
+    check(connection, rows, False)
+    connection.execute("UPDATE t SET b = 'y' WHERE a = 3;")
+    rows[4] = (3, "y")
+    check(connection, rows, False)
+    connection.execute("DELETE FROM t WHERE a = 0;")
+    del rows[1]
+    check(connection, rows, False)
+    connection.execute("DROP TABLE t;")
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT);")
+    check(connection, [], False)
+    assert connection.database.result_cache.invalidations == 4
+
+
+def test_commits_on_another_connection_invalidate(connection):
+    other = project.connect(connection.database.path)
+    rows = [(i, str(i)) for i in range(5)]
+    check(connection, rows, False)
+    other.execute("BEGIN TRANSACTION;")
+    other.execute("UPDATE t SET b = 'z' WHERE a < 2;")
+    other.execute("DELETE FROM t WHERE a = 4;")
+    # Not committed yet, so not seen.
+    check(connection, rows, True)
+    other.execute("ROLLBACK TRANSACTION;")
+    check(connection, rows, True)
+    other.execute("BEGIN TRANSACTION;")
+    other.execute("UPDATE t SET b = 'z' WHERE a < 2;")
+    other.execute("DELETE FROM t WHERE a = 4;")
+    other.execute("INSERT INTO t VALUES (-2, 'w');")
+    other.execute("COMMIT TRANSACTION;")
+    rows = [(-2, "w"), (0, "z"), (1, "z"), (2, "2"), (3, "3")]
+    check(connection, rows, False)
+    other.execute("INSERT INTO t VALUES (-3, 'v');")
+    check(connection, [(-3, "v")] + rows, False)
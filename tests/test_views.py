@@ -0,0 +1,98 @@
+"""
+Materialized views: what may be created and dropped, and their rows
+against the query they cache as the tables under them change.
+"""
+import pytest
+
+import project
+
+
+def reopen(path):
+    project._ALL_DATABASES.close(path)
+    return project.connect(path)
+
+
+@pytest.fixture
+def connection(tmp_path):
+    path = str(tmp_path / "db")
+    connection = project.connect(path)
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT);")
+    connection.executemany("INSERT INTO t VALUES (?, ?);",
+                           [(i, "s{}".format(i % 3)) for i in range(20)])
+    yield connection
+    project._ALL_DATABASES.close(path)
+
+
+def test_views_need_tables_and_a_name_of_their_own(connection):
+    with pytest.raises(AssertionError):
+        connection.execute(
+            "CREATE MATERIALIZED VIEW m AS SELECT a FROM nosuch;")
+    with pytest.raises(AssertionError):
+        connection.execute("CREATE MATERIALIZED VIEW t AS SELECT a FROM t;")
+    connection.execute("CREATE VIEW v AS SELECT a FROM t WHERE a < 5;")
+    with pytest.raises(AssertionError):
+        connection.execute("CREATE MATERIALIZED VIEW m AS SELECT a FROM v;")
+    with pytest.raises(AssertionError):
+        connection.execute("CREATE MATERIALIZED VIEW v AS SELECT a FROM t;")
+    connection.execute("CREATE MATERIALIZED VIEW m AS SELECT a FROM t;")
+    with pytest.raises(AssertionError):
+        connection.execute("CREATE TABLE m (a INTEGER);")
+    connection.execute("CREATE TABLE IF NOT EXISTS m (a INTEGER);")
+    assert "m" not in connection.database.tables
+    connection.execute("DROP VIEW v;")
+    connection.execute("DROP VIEW IF EXISTS v;")
+    with pytest.raises(AssertionError):
+        connection.execute("DROP VIEW v;")
+    connection = reopen(connection.database.path)
+    assert list(connection.database.views) == ["m"]
+
+
+def test_tables_under_a_view_stay_until_it_is_dropped(connection):
+    path = connection.database.path
+    connection.execute("CREATE MATERIALIZED VIEW m AS SELECT a FROM t;")
+    with pytest.raises(AssertionError):
+        connection.execute("DROP TABLE t;")
+    connection.execute("BEGIN TRANSACTION;")
+    connection.execute("DROP MATERIALIZED VIEW m;")
+    connection.execute("ROLLBACK TRANSACTION;")
+    assert len(list(connection.execute("SELECT * FROM m;"))) == 20
+    connection.execute("BEGIN TRANSACTION;")
+    connection.execute("DROP MATERIALIZED VIEW m;")
+    connection.execute("DROP TABLE t;")
+    connection.execute("COMMIT TRANSACTION;")
+    connection.execute("DROP MATERIALIZED VIEW IF EXISTS m;")
+    with pytest.raises(AssertionError):
+        connection.execute("DROP MATERIALIZED VIEW m;")
+    connection = reopen(path)
+    assert not connection.database.views
+    assert not connection.database.tables
+    connection.execute("CREATE TABLE m (a INTEGER);")
+
+
+@pytest.mark.parametrize("select", [
+    "SELECT a, b FROM t WHERE a > 4",
+    "SELECT * FROM t",
+    "SELECT b, count(a) FROM t GROUP BY b",
+    "SELECT DISTINCT b FROM t ORDER BY b",
+])
+def test_views_follow_their_tables(connection, select):
+    connection.execute("CREATE MATERIALIZED VIEW m AS {};".format(select))
+
+    def check():
+        expected = sorted(connection.execute(select + ";"))
+        assert sorted(connection.execute("SELECT * FROM m;")) == expected
+
+    check()
+    connection.execute("INSERT INTO t VALUES (7, 'new');")
+    check()
+    connection.execute("UPDATE t SET b = 'u' WHERE a < 8;")
+    check()
+    connection.execute("DELETE FROM t WHERE a = 7;")
+    check()
+    connection.execute("BEGIN TRANSACTION;")
+    connection.execute("DELETE FROM t WHERE a > 15;")
+    check()
+    connection.execute("COMMIT TRANSACTION;")
+    check()
+    connection = reopen(connection.database.path)
+    check()